@@ -999,6 +999,13 @@ class Properties(Action):
             if s in ('','-'):
                 return 0
             return int(s)
+        def direction_parser(s):
+            # 'x, y' or part of one, None when it's left empty or zero
+            parts = s.split(',')
+            if len(parts) > 2:
+                raise ValueError
+            direction = [0 if part.strip() in ('', '-') else float(part) for part in parts + ['']*(2 - len(parts))]
+            return direction if any(direction) else None
 
         tk.Label(primary, text='Friction:').grid(row=0, column=0)
         widgets.PropertyEntry(primary, self.new_values, ('friction',), positive_float_parser, width=6).grid(row=0, column=1)
@@ -1012,6 +1019,15 @@ class Properties(Action):
         tk.Label(primary, text='Trigger:').grid(row=3, column=0)
         TriggerProperty(primary, self.new_values).grid(row=3, column=1)
 
+        tk.Label(primary, text='Trigger after tick:').grid(row=4, column=0)
+        widgets.BoolProperty(primary, self.new_values, ('trigger_after_tick',)).grid(row=4, column=1)
+
+        tk.Label(primary, text='Sensor:').grid(row=5, column=0)
+        widgets.BoolProperty(primary, self.new_values, ('sensor',)).grid(row=5, column=1)
+
+        tk.Label(primary, text='One way:').grid(row=6, column=0)
+        widgets.PropertyEntry(primary, self.new_values, ('one_way',), direction_parser, width=6).grid(row=6, column=1)
+
         ttk.Separator(inner, orient=tk.HORIZONTAL).pack(fill='x', pady=5)
 
         notebook = ttk.Notebook(inner)
@@ -0,0 +1,126 @@
+'''Measures how fast the physics steps the bundled levels, without opening a window.
+
+Usage: python benchmark.py [--ticks N] [--players N] [--inputs scripted|random] [--narrowphase-threads N] [--json] [level ...]
+
+Each level is loaded through main.create_world, given some players and stepped as fast as it
+will go. Scripted players run back and forth and jump at fixed intervals, random ones pick new
+seeded inputs every so often, so either way a run is the same every time. Reports ticks per
+second, tick time percentiles and where the physics spent its time, from the world's stats.
+With no levels given every level is run, --standard runs just STANDARD_LEVELS.
+'''
+from typing import *
+
+import sys, os, time, random, glob, json, argparse
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')  # Keeps stdout to the results
+
+import numpy as np
+
+import main, editor, objects
+
+# Heavy on contacts, heavy on joints, so regressions in either show up
+STANDARD_LEVELS = ['stresstest', 'stresstest2', 'pendulum']
+
+PERCENTILES = (50, 90, 99)
+RANDOM_INPUT_INTERVAL = 20
+
+def scripted_action(tick: int, index: int) -> Tuple[int, int]:
+    # Run one way then the other, jumping every so often. Players are offset so they don't move as one
+    tick += index * 50
+    return 1 if (tick // 150) % 2 == 0 else -1, -1 if tick % 37 == 0 else 0
+
+def benchmark_level(path: str, ticks: int, players: int, inputs: str, narrowphase_threads: int = 1) -> Dict[str, Any]:
+    random.seed(0)
+    np.random.seed(0)
+    world = main.create_world(editor.load_file(path))
+    world.narrowphase_threads = narrowphase_threads
+
+    benchmark_players = []
+    for i in range(players):
+        player = objects.BasePlayer(world, (255, 255, 255), 'Benchmark {}'.format(i))
+        world.add_object(player)
+        benchmark_players.append(player)
+    rng = random.Random(0)
+
+    world.reset_stats()
+    tick_times = []
+    start = time.perf_counter()
+    for tick in range(ticks):
+        for i, player in enumerate(benchmark_players):
+            if inputs == 'scripted':
+                player.action = scripted_action(tick, i)
+            elif tick % RANDOM_INPUT_INTERVAL == 0:
+                player.action = rng.choice((-1, 0, 1)), rng.choice((-1, 0, 0))
+
+        tick_start = time.perf_counter()
+        world.update()
+        tick_times.append(time.perf_counter() - tick_start)
+    elapsed = time.perf_counter() - start
+
+    stats = world.stats
+    tick_ms = np.array(tick_times) * 1000
+    return {
+        'level': os.path.splitext(os.path.basename(path))[0],
+        'objects': len(world),
+        'ticks': ticks,
+        'ticks_per_second': ticks / elapsed,
+        'tick_ms': {
+            'mean': float(tick_ms.mean()),
+            **{'p{}'.format(p): float(np.percentile(tick_ms, p)) for p in PERCENTILES},
+            'max': float(tick_ms.max()),
+        },
+        'steps_per_tick': stats['steps'] / ticks,
+        # Physics time per tick, whatever isn't in 'total' went on Python (scripts, objects, events)
+        'phase_ms': {name: seconds * 1000 / ticks for name, seconds in stats['time'].items()},
+        'per_tick': {name: stats[name] / ticks for name in
+                     ('pairs', 'contacts', 'contact_points', 'awake_objects', 'collision_handler_calls', 'constraint_callbacks')},
+        'narrowphase': stats['narrowphase'],
+    }
+
+def print_table(results: List[Dict[str, Any]]):
+    phases = list(results[0]['phase_ms']) if results else []
+    percentiles = ['p{}'.format(p) for p in PERCENTILES]
+    print('{:<16} {:>7} {:>9}'.format('level', 'objects', 'ticks/s') +
+          ''.join(' {:>8}'.format(name + ' ms') for name in percentiles) + ' {:>6}'.format('steps') +
+          ''.join(' {:>11}'.format(phase) for phase in phases))
+    for result in results:
+        print('{:<16} {:>7} {:>9.1f}'.format(result['level'], result['objects'], result['ticks_per_second']) +
+              ''.join(' {:>8.3f}'.format(result['tick_ms'][name]) for name in percentiles) +
+              ' {:>6.2f}'.format(result['steps_per_tick']) +
+              ''.join(' {:>11.3f}'.format(result['phase_ms'][phase]) for phase in phases))
+
+def level_path(name: str) -> str:
+    if os.path.exists(name):
+        return name
+    return os.path.join('levels', name if name.endswith('.json') else name + '.json')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless physics benchmark over the bundled levels')
+    parser.add_argument('levels', nargs='*', help='level names or paths, every level by default')
+    parser.add_argument('--ticks', type=int, default=1000)
+    parser.add_argument('--players', type=int, default=1)
+    parser.add_argument('--inputs', choices=('scripted', 'random'), default='scripted')
+    parser.add_argument('--narrowphase-threads', type=int, default=1, help='threads each world splits its pairs over')
+    parser.add_argument('--standard', action='store_true', help='run STANDARD_LEVELS only')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    if args.levels:
+        levels = [level_path(name) for name in args.levels]
+    elif args.standard:
+        levels = [level_path(name) for name in STANDARD_LEVELS]
+    else:
+        levels = sorted(glob.glob('levels/*.json'))
+
+    results = []
+    for path in levels:
+        print('Running', path, file=sys.stderr)
+        results.append(benchmark_level(path, args.ticks, args.players, args.inputs, args.narrowphase_threads))
+
+    if args.json:
+        json.dump({'ticks': args.ticks, 'players': args.players, 'inputs': args.inputs,
+                   'narrowphase_threads': args.narrowphase_threads, 'results': results},
+                  sys.stdout, indent=2)
+        print()
+    else:
+        print_table(results)
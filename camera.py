@@ -36,11 +36,10 @@ class Camera:
 
         gl.glTranslatef(*(-self.pos), 0)
 
-    def is_visible(self, lower, upper):
-        return  upper[0] >= self.pos[0] - self.size[0]*0.5 and \
-                upper[1] >= self.pos[1] - self.size[1]*0.5 and \
-                lower[0] <= self.pos[0] + self.size[0]*0.5 and \
-                lower[1] <= self.pos[1] + self.size[1]*0.5
+    @property
+    def bounds(self):
+        half = np.multiply(self.size, 0.5)
+        return self.pos - half, self.pos + half
 
 
 
@@ -65,9 +64,13 @@ class PlayerCamera(Camera):
         self.load()
         self.update_position()
         
+        visible = self.player.world.query_visible(*self.bounds)
+        # Names are drawn above players, so players just off screen still need drawing
+        drawn = set(visible)
+        visible += [player for player in self.player.world.players if player not in drawn]
         if self.fancy:
-            for obj in self.player.world:
+            for obj in visible:
                 obj.render_fancy(self)
         else:
-            for obj in self.player.world:
+            for obj in visible:
                 obj.render(self)
@@ -11,6 +11,7 @@ class Client:
         copied_world.script = {} # No scripts should ever be run on drawer
 
         copied_world.steps = 2
+        copied_world.max_steps = 2
         self.object_map = dict(zip(world, copied_world))
 
         self.drawer = Drawer(fancy, [self.object_map[player] for player in players], screen, copied_world)
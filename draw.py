@@ -17,6 +17,7 @@ class Drawer:
         self.cameras = []
 
         self.target_tick = 0
+        self.snapshot = None
 
     def load(self, world, obj_map): # obj_map is between world to self.world
         tick = self.world.tick
@@ -35,11 +36,6 @@ class Drawer:
             else:
                 self.toremove.remove(obj_b)
 
-            obj_b.pos = obj_a.pos
-            obj_b.vel = obj_a.vel
-            obj_b.rot = obj_a.rot
-            obj_b.rot_vel = obj_a.rot_vel
-
         for obj in self.toremove:
             if 'remove_object' in self.world.script:
                 try:
@@ -49,6 +45,15 @@ class Drawer:
             self.world.remove_object(obj)
             obj.cleanup()
 
+        # Contacts and joint impulses come across too, so prediction starts from a warm solver
+        self.snapshot = world.snapshot(self.snapshot)
+        try:
+            self.world.restore(self.snapshot, [obj_map[obj] for obj in world])
+        except ValueError:
+            # The joints or controllers don't line up, as when a player joins or leaves between
+            # loads, so only the objects' states come across
+            self.world.set_state(world.get_state(list(obj_map.keys())), list(obj_map.values()))
+
         dt = max(tick - world.tick, 0)
         self.world.update(dt)
 
@@ -40,9 +40,12 @@ DEFAULT_SERVER_SCRIPT = '''
 # Functions inside this script will be executed based on triggers bound using the level editor.
 
 # The below function is a collision trigger, once bound to an object it will be called for each collision the object has.
+# Triggers run as the collision happens, or once the tick is over when the object has Trigger after tick set, which is faster.
+# What they return is ignored, whether objects touch is set in the object's properties instead:
+# everything passes through a sensor, and anything moving in the object's one way direction passes through it.
+# For example a platform with a one way direction of 0, -1 lets players jump up through it but not fall down through it.
 def handler(self, other, normal, local_a, local_b):
-   #A return value of True cancels the collision so no collision response is applied.
-   return other.vel[1] < 0 # This example would allow any physics object (including players) to jump through this object but not fall down through it.
+   pass
 
 def on_death(player): # Called whenever any player dies.
     pass
@@ -137,6 +137,20 @@ Mean   : {sum(self.times)/len(self.times):.2f}
 Median : {sorted_times[len(self.times)//2]:.2f}
 ''')
 
+def print_physics_stats(stats):
+    # Breaks down the profiler's 'Updating' with a world's stats, per physics step
+    steps = stats['steps']
+    if steps == 0:
+        return
+    total = stats['time']['total']
+    for name, seconds in stats['time'].items():
+        print(f'{name:<12}: {seconds/steps*1000:.3f}ms {seconds/total*100 if total else 0:.1f}%')
+    for name in ('pairs', 'contacts', 'contact_points', 'awake_objects', 'collision_handler_calls', 'constraint_callbacks'):
+        print(f'{name:<24}: {stats[name]/steps:.1f}')
+    narrowphase = stats['narrowphase']
+    print('gjk histogram           :', narrowphase['gjk_histogram'])
+    print('epa histogram           :', narrowphase['epa_histogram'])
+
 
 def draw_square(lower: Tuple[float, float], upper: Tuple[float, float]):
     depth = 1
@@ -320,14 +334,13 @@ def run(levelname: Optional[str]=None, port: Optional[int]=None, address: Option
                 gl.glEnd()
 
             if False: # Debug AABB tree
-                root = world.AABBTree.root
                 def traverse(node):
                     draw_square(*node.bounds)
 
                     if hasattr(node, 'children'):
                         for child in node.children:
                             traverse(child)
-                if root is not None:
+                for root in world.AABBTree.roots:
                     traverse(root)
 
             profiler('Flipping')
@@ -341,6 +354,8 @@ def run(levelname: Optional[str]=None, port: Optional[int]=None, address: Option
         print()
         print('FPS:')
         frame_timer.print_results()
+        print('Physics:')
+        print_physics_stats(world.stats)
 
         if multiplayer:
             '''print('Writing trace')
@@ -409,6 +424,9 @@ def run_server(levelname, port):
                                 print(', '.join(player.name for player in players) + ': ping={:.2f}±{:.2f}ms loss={:.1f}%'.format(connection.rtt*1000, connection.rtt_dev*1000, connection.packet_loss*100))
                         else:
                             print('No players')
+                    elif line == 't':
+                        print_physics_stats(server.world.stats)
+                        server.world.reset_stats()
                     else:
                         print('Invalid command')
             server.update()
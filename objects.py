@@ -14,6 +14,9 @@ import util, camera, font, decomposition, render, actions
 OFFSET = 5
 SCALE = 0.3
 
+# Player IDs count up from 0 like object IDs, so their sync ids are moved out of the way
+PLAYER_SYNC_ID = 1 << 31
+
 def calculate_props(polygon: List[util.Vec], density: Optional[float]):
     area = sum(util.cross2d(a, b) for a, b in zip(polygon, np.roll(polygon, 1, 0))) / 2
 
@@ -79,14 +82,12 @@ class Object(physics.Object):
             colliders = [physics.PolyCollider(convex) for convex in self.drawn_character.convex_polygons]
 
         self.trigger = data.get('trigger', None)
-        if 'trigger' in data:
-            def handler(other, normal, local_a, local_b):
-                if self.trigger in self.world.script:
-                    return self.world.script[self.trigger](self, other, normal, local_a, local_b)
-                return False
-            self.collide = handler
+        self.trigger_after_tick = data.get('trigger_after_tick', False)
+        self.bind_trigger()
 
         super().__init__(mass, moment, data['restitution'], data['friction'])
+        self.sensor = data.get('sensor', False)
+        self.one_way = data.get('one_way') or (0, 0)
         self.pos = pos
         for collider in colliders:
             self.colliders.append(collider)
@@ -105,16 +106,32 @@ class Object(physics.Object):
 
         self.initial_state = {'colour': list(self.colour), 'pos': self.pos, 'vel': self.vel, 'rot': self.rot, 'rot_vel': self.rot_vel}
 
-    def __setstate__(self, state):
-        super().__setstate__(state)
-        if self.trigger is not None:
-            def handler(other, normal, local_a, local_b):
-                if self.trigger in self.world.script:
-                    return self.world.script[self.trigger](self, other, normal, local_a, local_b)
-                return False
-            self.collide = handler
-        elif hasattr(self, 'collide'):
-            delattr(self, 'collide')
+    @property
+    def checkpoint(self):
+        return self._checkpoint
+    @checkpoint.setter
+    def checkpoint(self, checkpoint):
+        self._checkpoint = checkpoint
+        self.is_checkpoint = checkpoint is not None
+
+    def bind_trigger(self):
+        # A trigger runs from collide, during the step, as each collision happens. With trigger_after_tick
+        # it runs from the world's collision events once the tick is over instead, which keeps Python out of
+        # the step but means the contact has been resolved by the time it runs. Has to be called before
+        # physics.Object.__init__ for the collide callback to be picked up
+        if self.trigger is not None and not self.trigger_after_tick:
+            self.collide = self.run_trigger
+        elif 'collide' in self.__dict__:
+            del self.collide
+        self.report_collisions = self.trigger is not None and self.trigger_after_tick
+
+    def run_trigger(self, other, normal, local_a, local_b):
+        if self.trigger in self.world.script:
+            self.world.script[self.trigger](self, other, normal, local_a, local_b)
+        return False # Triggers can't turn contacts down, sensor and one_way do that
+
+    def on_collision(self, other, normal, local_a, local_b, impulse):
+        self.run_trigger(other, normal, local_a, local_b)
 
     def reset(self):
         self.colour = self.initial_state['colour']
@@ -204,9 +221,6 @@ class Object(physics.Object):
         gl.glEndList()
 
     def render(self, camera):
-        if not camera.is_visible(*self.bounds):
-            return
-
         if self.displaylist is None:
             self.create_displaylist()
         colour = self.checkpoint['colour'] if hasattr(camera, 'player') and self is camera.player.checkpoint else self.colour
@@ -251,8 +265,6 @@ class Object(physics.Object):
         self.fancy_displaylist = displaylist, colour
 
     def render_fancy(self, camera):
-        if not camera.is_visible(*self.bounds):
-            return
         colour = tuple(self.checkpoint['colour'] if hasattr(camera, 'player') and self is camera.player.checkpoint else self.colour)
 
         if self.fancy_displaylist is None:
@@ -279,50 +291,7 @@ class Object(physics.Object):
             gl.glDeleteLists(self.fancy_displaylist[0], 1)
             self.fancy_displaylist = None
 
-class JumpConstraint(physics.CustomConstraint):
-    def __init__(self, normal, local_a, local_b, strength):
-        self.normal = np.array(normal, float)
-        self.local_a = local_a
-        self.local_b = local_b
-
-        player_mass = BasePlayer.density * math.pi * BasePlayer.size**2
-
-        self.target_velocity = 8 * strength
-        #self.target_energy = player_mass*self.target_velocity**2/2
-        self.max_impulse = player_mass * self.target_velocity * 2
-
-        self.impulse = 0
-
-    def apply(self, obj_a, obj_b):
-        V = np.array([*obj_a.vel, 0, *obj_b.vel, obj_b.rot_vel]) # [ms-1, ms-1, s-1, ms-1, ms-1, s-1]
-        M = np.array([obj_a.inv_mass, obj_a.inv_mass, obj_a.inv_moment,
-                      obj_b.inv_mass, obj_b.inv_mass, obj_b.inv_moment]) # kg-1, kg-1, kg-1m-2, kg-1, kg-1, kg-1m-2
-
-        #M[3:] *= 0.5
-
-        offsetA = obj_a.local_to_global_vec(self.local_a)
-        offsetB = obj_b.local_to_global_vec(self.local_b)
-        J = np.array([-self.normal[0], -self.normal[1], util.cross2d(self.normal, offsetA),
-                            self.normal[0], self.normal[1], -util.cross2d(self.normal, offsetB)]) # 1, 1, m, 1, 1, m
-
-        bias = self.target_velocity # ms-1
-        impulse = -(np.dot(V, J) + bias) / np.dot(J*J, M) # np.dot(V,J) = ms-1, np.dot(J*J, M) = kg-1, impulse = kgms-1
-
-        new_impulse = self.impulse + impulse
-        impulse = new_impulse - self.impulse
-        self.impulse = new_impulse
-
-        if impulse == 0:
-            return
-
-        dV = (J * M) * impulse
-
-        obj_a.vel = np.array(obj_a.vel) + dV[0:2]
-        obj_a.rot_vel = obj_a.rot_vel + dV[2]
-        obj_b.vel = np.array(obj_b.vel) + dV[3:5]
-        obj_b.rot_vel = obj_b.rot_vel + dV[5]
-
-class BasePlayer(physics.Object):
+class BasePlayer(physics.ControlledObject):
     size = 15
     density = 0.5
 
@@ -334,12 +303,6 @@ class BasePlayer(physics.Object):
         self.vel = 0, 0
         self.colour = colour
         self.name = name
-        self.dead = -1
-
-        self.jump = False
-
-        self.checkpoint = None
-        self.action = 0,0
 
         self.displaylist = None
         self.fancy_displaylist = None
@@ -395,48 +358,6 @@ class BasePlayer(physics.Object):
     def get_action(self):
         raise NotImplementedError
 
-    def update(self, dt):
-        if self.dead == -1:
-            root = self.world.AABBTree.root
-            if root is not None:
-                gravity = self.world.gravity
-                lower, upper = root.bounds
-                pos = max((lower, (lower[0], upper[1]), (upper[0], lower[1]), upper), key=lambda corner: np.dot(corner, self.world.gravity))
-                if np.dot(pos, gravity) - (np.dot(self.pos, gravity) + np.dot(self.vel, gravity)*0.5) < 0:
-                    self.die()
-                    return
-            
-            delta = 0.01
-            if self.action[1] > 0:
-                stopping = self.rot_vel
-                roll = -1 if self.rot_vel > 0 else 1
-            else:
-                stopping = None
-                roll = self.action[0]
-            
-            roll *= delta
-            energy = abs(self.rot_vel)*self.rot_vel + roll
-            self.rot_vel = math.sqrt(abs(energy))*util.sign(energy)
-
-            if stopping is not None and util.sign(self.rot_vel) != util.sign(stopping):
-                self.rot_vel = 0
-
-            if not isinstance(self.jump, bool):
-                for i, (_, constraint) in enumerate(self.constraints):
-                    if constraint is self.jump:
-                        break
-                else:
-                    raise ValueError
-                del self.constraints[i]
-            self.jump = self.action[1] < -0.1
-
-            if abs(self.rot_vel + roll) < max(0.7, abs(self.rot_vel)):
-                self.rot_vel += roll
-        elif self.dead >= 3:
-            self.die()
-        else:
-            self.dead += 1
-
     def render(self, camera):
         if self.displaylist is None:
             self.create_displaylist()
@@ -469,22 +390,8 @@ class BasePlayer(physics.Object):
         gl.glPopMatrix()
 
 
-    def collide(self, other, normal, local_a, local_b):
-        if hasattr(other, 'lethal') and other.lethal:
-            self.dead = max(self.dead, 0)
-
-        if hasattr(other, 'checkpoint') and type(other.checkpoint) == dict: # make sure it's not another player
-            self.checkpoint = other
-
-        gravity = util.normalise(np.array(self.world.gravity, dtype=float))
-        if np.dot(normal, gravity) < -0.7 and self.jump is True:
-            self.jump = JumpConstraint(normal, local_a, local_b, -self.action[1])
-            self.constraints.append((other, self.jump))
-            return True # Ensure no contact constraint interferes
-        return False
-
     def die(self):
-        self.dead = -1
+        # Rolling, jumping and noticing deaths all happen in the physics world, this only respawns
         if self.checkpoint is None:
             spawn = self.world.spawn
         elif self.checkpoint not in self.world:
@@ -495,15 +402,8 @@ class BasePlayer(physics.Object):
             spawn = np.add(obj.pos, (obj.checkpoint['dx'], obj.checkpoint['dy']))
         self.pos = np.array(spawn, float) + (np.random.random(2)-0.5)*2
         self.vel = 0, 0
+        self.revive()
 
-        if not isinstance(self.jump, bool):
-            for i, (_, constraint) in enumerate(self.constraints):
-                if constraint is self.jump:
-                    break
-            else:
-                raise ValueError
-            del self.constraints[i]
-        self.jump = False
         if 'on_death' in self.world.script:
             self.world.script['on_death'](self)
 
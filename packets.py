@@ -79,6 +79,7 @@ class InitConnectionPacketServer:
             players.append(player)
 
             server.playerIDs[ID] = player
+            player.sync_id = objects.PLAYER_SYNC_ID + ID
             server.world.add_object(player)
 
         server.connections[connection] = players
@@ -110,6 +111,7 @@ class InitConnectionPacketClient:
 
         for ID, player in zip(self.ids, client.players):
             client.playerIDs[ID] = player
+            player.sync_id = objects.PLAYER_SYNC_ID + ID
 
 class NewPlayerPacketClient:
     type = networking.PacketType.RELIABLE
@@ -133,6 +135,7 @@ class NewPlayerPacketClient:
             client.tick()
 
         client.playerIDs[self.id] = player = objects.OtherPlayer(client.world, self.colour, self.name)
+        player.sync_id = objects.PLAYER_SYNC_ID + self.id
         client.world.add_object(player)
 
         client.object_map[player] = objects.OtherPlayer(client.drawer.world, self.colour, self.name)
@@ -166,22 +169,17 @@ class PlayerStatePacketClient:
         if len(args) == 0:
             return
         self.tick, self.id, player = args
-        self.pos = player.pos
-        self.vel = player.vel
-        self.rot = player.rot
-        self.rot_vel = player.rot_vel
+        self.state = player.world.get_state([player])[0]
         self.action = player.action
 
     def read(self, buf):
         res = struct.unpack('<II6d2f', buf)
         self.tick, self.id = res[:2]
-        self.pos = res[2:4]
-        self.vel = res[4:6]
-        self.rot, self.rot_vel = res[6:8]
+        self.state = np.array(res[2:8])
         self.action = res[8:10]
 
     def write(self):
-        return struct.pack('<II6d2f', self.tick, self.id, *self.pos, *self.vel, self.rot, self.rot_vel, *self.action)
+        return struct.pack('<II6d2f', self.tick, self.id, *self.state, *self.action)
 
     def handle_client(self, client):
         while self.tick > client.world.tick:
@@ -191,10 +189,7 @@ class PlayerStatePacketClient:
         player = client.playerIDs.get(self.id)
         if player is None:
             return
-        player.pos = self.pos
-        player.vel = self.vel
-        player.rot = self.rot
-        player.rot_vel = self.rot_vel
+        client.world.set_state([self.state], [player])
         player.action = self.action
 
 class UpdateClientPacketServer:
@@ -312,27 +307,23 @@ class LevelPropsPacketClient:
 class UpdateObjectsPacketClient:
     type = networking.PacketType.NORMAL
 
+    # Same layout as struct '<I6f' per object
+    dtype = np.dtype([('id', '<u4'), ('state', '<f4', (6,))])
+
     def __init__(self, *args):
         if len(args) == 0:
             return
-        self.tick, objects = args
-        self.objects = [(ID, obj.pos, obj.vel, obj.rot, obj.rot_vel) for (ID, obj) in objects]
+        self.tick, ids, state = args # state rows are from World.get_state
+        self.objects = np.empty(len(ids), dtype=self.dtype)
+        self.objects['id'] = ids
+        self.objects['state'] = state
 
     def write(self):
-        return struct.pack('<I', self.tick) + b''.join(struct.pack('<I6f', ID, *pos, *vel, rot, rot_vel) for ID, pos, vel, rot, rot_vel in self.objects)
+        return struct.pack('<I', self.tick) + self.objects.tobytes()
 
     def read(self, buf):
         self.tick, = struct.unpack('<I', buf[:4])
-
-        self.objects = []
-        for data in struct.iter_unpack('<I6f', buf[4:]):
-            self.objects.append([
-               data[0],
-               np.array(data[1:3]),
-               np.array(data[3:5]),
-               data[5],
-               data[6]
-            ])
+        self.objects = np.frombuffer(buf[4:], dtype=self.dtype)
 
     def handle_client(self, client):
         while self.tick > client.world.tick:
@@ -340,14 +331,13 @@ class UpdateObjectsPacketClient:
         if self.tick < client.world.tick:
             return
 
-        for ID, pos, vel, rot, rot_vel in self.objects:
+        objs = []
+        for ID in self.objects['id'].tolist():
             obj = client.world.objects.get(ID)
             if obj is None:
-                return
-            obj.pos = pos
-            obj.vel = vel
-            obj.rot = rot
-            obj.rot_vel = rot_vel
+                break
+            objs.append(obj)
+        client.world.set_state(self.objects['state'][:len(objs)], objs)
 
 class NewObjectPacketClient:
     type = networking.PacketType.RELIABLE
@@ -389,6 +379,7 @@ class NewObjectPacketClient:
             obj.rot_vel = self.rot_vel
 
         client.world.objects[self.id] = obj_a
+        obj_a.sync_id = self.id
         client.world.append(obj_a)
         if 'add_object' in client.world.script:
             try:
@@ -441,6 +432,9 @@ class ObjectPropsPacketClient:
            'checkpoint': obj.checkpoint,
            'groups': obj.groups,
            'trigger': obj.trigger,
+           'trigger_after_tick': obj.trigger_after_tick,
+           'sensor': obj.sensor,
+           'one_way': obj.one_way,
         }
 
     def write(self):
@@ -470,6 +464,10 @@ class ObjectPropsPacketClient:
             obj.checkpoint = self.data['checkpoint']
             obj.groups = self.data['groups']
             obj.trigger = self.data['trigger']
+            obj.trigger_after_tick = self.data['trigger_after_tick']
+            obj.report_collisions = obj.trigger is not None and obj.trigger_after_tick
+            obj.sensor = self.data['sensor']
+            obj.one_way = self.data['one_way']
 
 class NewConstraintPacketClient:
     type = networking.PacketType.RELIABLE
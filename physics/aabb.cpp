@@ -3,7 +3,7 @@
 #include <algorithm>
 #include <functional>
 
-Node::~Node() {}
+Proxy::~Proxy() {}
 
 AABB AABB::mkUnion(const AABB &other) const {
     Vec2 high(std::max(upper.x, other.upper.x),
@@ -19,6 +19,10 @@ AABB AABB::expand(float_type radius) const {
     return AABB(high, low);
 }
 
+float_type AABB::perimeter() const {
+    return 2 * ((upper.x - lower.x) + (upper.y - lower.y));
+}
+
 bool AABB::contains(const AABB &other) const {
     return upper.x >= other.upper.x && upper.y >= other.upper.y &&
            lower.x <= other.lower.x && lower.y <= other.lower.y;
@@ -29,181 +33,437 @@ bool AABB::intersect(const AABB &other) const {
            upper.y > other.lower.y && lower.y < other.upper.y;
 }
 
+bool AABB::intersectSegment(const Vec2 &from, const Vec2 &delta, float_type maxFraction) const {
+    float_type lowerT = 0, upperT = maxFraction;
+    for (int axis = 0; axis < 2; axis++) {
+        if (delta[axis] == 0) {
+            if (from[axis] < lower[axis] || from[axis] > upper[axis]) return false;
+            continue;
+        }
+        float_type t0 = (lower[axis] - from[axis]) / delta[axis];
+        float_type t1 = (upper[axis] - from[axis]) / delta[axis];
+        if (t0 > t1) std::swap(t0, t1);
+        lowerT = std::max(lowerT, t0);
+        upperT = std::min(upperT, t1);
+        if (lowerT > upperT) return false;
+    }
+    return true;
+}
+
 std::ostream& operator<<(std::ostream & Str, const AABB& v) {
    return Str << v.lower << "-" << v.upper;
 }
 
-void Node::updateAABB(const float_type margin) {
-    if (isLeaf()) {
-        outer = inner.expand(margin);
-    } else {
-        outer = children[0]->outer.mkUnion(children[1]->outer);
+void Proxy::touch() {
+    if (tree != nullptr && !touched) {
+        touched = true;
+        tree->touchedProxies.push_back(this);
     }
 }
 
-Node* Node::getSibling() {
-    return parent->children[0] == this ? parent->children[1]
-                                       : parent->children[0];
+AABB Proxy::fatten(const float_type margin) const {
+    return inner.expand(margin);
 }
 
-Node* AABBTree::add(const AABB &aabb) {
-    Node *node = new Node();
-    node->inner = aabb;
-    addNode(node);
+int AABBTree::allocateNode() {
+    int node;
+    if (freeList == NULL_NODE) {
+        node = nodes.size();
+        nodes.emplace_back();
+        innerBounds.emplace_back();
+    } else {
+        node = freeList;
+        freeList = nodes[node].parent;
+    }
+
+    nodes[node].proxy = nullptr;
+    nodes[node].parent = NULL_NODE;
+    nodes[node].children[0] = NULL_NODE;
+    nodes[node].children[1] = NULL_NODE;
+    nodes[node].height = 0;
+    nodeCount++;
     return node;
 }
 
-void AABBTree::addNode(Node *node) {
-    node->updateAABB(margin);
-    if (root == nullptr) {
-        root = node;
-    } else {
-        insertNode(root, node);
+void AABBTree::freeNode(int node) {
+    nodes[node].proxy = nullptr;
+    nodes[node].parent = freeList;
+    nodes[node].height = -1;
+    freeList = node;
+    nodeCount--;
+}
+
+void AABBTree::addProxy(Proxy *proxy) {
+    const int leaf = allocateNode();
+    nodes[leaf].proxy = proxy;
+    nodes[leaf].aabb = proxy->fatten(margin);
+    innerBounds[leaf] = proxy->inner;
+    proxy->tree = this;
+    proxy->id = leaf;
+    proxy->staticTree = proxy->isStatic();
+
+    insertLeaf(leaf);
+    markMoved(proxy);
+}
+
+void AABBTree::removeProxy(Proxy *proxy) {
+    // No end events, the other side may not outlive the removal
+    while (!proxy->partners.empty()) {
+        removeCachedPair(proxy->partners.back().second);
+    }
+
+    if (proxy->moved) {
+        moveBuffer.erase(std::remove(moveBuffer.begin(), moveBuffer.end(), proxy), moveBuffer.end());
+        proxy->moved = false;
+    }
+    if (proxy->touched) {
+        touchedProxies.erase(std::remove(touchedProxies.begin(), touchedProxies.end(), proxy), touchedProxies.end());
+        proxy->touched = false;
     }
+    if (proxy->changed) {
+        changedProxies.erase(std::remove(changedProxies.begin(), changedProxies.end(), proxy), changedProxies.end());
+        proxy->changed = false;
+    }
+
+    removeLeaf(proxy->id);
+    freeNode(proxy->id);
+    proxy->tree = nullptr;
+    proxy->id = NULL_NODE;
 }
 
-void AABBTree::insertNode(Node *node, Node *newNode) {
-    if (node->isLeaf()) {
-        Node *newParent = new Node();
+void AABBTree::insertLeaf(int leaf) {
+    int &root = roots[nodes[leaf].proxy->staticTree];
+    if (root == NULL_NODE) {
+        root = leaf;
+        nodes[root].parent = NULL_NODE;
+        return;
+    }
+
+    // Walk down towards the sibling that grows the total perimeter of the tree the least
+    const AABB leafAABB = nodes[leaf].aabb;
+    int index = root;
+    while (!nodes[index].isLeaf()) {
+        const TreeNode &node = nodes[index];
+        const float_type perimeter = node.aabb.perimeter();
+        const float_type combinedPerimeter = node.aabb.mkUnion(leafAABB).perimeter();
 
-        if (node == root) {
-            root = newParent;
-        } else {
-            (node->parent->children[0] == node ? 
-            node->parent->children[0] : node->parent->children[1]) = newParent;
+        // Pairing the leaf with this node creates a new parent covering both
+        const float_type cost = 2 * combinedPerimeter;
+        // Descending further grows this node regardless of where the leaf ends up
+        const float_type inheritanceCost = 2 * (combinedPerimeter - perimeter);
+
+        float_type childCosts[2];
+        for (int i = 0; i < 2; i++) {
+            const TreeNode &child = nodes[node.children[i]];
+            const float_type grownPerimeter = child.aabb.mkUnion(leafAABB).perimeter();
+            if (child.isLeaf()) {
+                childCosts[i] = grownPerimeter + inheritanceCost;
+            } else {
+                childCosts[i] = grownPerimeter - child.aabb.perimeter() + inheritanceCost;
+            }
         }
 
-        newParent->parent = node->parent;
-        newNode->parent = node->parent = newParent;
+        if (cost < childCosts[0] && cost < childCosts[1]) break;
+        index = childCosts[0] < childCosts[1] ? node.children[0] : node.children[1];
+    }
+
+    const int sibling = index;
+    const int oldParent = nodes[sibling].parent;
+    const int newParent = allocateNode();  // May reallocate the pool
 
-        newParent->children[0] = node;
-        newParent->children[1] = newNode;
+    nodes[newParent].parent = oldParent;
+    nodes[newParent].aabb = leafAABB.mkUnion(nodes[sibling].aabb);
+    nodes[newParent].height = nodes[sibling].height + 1;
+    nodes[newParent].children[0] = sibling;
+    nodes[newParent].children[1] = leaf;
+    nodes[sibling].parent = newParent;
+    nodes[leaf].parent = newParent;
 
-        newParent->updateAABB(margin);
+    if (oldParent == NULL_NODE) {
+        replaceRoot(sibling, newParent);
     } else {
-        const AABB aabb0 = node->children[0]->outer;
-        const AABB aabb1 = node->children[1]->outer;
+        int *children = nodes[oldParent].children;
+        (children[0] == sibling ? children[0] : children[1]) = newParent;
+    }
 
-        const float_type areaDiff0 =
-            aabb0.mkUnion(newNode->outer).area() - aabb0.area();
-        const float_type areaDiff1 =
-            aabb1.mkUnion(newNode->outer).area() - aabb1.area();
+    refit(newParent);
+}
 
-        if (areaDiff0 < areaDiff1) {
-            insertNode(node->children[0], newNode);
-        } else {
-            insertNode(node->children[1], newNode);
-        }
+void AABBTree::removeLeaf(int leaf) {
+    if (nodes[leaf].parent == NULL_NODE) {
+        replaceRoot(leaf, NULL_NODE);
+        return;
+    }
+
+    const int parent = nodes[leaf].parent;
+    const int grandParent = nodes[parent].parent;
+    const int sibling = nodes[parent].children[0] == leaf ? nodes[parent].children[1]
+                                                          : nodes[parent].children[0];
 
-        node->updateAABB(margin);
+    nodes[sibling].parent = grandParent;
+    if (grandParent == NULL_NODE) {
+        replaceRoot(parent, sibling);
+    } else {
+        int *children = nodes[grandParent].children;
+        (children[0] == parent ? children[0] : children[1]) = sibling;
     }
+    freeNode(parent);
+
+    refit(grandParent);
 }
 
-void AABBTree::removeNode(Node *node) {
-    // Node must be leaf
-    if (node == root) {
-        root = nullptr;
-    } else {
-        Node *parent = node->parent;
-        Node *sibling = node->getSibling();
+// Rebalances and recomputes the bounds of every node from here up to the root
+void AABBTree::refit(int index) {
+    while (index != NULL_NODE) {
+        index = balance(index);
 
-        if (parent == root) {
-            root = sibling;
-            sibling->parent = nullptr;
-        } else {
-            sibling->parent = parent->parent;
+        TreeNode &node = nodes[index];
+        const TreeNode &child0 = nodes[node.children[0]];
+        const TreeNode &child1 = nodes[node.children[1]];
+        node.height = 1 + std::max(child0.height, child1.height);
+        node.aabb = child0.aabb.mkUnion(child1.aabb);
 
-            (parent->parent->children[0] == parent
-                 ? parent->parent->children[0]
-                 : parent->parent->children[1]) = sibling;
-            delete parent;
-        }
+        index = node.parent;
     }
 }
 
-void AABBTree::findInvalid(Node *node) {
-    if (node->isLeaf()) {
-        if (!node->outer.contains(node->inner)) {
-            invalidNodes.push_back(node);
-        }
+// Rotates the taller grandchild of a up if its children differ in height by more than one.
+// Returns the node now in a's place.
+int AABBTree::balance(int a) {
+    TreeNode &nodeA = nodes[a];
+    if (nodeA.isLeaf() || nodeA.height < 2) return a;
+
+    const int b = nodeA.children[0];
+    const int c = nodeA.children[1];
+    const int heightDiff = nodes[c].height - nodes[b].height;
+    if (heightDiff >= -1 && heightDiff <= 1) return a;
+
+    // The taller child moves up into a's place, a takes the side of the shorter child
+    const int side = heightDiff > 1 ? 1 : 0;
+    const int up = nodeA.children[side];
+    const int other = nodeA.children[1 - side];
+    TreeNode &nodeUp = nodes[up];
+
+    const int f = nodeUp.children[0];
+    const int g = nodeUp.children[1];
+
+    nodeUp.children[0] = a;
+    nodeUp.parent = nodeA.parent;
+    nodeA.parent = up;
+
+    if (nodeUp.parent == NULL_NODE) {
+        replaceRoot(a, up);
     } else {
-        findInvalid(node->children[0]);
-        findInvalid(node->children[1]);
+        int *children = nodes[nodeUp.parent].children;
+        (children[0] == a ? children[0] : children[1]) = up;
     }
-}
 
-void AABBTree::update() {
-    if (root == nullptr) return;
+    // Keep the taller grandchild under up, hand the shorter one to a
+    const int keep = nodes[f].height > nodes[g].height ? f : g;
+    const int give = keep == f ? g : f;
 
-    if (root->isLeaf()) {
-        root->updateAABB(margin);
-    } else {
-        findInvalid(root);
-        for (Node *node : invalidNodes) {
-            removeNode(node);
-            addNode(node);
-        }
-        invalidNodes.clear();
+    nodeUp.children[1] = keep;
+    nodeA.children[side] = give;
+    nodes[give].parent = a;
+
+    nodeA.aabb = nodes[other].aabb.mkUnion(nodes[give].aabb);
+    nodeA.height = 1 + std::max(nodes[other].height, nodes[give].height);
+    nodeUp.aabb = nodeA.aabb.mkUnion(nodes[keep].aabb);
+    nodeUp.height = 1 + std::max(nodeA.height, nodes[keep].height);
+
+    return up;
+}
+
+void AABBTree::markMoved(Proxy *proxy) {
+    if (!proxy->moved) {
+        proxy->moved = true;
+        moveBuffer.push_back(proxy);
     }
 }
 
-void AABBTree::findPairsForLeaf(Node* leaf, Node* branch) {
-    // Finds all collisions from a given leaf onto a node which may be a leaf
-    if (branch->isLeaf()) {
-        if (branch->inner.intersect(leaf->inner)) {
-            pairs.emplace_back(leaf, branch);
-        }
-    } else {
-        if (branch->outer.intersect(leaf->inner)) {
-            findPairsForLeaf(leaf, branch->children[0]);
-            findPairsForLeaf(leaf, branch->children[1]);
+void AABBTree::setFatBounds(Proxy *proxy, const AABB &aabb) {
+    if (proxy->tree != this) return;
+    const int leaf = proxy->id;
+    AABB current = nodes[leaf].aabb;
+    if (current.lower == aabb.lower && current.upper == aabb.upper) return;
+
+    removeLeaf(leaf);
+    nodes[leaf].aabb = aabb;
+    insertLeaf(leaf);
+    markMoved(proxy);
+}
+
+void AABBTree::update() {
+    // Only touched proxies can have left their fat bounds, so untouched leaves (most of the
+    // static tree) are never visited
+    for (Proxy *proxy : touchedProxies) {
+        proxy->touched = false;
+        if (!proxy->changed) {
+            proxy->changed = true;
+            changedProxies.push_back(proxy);
         }
+
+        const int leaf = proxy->id;
+        const bool changeTree = proxy->isStatic() != proxy->staticTree;
+        if (!changeTree && nodes[leaf].aabb.contains(proxy->inner)) continue;
+
+        removeLeaf(leaf);
+        proxy->staticTree = proxy->isStatic();
+        nodes[leaf].aabb = proxy->fatten(margin);
+        insertLeaf(leaf);
+        markMoved(proxy);
     }
+    touchedProxies.clear();
 }
 
-void AABBTree::findPairs(Node* n0, Node* n1) {
-    // Finds all collisions across the two given nodes
-    if (n0->isLeaf()) {
-        if (n1->isLeaf()) {
-            if (n0->inner.intersect(n1->inner)) {
-                pairs.emplace_back(n0, n1);
-            }
+template <typename F>
+void AABBTree::query(int root, const AABB &aabb, F callback) {
+    if (root == NULL_NODE) return;
+
+    stack.clear();
+    stack.push_back(root);
+    while (!stack.empty()) {
+        const TreeNode &node = nodes[stack.back()];
+        stack.pop_back();
+
+        if (!node.aabb.intersect(aabb)) continue;
+        if (node.isLeaf()) {
+            callback(node.proxy);
         } else {
-            if (n0->inner.intersect(n1->outer)) {
-                findPairsForLeaf(n0, n1->children[0]);
-                findPairsForLeaf(n0, n1->children[1]);
-            }
+            stack.push_back(node.children[1]);
+            stack.push_back(node.children[0]);
         }
-    } else {
-        if (n1->isLeaf()) {
-            if (n0->outer.intersect(n1->inner)) {
-                findPairsForLeaf(n1, n0->children[0]);
-                findPairsForLeaf(n1, n0->children[1]);
-            }
-        } else {
-            if (n0->outer.intersect(n1->outer)) {
-                findPairs(n0->children[0], n1->children[0]);
-                findPairs(n0->children[0], n1->children[1]);
-                findPairs(n0->children[1], n1->children[0]);
-                findPairs(n0->children[1], n1->children[1]);
-            }
+    }
+}
+
+void AABBTree::queryBounds(const AABB &aabb, std::vector<Proxy*> &out) {
+    for (bool staticTree : {false, true}) {
+        query(roots[staticTree], aabb, [&out](Proxy *proxy) { out.push_back(proxy); });
+    }
+}
+
+void AABBTree::addCachedPair(Proxy *a, Proxy *b) {
+    const uint64_t key = pairKey(a, b);
+    if (pairIndices.count(key) != 0) return;
+
+    const size_t index = cachedPairs.size();
+    pairIndices[key] = index;
+    cachedPairs.push_back({ProxyPair(a, b), {a->id, b->id}, NO_SLOT});
+    a->partners.emplace_back(b, index);
+    b->partners.emplace_back(a, index);
+    beginPairs.emplace_back(a, b);
+    updateOverlap(index);
+}
+
+void AABBTree::setPartnerSlot(Proxy *proxy, size_t from, size_t to) {
+    for (auto &partner : proxy->partners) {
+        if (partner.second == from) {
+            partner.second = to;
+            return;
         }
     }
 }
 
-void AABBTree::findAllPairs(Node* node) {
-    if (!node->isLeaf()) {
-        findPairs(node->children[0], node->children[1]);
+void AABBTree::removeCachedPair(size_t index) {
+    const ProxyPair pair = cachedPairs[index].pair;
+    pairIndices.erase(pairKey(pair.first, pair.second));
+    if (cachedPairs[index].overlapping != NO_SLOT) removeOverlap(index);
+
+    for (Proxy *proxy : {pair.first, pair.second}) {
+        auto &partners = proxy->partners;
+        auto found = std::find_if(partners.begin(), partners.end(),
+                                  [index](const std::pair<Proxy*, size_t> &partner) { return partner.second == index; });
+        *found = partners.back();
+        partners.pop_back();
+    }
+
+    // Swap removes to keep the pairs packed, the last pair moves into the slot
+    const size_t last = cachedPairs.size() - 1;
+    if (index != last) {
+        const CachedPair &moved = cachedPairs[last];
+        pairIndices[pairKey(moved.pair.first, moved.pair.second)] = index;
+        setPartnerSlot(moved.pair.first, last, index);
+        setPartnerSlot(moved.pair.second, last, index);
+        if (moved.overlapping != NO_SLOT) pairSources[moved.overlapping] = index;
+        cachedPairs[index] = moved;
+    }
+    cachedPairs.pop_back();
+}
+
+void AABBTree::updateOverlap(size_t index) {
+    CachedPair &cached = cachedPairs[index];
+    const bool overlapping = innerBounds[cached.leaves[0]].intersect(innerBounds[cached.leaves[1]]);
+    if (overlapping == (cached.overlapping != NO_SLOT)) return;
 
-        findAllPairs(node->children[0]);
-        findAllPairs(node->children[1]);
+    if (overlapping) {
+        cached.overlapping = pairs.size();
+        pairs.push_back(cached.pair);
+        pairSources.push_back(index);
+    } else {
+        removeOverlap(index);
     }
 }
 
-const std::vector<std::pair<Node *, Node *>>& AABBTree::computePairs() {
-    pairs.clear();
+void AABBTree::removeOverlap(size_t index) {
+    // Swap removes, the last overlapping pair takes over the slot
+    const size_t slot = cachedPairs[index].overlapping;
+    pairs[slot] = pairs.back();
+    pairSources[slot] = pairSources.back();
+    cachedPairs[pairSources[slot]].overlapping = slot;
+    pairs.pop_back();
+    pairSources.pop_back();
+    cachedPairs[index].overlapping = NO_SLOT;
+}
+
+const std::vector<ProxyPair>& AABBTree::computePairs() {
+    beginPairs.clear();
+    endPairs.clear();
+    // Pairs are checked against these copies, which keeps the checks within one array
+    size_t changedPairs = 0;
+    for (Proxy *proxy : changedProxies) {
+        proxy->changed = false;
+        innerBounds[proxy->id] = proxy->inner;
+        changedPairs += proxy->partners.size();
+    }
+
+    // Fat bounds only change when a leaf is reinserted, so only pairs with a moved leaf can end
+    // (including pairs left between two static leaves by a leaf changing tree). Removing a pair
+    // swaps the last partner into its place, so the partners are walked from the back
+    for (Proxy *proxy : moveBuffer) {
+        for (size_t i = proxy->partners.size(); i-- > 0;) {
+            Proxy *other = proxy->partners[i].first;
+            const size_t index = proxy->partners[i].second;
+            if (!nodes[proxy->id].aabb.intersect(nodes[other->id].aabb) ||
+                (proxy->staticTree && other->staticTree)) {
+                endPairs.push_back(cachedPairs[index].pair);
+                removeCachedPair(index);
+            }
+        }
+    }
+
+    // Everything is queried against the dynamic tree, only dynamic leaves against the static one
+    for (Proxy *proxy : moveBuffer) {
+        const AABB aabb = nodes[proxy->id].aabb;
+        auto addPair = [this, proxy](Proxy *other) {
+            if (other != proxy) addCachedPair(proxy, other);
+        };
+        query(roots[false], aabb, addPair);
+        if (!proxy->staticTree) query(roots[true], aabb, addPair);
+    }
+    for (Proxy *proxy : moveBuffer) proxy->moved = false;
+    moveBuffer.clear();
+
+    // New pairs were checked as they were added, the rest can only have changed with a leaf's
+    // inner bounds. When most leaves changed, going through the packed pairs in order is
+    // quicker than following each leaf's partners
+    if (changedPairs < cachedPairs.size()) {
+        for (Proxy *proxy : changedProxies) {
+            for (const auto &partner : proxy->partners) updateOverlap(partner.second);
+        }
+    } else {
+        for (size_t index = 0; index < cachedPairs.size(); index++) updateOverlap(index);
+    }
+    changedProxies.clear();
 
-    if (root == nullptr) return pairs;
-    findAllPairs(root);
     return pairs;
 }
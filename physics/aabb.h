@@ -1,6 +1,10 @@
 #pragma once
 
+#include <algorithm>
 #include <cmath>
+#include <cstdint>
+#include <functional>
+#include <unordered_map>
 #include <vector>
 #include <memory>
 
@@ -18,78 +22,187 @@ struct AABB {
    AABB mkUnion(const AABB& other) const;
    AABB expand(float_type radius) const;
    float_type area() const { return (upper.x - lower.x) * (upper.y - lower.y); }
+   float_type perimeter() const;
    bool contains(const AABB& other) const;
    bool intersect(const AABB& other) const;
+   // Whether the segment from + t * delta, 0 <= t <= maxFraction, touches the box
+   bool intersectSegment(const Vec2& from, const Vec2& delta, float_type maxFraction) const;
 };
 
 std::ostream& operator<<(std::ostream & Str, const AABB& v);
 
-class Node {
+const int NULL_NODE = -1;
+
+// Something stored in the tree, the tree keeps a fattened copy of its bounds
+class Proxy {
    friend AABBTree;
 
    public:
-      Node() : parent(nullptr), children{nullptr, nullptr} {};
-      virtual ~Node();
-      
-      Node* getParent() { return parent; }
-      Node** getChildren() { return children; }
+      Proxy() : tree(nullptr), id(NULL_NODE) {};
+      virtual ~Proxy();
 
       AABB getInner() const { return inner; }
-      AABB getOuter() const { return outer; }
+      int getId() const { return id; }
+
+      // Static proxies are kept in a separate tree and never paired with each other
+      virtual bool isStatic() const { return false; }
 
-      bool isLeaf() const { return children[0] == nullptr; }
-   
    protected:
       AABB inner;
-      AABB outer;
+
+      void setInner(const AABB &aabb) { inner = aabb; touch(); }
+      // Has the tree check the proxy's bounds and isStatic on its next update
+      void touch();
 
       // Only to be called by AABBTree
-      virtual void updateAABB(const float_type margin);
+      virtual AABB fatten(const float_type margin) const;
 
    private:
-      Node *parent;
-      Node *children[2];
+      AABBTree *tree;
+      int id;  // Index of the leaf in the tree
+      bool staticTree = false;  // Which of the two trees the leaf is in
+      bool touched = false;
+      bool moved = false;  // Needs its pairs refreshed on the next computePairs
+      bool changed = false;  // Inner bounds changed since the last computePairs
+      std::vector<std::pair<Proxy*, size_t>> partners;  // The other leaf and slot of each of its cached pairs
+
+      Proxy(const Proxy&) = delete;
+      Proxy& operator=(const Proxy&) = delete;
+      Proxy(Proxy&&) = delete;
+      Proxy& operator=(Proxy&&) = delete;
+};
 
-      Node(const Node&) = delete;
-      Node& operator=(const Node&) = delete;
-      Node(Node&&) = delete;
-      Node& operator=(Node&&) = delete;
+struct TreeNode {
+   AABB aabb;
+   Proxy *proxy;  // Only set for leaves
+   int parent;  // Next free node while on the free list
+   int children[2];
+   int height;  // 0 for leaves, -1 while free
 
-      Node* getSibling();
+   bool isLeaf() const { return children[0] == NULL_NODE; }
 };
 
+typedef std::pair<Proxy*, Proxy*> ProxyPair;
+
 class AABBTree {
-   private:
-      std::vector<Node*> invalidNodes;
-      std::vector<std::pair<Node*,Node*>> pairs;
+   friend Proxy;
 
-      Node *root;
+   private:
+      // Nodes live in one pool and refer to each other by index, freed nodes are reused
+      std::vector<TreeNode> nodes;
+      std::vector<AABB> innerBounds;  // Each leaf's inner bounds as of the last computePairs, indexed like nodes
+      int roots[2];  // Dynamic and static tree, indexed by Proxy::staticTree
+      int freeList;
+      size_t nodeCount;
+
+      std::vector<Proxy*> touchedProxies;
+      std::vector<int> stack;
+      std::vector<Proxy*> moveBuffer;  // Leaves inserted or reinserted since the last computePairs
+      std::vector<Proxy*> changedProxies;  // Leaves touched since then
+
+      static constexpr size_t NO_SLOT = SIZE_MAX;
+
+      // A pair of leaves with overlapping fat bounds, kept between updates
+      struct CachedPair {
+         ProxyPair pair;
+         int leaves[2];
+         size_t overlapping;  // Index in pairs while the inner bounds overlap, NO_SLOT otherwise
+      };
+      std::vector<CachedPair> cachedPairs;
+      std::unordered_map<uint64_t, size_t> pairIndices;  // Slot of each cached pair by its leaves
+
+      std::vector<ProxyPair> beginPairs, endPairs;
+      std::vector<ProxyPair> pairs;  // The cached pairs whose inner bounds overlap, in no set order
+      std::vector<size_t> pairSources;  // Slot in cachedPairs of each of pairs
 
       AABBTree(const AABBTree&) = delete;
       AABBTree& operator=(const AABBTree&) = delete;
       AABBTree(AABBTree&&) = delete;
       AABBTree& operator=(AABBTree&&) = delete;
 
-      void insertNode(Node*, Node*);
-      void findInvalid(Node*);
-      void findPairs(Node*, Node*);
-      void findAllPairs(Node*);
-      void findPairsForLeaf(Node* leaf, Node* branch);
+      int allocateNode();
+      void freeNode(int node);
+
+      void insertLeaf(int leaf);
+      void removeLeaf(int leaf);
+      void replaceRoot(int oldRoot, int newRoot) { (roots[0] == oldRoot ? roots[0] : roots[1]) = newRoot; }
+      int balance(int node);
+      void refit(int node);
+      void markMoved(Proxy *proxy);
+
+      static uint64_t pairKey(const Proxy *a, const Proxy *b) {
+         const uint64_t low = std::min(a->id, b->id);
+         const uint64_t high = std::max(a->id, b->id);
+         return (high << 32) | low;
+      }
+      void addCachedPair(Proxy *a, Proxy *b);
+      void removeCachedPair(size_t index);
+      void updateOverlap(size_t index);
+      void removeOverlap(size_t index);
+      static void setPartnerSlot(Proxy *proxy, size_t from, size_t to);
+
+      template <typename F>
+      void query(int root, const AABB &aabb, F callback);
 
    public:
       const float_type margin;
 
-      AABBTree(float_type margin) : root(nullptr), margin(margin) {}
+      AABBTree(float_type margin) : roots{NULL_NODE, NULL_NODE}, freeList(NULL_NODE), nodeCount(0), margin(margin) {}
+
+      // Fat bounds kept for a proxy, setting them moves its leaf and has its pairs refreshed
+      AABB getFatBounds(const Proxy *proxy) const { return nodes[proxy->id].aabb; }
+      void setFatBounds(Proxy *proxy, const AABB &aabb);
 
-      Node* getRoot() { return root; }
+      int getRoot(bool staticTree) const { return roots[staticTree]; }
+      const TreeNode& getNode(int node) const { return nodes[node]; }
+      int getHeight(bool staticTree) const { return roots[staticTree] == NULL_NODE ? 0 : nodes[roots[staticTree]].height; }
+      size_t getNodeCount() const { return nodeCount; }
+      size_t getMemoryUsage() const { return nodes.capacity() * sizeof(TreeNode) + innerBounds.capacity() * sizeof(AABB); }
 
-      Node* add(const AABB& aabb);
-      void addNode(Node *node);
+      void addProxy(Proxy *proxy);
+      void removeProxy(Proxy *proxy);
 
-      //void remove(AABB aabb);
-      void removeNode(Node *node);
+      // Pairs of leaves with overlapping inner bounds. Only the pairs of leaves that moved or were
+      // touched since the last call are looked at, so the cost follows the awake proxies
+      const std::vector<ProxyPair>& computePairs();
 
-      const std::vector<std::pair<Node*,Node*>>& computePairs();
+      // Appends every proxy whose fat bounds overlap aabb, from both trees
+      void queryBounds(const AABB &aabb, std::vector<Proxy*> &out);
+      // Calls callback(proxy, maxFraction) for every proxy, from both trees, whose fat bounds the
+      // segment from -> to crosses within maxFraction of its length. maxFraction starts at 1 and the
+      // callback returns the new one, so a hit cuts the rest of the search short
+      template <typename F>
+      void raycast(const Vec2 &from, const Vec2 &to, F callback);
+
+      // Pairs that started/stopped overlapping (fat bounds) during the last computePairs
+      const std::vector<ProxyPair>& getBeginPairs() const { return beginPairs; }
+      const std::vector<ProxyPair>& getEndPairs() const { return endPairs; }
+      // Pairs of leaves with overlapping fat bounds as of the last computePairs
+      size_t getCachedPairCount() const { return cachedPairs.size(); }
 
       void update();
-};
\ No newline at end of file
+};
+
+template <typename F>
+void AABBTree::raycast(const Vec2 &from, const Vec2 &to, F callback) {
+   const Vec2 delta = to - from;
+   float_type maxFraction = 1;
+   for (bool staticTree : {false, true}) {
+      if (roots[staticTree] == NULL_NODE) continue;
+
+      stack.clear();
+      stack.push_back(roots[staticTree]);
+      while (!stack.empty()) {
+         const TreeNode &node = nodes[stack.back()];
+         stack.pop_back();
+
+         if (!node.aabb.intersectSegment(from, delta, maxFraction)) continue;
+         if (node.isLeaf()) {
+            maxFraction = callback(node.proxy, maxFraction);
+         } else {
+            stack.push_back(node.children[1]);
+            stack.push_back(node.children[0]);
+         }
+      }
+   }
+}
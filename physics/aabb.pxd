@@ -3,9 +3,11 @@ from libcpp.utility cimport pair
 from libcpp cimport bool
 from vector cimport Vec2, float_type
 
-ctypedef Node* nodeP
+ctypedef Proxy* proxyP
 
 cdef extern from "aabb.h":
+   const int NULL_NODE
+
    cdef struct AABB:
       Vec2 upper
       Vec2 lower
@@ -19,25 +21,33 @@ cdef extern from "aabb.h":
       bool contains(const AABB other)
       bool intersect(const AABB other)
 
-   cdef cppclass Node:
-      Node()
-
-      void updateAABB(float_type)
-
+   cdef cppclass Proxy:
       AABB getInner()
-      AABB getOuter()
+      int getId()
+      bool isStatic()
+
+   cdef struct TreeNode:
+      AABB aabb
+      Proxy *proxy
+      int parent
+      int children[2]
+      int height
 
       bool isLeaf()
-      Node* getParent()
-      Node** getChildren()
-      Node* getSibling()
    
    cdef cppclass AABBTree:
       const float_type margin
 
       AABBTree(float_type)
 
-      nodeP getRoot()
+      int getRoot(bool)
+      const TreeNode& getNode(int)
+      int getHeight(bool)
+      size_t getNodeCount()
+      size_t getMemoryUsage()
 
-      vector[pair[nodeP,nodeP]] computePairs()
+      vector[pair[proxyP,proxyP]] computePairs()
+      vector[pair[proxyP,proxyP]] getBeginPairs()
+      vector[pair[proxyP,proxyP]] getEndPairs()
+      size_t getCachedPairCount()
       void update()
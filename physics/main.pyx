@@ -8,11 +8,12 @@ from morelibcpp cimport remove
 cimport libcpp.iterator
 from cpython.ref cimport PyObject
 
-cimport objects, aabb
+cimport objects, aabb, treebench
 cimport physics as cPhysics
 from vector cimport Vec2, Vec3, float_type
 
-import copy, sys
+import copy, os, sys
+import numpy as np
 
 cdef class CustomList:
    cdef _list
@@ -196,6 +197,42 @@ cdef class FixedConstraint:
    cdef objects.BaseConstraint* generate(self, objects.Object *obj_a, objects.Object *obj_b):
       return new objects.FixedConstraint(obj_a, obj_b, convert_to_vec2(self.local_a), convert_to_vec2(self.local_b))
    
+cdef class VelocityConstraint(BaseConstraint):
+   # Pushes the anchors apart or together along normal (world space) until the velocity of b
+   # relative to a along it reaches target_velocity, without going over max_impulse
+   cdef normal
+   cdef local_a
+   cdef local_b
+   cdef target_velocity
+   cdef max_impulse
+
+   def __init__(self, normal, local_a, local_b, target_velocity, max_impulse=float('inf')):
+      self.normal = normal
+      self.local_a = local_a
+      self.local_b = local_b
+      self.target_velocity = target_velocity
+      self.max_impulse = max_impulse
+
+   @property
+   def normal(self):
+      return self.normal
+   @property
+   def local_a(self):
+      return self.local_a
+   @property
+   def local_b(self):
+      return self.local_b
+   @property
+   def target_velocity(self):
+      return self.target_velocity
+   @property
+   def max_impulse(self):
+      return self.max_impulse
+
+   cdef objects.BaseConstraint* generate(self, objects.Object *obj_a, objects.Object *obj_b):
+      return new objects.VelocityConstraint(obj_a, obj_b, convert_to_vec2(self.local_a), convert_to_vec2(self.local_b),
+                                            convert_to_vec2(self.normal), self.target_velocity, self.max_impulse)
+
 cdef class SliderConstraint:
    cdef local_a
    cdef local_b
@@ -248,12 +285,14 @@ cdef class ColliderList(CustomList):
       pair.second = collider
       self.collider_map.insert(pair)
       (<Object>self.obj).thisptr.updateBounds()
+      (<Object>self.obj).thisptr.wake()
    
    def _remove(self, col):
       cdef collider_pointer collider = self.collider_map[<PyObject*>col]
       self.collider_map.erase(<PyObject*>col)
       cdef obj_pointer obj = (<Object>self.obj).thisptr
       obj.colliders.erase(remove(obj.colliders.begin(), obj.colliders.end(), collider), obj.colliders.end())
+      obj.wake()
       del collider
    
    def _clear(self):
@@ -344,7 +383,10 @@ cdef class Object:
    def __getstate__(self):
       state = {'colliders': self.colliders, 'constraints': self.constraints,
                'mass': self.mass, 'moment': self.moment, 'restitution': self.restitution, 'friction': self.friction,
-               'pos': self.pos, 'vel': self.vel, 'rot': self.rot, 'rot_vel': self.rot_vel}
+               'pos': self.pos, 'vel': self.vel, 'rot': self.rot, 'rot_vel': self.rot_vel,
+               'sensor': self.sensor, 'one_way': self.one_way, 'report_collisions': self.report_collisions,
+               'lethal': self.lethal, 'is_checkpoint': self.is_checkpoint, 'sync_id': self.sync_id,
+               'bullet': self.bullet}
       if hasattr(self, '__dict__'):
          state.update(self.__dict__)
       return state
@@ -354,6 +396,13 @@ cdef class Object:
       self.vel = state['vel']
       self.rot = state['rot']
       self.rot_vel = state['rot_vel']
+      self.sensor = state['sensor']
+      self.one_way = state['one_way']
+      self.report_collisions = state['report_collisions']
+      self.lethal = state['lethal']
+      self.is_checkpoint = state['is_checkpoint']
+      self.sync_id = state['sync_id']
+      self.bullet = state['bullet']
 
       colliders = state['colliders']
       constraints = state['constraints']
@@ -362,7 +411,8 @@ cdef class Object:
       restitution = state['restitution']
       friction = state['friction']
 
-      for key in ('colliders', 'pos', 'vel', 'rot', 'rot_vel', 'mass', 'moment','restitution', 'friction'):
+      for key in ('colliders', 'pos', 'vel', 'rot', 'rot_vel', 'sensor', 'one_way', 'report_collisions', 'lethal', 'is_checkpoint',
+                  'sync_id', 'bullet', 'mass', 'moment','restitution', 'friction'):
          del state[key]
       
       if hasattr(self, '__dict__'):
@@ -412,13 +462,87 @@ cdef class Object:
    def inv_moment(self):
       return self.thisptr.getInvMoment()
 
+   # Declarative alternatives to a collide method: a sensor never gets contact constraints, objects
+   # moving along one_way relative to this one pass through it (0, 0 for none), and collisions of
+   # reporting objects are collected by PyWorld.pop_collision_events
+
+   @property
+   def sensor(self):
+      return self.thisptr.sensor
+   @sensor.setter
+   def sensor(self, bool val):
+      self.thisptr.sensor = val
+
+   @property
+   def one_way(self):
+      cdef Vec2 one_way = self.thisptr.oneWay
+      return one_way.x, one_way.y
+   @one_way.setter
+   def one_way(self, one_way):
+      self.thisptr.oneWay = convert_to_vec2(one_way)
+
+   @property
+   def report_collisions(self):
+      return self.thisptr.reportCollisions
+   @report_collisions.setter
+   def report_collisions(self, bool val):
+      self.thisptr.reportCollisions = val
+
+   # What a ControlledObject touching this object should make of it
+
+   @property
+   def lethal(self):
+      return self.thisptr.lethal
+   @lethal.setter
+   def lethal(self, bool val):
+      self.thisptr.lethal = val
+
+   @property
+   def is_checkpoint(self):
+      return self.thisptr.isCheckpoint
+   @is_checkpoint.setter
+   def is_checkpoint(self, bool val):
+      self.thisptr.isCheckpoint = val
+
+   @property
+   def bullet(self):
+      # Fast objects are always kept from passing through static ones, bullets are kept from passing
+      # through anything
+      return self.thisptr.bullet
+   @bullet.setter
+   def bullet(self, bool val):
+      self.thisptr.bullet = val
+
+   @property
+   def sync_id(self):
+      # Where the object goes in a deterministic world's step order, None until it is set or
+      # the object is added to a world
+      if self.thisptr.syncId == objects.noSyncId:
+         return None
+      return self.thisptr.syncId
+   @sync_id.setter
+   def sync_id(self, val):
+      self.thisptr.syncId = objects.noSyncId if val is None else val
+
+   @property
+   def sleeping(self):
+      return self.thisptr.sleeping
+
+   def wake(self):
+      self.thisptr.wake()
+
+   # Setting state only wakes the object (and its island) if the value actually changes
+
    @property
    def pos(self):
       cdef Vec2 pos = self.thisptr.pos
       return pos.x, pos.y
    @pos.setter
    def pos(self, pos):
-      self.thisptr.pos = convert_to_vec2(pos)
+      cdef Vec2 vec = convert_to_vec2(pos)
+      if vec.x != self.thisptr.pos.x or vec.y != self.thisptr.pos.y:
+         self.thisptr.wake()
+      self.thisptr.pos = vec
       self.thisptr.updateBounds()
    
    @property
@@ -427,13 +551,18 @@ cdef class Object:
       return vel.x, vel.y
    @vel.setter
    def vel(self,vel):
-      self.thisptr.vel = convert_to_vec2(vel)
+      cdef Vec2 vec = convert_to_vec2(vel)
+      if vec.x != self.thisptr.vel.x or vec.y != self.thisptr.vel.y:
+         self.thisptr.wake()
+      self.thisptr.vel = vec
    
    @property
    def rot(self):
       return self.thisptr.rot
    @rot.setter
-   def rot(self, rot):
+   def rot(self, float_type rot):
+      if rot != self.thisptr.rot:
+         self.thisptr.wake()
       self.thisptr.rot = rot
       self.thisptr.updateRotMat()
       self.thisptr.updateBounds()
@@ -442,7 +571,9 @@ cdef class Object:
    def rot_vel(self):
       return self.thisptr.rotV
    @rot_vel.setter
-   def rot_vel(self,rot_vel):
+   def rot_vel(self, float_type rot_vel):
+      if rot_vel != self.thisptr.rotV:
+         self.thisptr.wake()
       self.thisptr.rotV = rot_vel
    
    @property
@@ -462,6 +593,53 @@ cdef class Object:
    def global_to_local_vec(self, vec):
       return convert_from_vec2(self.thisptr.globalToLocalVec(convert_to_vec2(vec)))
 
+cdef class ControlledObject(Object):
+   # Rolls and jumps according to action inside PyWorld.update. Once it dies it shows up in
+   # PyWorld.pop_deaths and ignores its action until revive is called
+   def __cinit__(self, *args, **kwargs):
+      self.thisptr.controller.reset(new objects.Controller())
+
+   def __getstate__(self):
+      state = super().__getstate__()
+      state['action'] = self.action
+      state['checkpoint'] = self.checkpoint
+      return state
+
+   def __setstate__(self, state):
+      action = state.pop('action')
+      checkpoint = state.pop('checkpoint')
+      super().__setstate__(state)
+      self.action = action
+      self.checkpoint = checkpoint
+
+   @property
+   def action(self):
+      return convert_from_vec2(self.thisptr.controller.get().action)
+   @action.setter
+   def action(self, action):
+      self.thisptr.controller.get().action = convert_to_vec2(action)
+
+   @property
+   def alive(self):
+      return self.thisptr.controller.get().state == objects.Alive
+
+   @property
+   def checkpoint(self):
+      # Last object touched with is_checkpoint set, forgotten when that object leaves the world
+      cdef obj_pointer c_checkpoint = self.thisptr.controller.get().checkpoint
+      if c_checkpoint == NULL or object_map.count(c_checkpoint) == 0:
+         return None
+      return <object>object_map[c_checkpoint]
+   @checkpoint.setter
+   def checkpoint(self, checkpoint):
+      if checkpoint is None:
+         self.thisptr.controller.get().checkpoint = NULL
+      else:
+         self.thisptr.controller.get().checkpoint = (<Object?>checkpoint).thisptr
+
+   def revive(self):
+      self.thisptr.controller.get().revive()
+
 class ContactPoint:
    def __init__(self, *args):
       self.local_a,self.local_b,self.global_a,self.global_b,self.normal,self.penetration,self.normal_impulse_sum,self.tangent_impulse_sum = args
@@ -478,19 +656,26 @@ class ContactConstraint:
 
 
 cdef class Node:
-   cdef aabb.Node *ptr
-   cdef cPhysics.World *world
+   cdef aabb.AABBTree *tree
+   cdef int index
 
    @property
    def children(self):
-      return create_node(self.world, self.ptr.getChildren()[0]), create_node(self.world, self.ptr.getChildren()[1])
+      cdef const aabb.TreeNode *node = &self.tree.getNode(self.index)
+      return create_node(self.tree, node.children[0]), create_node(self.tree, node.children[1])
 
    @property
    def bounds(self):
-      return convert_from_vec2(self.ptr.getOuter().lower), convert_from_vec2(self.ptr.getOuter().upper)
+      cdef aabb.AABB bounds = self.tree.getNode(self.index).aabb
+      return convert_from_vec2(bounds.lower), convert_from_vec2(bounds.upper)
+
+   @property
+   def height(self):
+      return self.tree.getNode(self.index).height
 
 cdef class LeafNode:
-   cdef aabb.Node *ptr
+   cdef aabb.AABBTree *tree
+   cdef int index
    cdef obj
 
    @property
@@ -499,22 +684,30 @@ cdef class LeafNode:
 
    @property
    def inner_bounds(self):
-      return convert_from_vec2(self.ptr.getInner().lower), convert_from_vec2(self.ptr.getInner().upper)
+      cdef aabb.AABB bounds = self.tree.getNode(self.index).proxy.getInner()
+      return convert_from_vec2(bounds.lower), convert_from_vec2(bounds.upper)
    
    @property
    def bounds(self):
-      return convert_from_vec2(self.ptr.getOuter().lower), convert_from_vec2(self.ptr.getOuter().upper)
+      cdef aabb.AABB bounds = self.tree.getNode(self.index).aabb
+      return convert_from_vec2(bounds.lower), convert_from_vec2(bounds.upper)
 
-cdef create_node(cPhysics.World *world, aabb.Node *c_node):
+   @property
+   def height(self):
+      return 0
+
+cdef create_node(aabb.AABBTree *tree, int index):
+   cdef const aabb.TreeNode *c_node = &tree.getNode(index)
    if c_node.isLeaf():
       leaf = LeafNode()
-      leaf.ptr = c_node
-      leaf.obj = <object>object_map[<obj_pointer>c_node]
+      leaf.tree = tree
+      leaf.index = index
+      leaf.obj = <object>object_map[<obj_pointer>c_node.proxy]
       return leaf
    else:
       node = Node()
-      node.ptr = c_node
-      node.world = world
+      node.tree = tree
+      node.index = index
       return node
 
 cdef class AABBTree:
@@ -523,12 +716,160 @@ cdef class AABBTree:
       self.world = (<PyWorld>world)._world
 
    @property
-   def root(self):
-      if self.world.tree.getRoot() == NULL:
+   def dynamic_root(self):
+      if self.world.tree.getRoot(False) == aabb.NULL_NODE:
+         return None
+      else:
+         return create_node(&self.world.tree, self.world.tree.getRoot(False))
+
+   @property
+   def static_root(self):
+      if self.world.tree.getRoot(True) == aabb.NULL_NODE:
+         return None
+      else:
+         return create_node(&self.world.tree, self.world.tree.getRoot(True))
+
+   @property
+   def roots(self):
+      return tuple(root for root in (self.dynamic_root, self.static_root) if root is not None)
+
+   @property
+   def bounds(self):
+      roots = self.roots
+      if len(roots) == 0:
          return None
+      lowers, uppers = zip(*(root.bounds for root in roots))
+      return tuple(map(min, zip(*lowers))), tuple(map(max, zip(*uppers)))
+
+   @property
+   def height(self):
+      return max(self.world.tree.getHeight(False), self.world.tree.getHeight(True))
+
+   @property
+   def node_count(self):
+      return self.world.tree.getNodeCount()
+
+   @property
+   def margin(self):
+      return self.world.tree.margin
+
+   @property
+   def memory_usage(self):
+      return self.world.tree.getMemoryUsage()
+
+   @property
+   def begin_pairs(self):
+      cdef vector[pair[aabb.proxyP, aabb.proxyP]] pairs = self.world.tree.getBeginPairs()
+      return [(<object>object_map[<obj_pointer>p.first], <object>object_map[<obj_pointer>p.second]) for p in pairs]
+
+   @property
+   def end_pairs(self):
+      cdef vector[pair[aabb.proxyP, aabb.proxyP]] pairs = self.world.tree.getEndPairs()
+      return [(<object>object_map[<obj_pointer>p.first], <object>object_map[<obj_pointer>p.second]) for p in pairs]
+
+   @property
+   def pair_count(self):
+      return self.world.tree.getCachedPairCount()
+
+# Kinds of op for replay_tree_ops
+TREE_ADD = treebench.TREE_ADD
+TREE_REMOVE = treebench.TREE_REMOVE
+TREE_MOVE = treebench.TREE_MOVE
+TREE_STEP = treebench.TREE_STEP
+TREE_QUERY = treebench.TREE_QUERY
+
+cdef convert_tree_timings(treebench.TreeTimings timings):
+   return {
+      'update': timings.update,
+      'pairs': timings.pairs,
+      'query': timings.query,
+      'pair_count': timings.pairCount,
+      'nodes': timings.nodes,
+      'height': timings.height,
+      'memory': timings.memory,
+   }
+
+def replay_tree_ops(ops, float_type margin):
+   # Runs recorded tree ops, rows of (kind, id, static, lower x, lower y, upper x, upper y), on the
+   # current tree and on the pointer based one it replaced. Returns the timings of each, in seconds
+   cdef const double[:, ::1] view = np.ascontiguousarray(ops, dtype=np.float64).reshape(-1, treebench.TREE_OP_COLUMNS)
+   cdef treebench.TreeTimings current, baseline
+   if view.shape[0] > 0:
+      treebench.replayTreeOps(&view[0, 0], view.shape[0], margin, current, baseline)
+   return convert_tree_timings(current), convert_tree_timings(baseline)
+
+
+cdef class Snapshot:
+   # Made by PyWorld.snapshot, only useful for handing back to PyWorld.restore
+   cdef cPhysics.WorldSnapshot snapshot
+
+   @property
+   def object_count(self):
+      return self.snapshot.objectCount()
+
+   @property
+   def contact_count(self):
+      return self.snapshot.contactCount()
+
+   @property
+   def nbytes(self):
+      return self.snapshot.byteSize()
+
+cdef class SnapshotRing:
+   # The last size snapshots by tick, the snapshots are reused so saving doesn't allocate once warmed up
+   cdef list snapshots
+   cdef list ticks
+   cdef int next
+
+   def __init__(self, int size):
+      if size < 1:
+         raise ValueError('size must be at least 1')
+      self.snapshots = [Snapshot() for _ in range(size)]
+      self.ticks = [None] * size
+      self.next = 0
+
+   def __len__(self):
+      return len(self.snapshots)
+
+   def __contains__(self, tick):
+      return tick in self.ticks
+
+   @property
+   def ticks(self):
+      return sorted(tick for tick in self.ticks if tick is not None)
+
+   def save(self, world, tick):
+      # Replaces the oldest snapshot
+      if tick in self.ticks:
+         slot = self.ticks.index(tick)
       else:
-         return create_node(self.world, self.world.tree.getRoot())
+         slot = self.next
+         self.next = (self.next + 1) % len(self.snapshots)
+      (<PyWorld?>world).snapshot(self.snapshots[slot])
+      self.ticks[slot] = tick
 
+   def restore(self, world, tick, objs=None):
+      if tick not in self.ticks:
+         raise KeyError(tick)
+      (<PyWorld?>world).restore(self.snapshots[self.ticks.index(tick)], objs)
+
+   def clear(self):
+      self.ticks = [None] * len(self.snapshots)
+      self.next = 0
+
+cdef convert_counters(cPhysics.NarrowphaseCounters counters):
+   # The histograms count queries by iterations taken, bucket i up to 2**i and the last anything more
+   return {
+      'gjk_queries': counters.gjkQueries,
+      'gjk_iterations': counters.gjkIterations,
+      'epa_iterations': counters.epaIterations,
+      'sat_queries': counters.satQueries,
+      'sat_cached_exits': counters.satCachedExits,
+      'ccd_queries': counters.ccdQueries,
+      'ccd_hits': counters.ccdHits,
+      'gjk_histogram': list(counters.gjkHistogram),
+      'epa_histogram': list(counters.epaHistogram),
+   }
 
 cdef class PyWorld(CustomList):
    cdef cPhysics.World *_world
@@ -538,12 +879,24 @@ cdef class PyWorld(CustomList):
       self._world = new cPhysics.World(Vec2(0,0), -1, -1, -1, -1, 5)
       self.AABBTree = AABBTree(self)
 
-   def __init__(self, gravity=(0,0.3), baumgarte_bias=0.05, solver_steps=4, slop_p=0.1, slop_r=0.05):
+   def __init__(self, gravity=(0,0.3), baumgarte_bias=0.05, solver_steps=4, slop_p=0.1, slop_r=0.05,
+                warm_start_factor=1, batched_solver=False, sleep_enabled=True, sleep_linear_threshold=0.05, sleep_angular_threshold=0.005, sleep_time=30,
+                ccd_enabled=True, ccd_threshold=0.5, narrowphase_threads=1, deterministic=False):
       self.gravity = gravity
       self.baumgarte_bias = baumgarte_bias
       self.solver_steps = solver_steps
       self.slop_p = slop_p
       self.slop_r = slop_r
+      self.warm_start_factor = warm_start_factor
+      self.batched_solver = batched_solver
+      self.sleep_enabled = sleep_enabled
+      self.sleep_linear_threshold = sleep_linear_threshold
+      self.sleep_angular_threshold = sleep_angular_threshold
+      self.sleep_time = sleep_time
+      self.ccd_enabled = ccd_enabled
+      self.ccd_threshold = ccd_threshold
+      self.narrowphase_threads = narrowphase_threads
+      self.deterministic = deterministic
 
    def _add(self, obj):
       self._world.addObject((<Object>obj).thisptr)
@@ -552,8 +905,241 @@ cdef class PyWorld(CustomList):
    def _clear(self):
       self._world.clear()
 
-   def update(self, step_size):
-      self._world.update(step_size)
+   def update(self, step_size, unsigned int steps=1):
+      # Runs steps steps of step_size. Other threads can run meanwhile unless an object has a collide
+      # method or a CustomConstraint, which need the GIL held
+      cdef float_type c_step_size = step_size
+      if self._world.hasCallbacks():
+         for _ in range(steps):
+            self._world.update(c_step_size)
+         return
+      with nogil:
+         for _ in range(steps):
+            self._world.update(c_step_size)
+
+   # Bulk versions of Object.pos, vel, rot and rot_vel. Each row is (x, y, vel x, vel y, rot, rot vel)
+   # for the matching object of objs, which defaults to every object in the world's order
+
+   def get_state(self, objs=None, out=None):
+      if objs is None:
+         objs = self._list
+      if out is None:
+         out = np.empty((len(objs), 6))
+      cdef double[:, ::1] view = out
+      if view.shape[0] != len(objs) or view.shape[1] != 6:
+         raise ValueError('out must have shape ({}, 6)'.format(len(objs)))
+
+      cdef objects.Object *c_obj
+      cdef Py_ssize_t i = 0
+      for obj in objs:
+         c_obj = (<Object?>obj).thisptr
+         view[i, 0] = c_obj.pos.x
+         view[i, 1] = c_obj.pos.y
+         view[i, 2] = c_obj.vel.x
+         view[i, 3] = c_obj.vel.y
+         view[i, 4] = c_obj.rot
+         view[i, 5] = c_obj.rotV
+         i += 1
+      return out
+
+   def pop_collision_events(self):
+      # Everything recorded since the last call as (objs_a, objs_b, normals, locals_a, locals_b, impulses),
+      # normals point from a to b and locals are the deepest point in each object's space
+      cdef vector[cPhysics.CollisionEvent] *events = &self._world.collisionEvents
+      cdef Py_ssize_t n = events.size()
+      normals = np.empty((n, 2))
+      locals_a = np.empty((n, 2))
+      locals_b = np.empty((n, 2))
+      impulses = np.empty(n)
+      cdef double[:, ::1] normals_view = normals
+      cdef double[:, ::1] locals_a_view = locals_a
+      cdef double[:, ::1] locals_b_view = locals_b
+      cdef double[::1] impulses_view = impulses
+
+      objs_a = []
+      objs_b = []
+      cdef cPhysics.CollisionEvent *event
+      for i in range(n):
+         event = &events[0][i]
+         objs_a.append(<object>object_map[event.objA])
+         objs_b.append(<object>object_map[event.objB])
+         normals_view[i, 0] = event.normal.x
+         normals_view[i, 1] = event.normal.y
+         locals_a_view[i, 0] = event.localA.x
+         locals_a_view[i, 1] = event.localA.y
+         locals_b_view[i, 0] = event.localB.x
+         locals_b_view[i, 1] = event.localB.y
+         impulses_view[i] = event.impulse
+      events.clear()
+      return objs_a, objs_b, normals, locals_a, locals_b, impulses
+
+   # Snapshots cover positions, velocities, sleep timers, contacts, joint impulses and controllers.
+   # Which objects are in the world, their colliders and joints have to match between the two calls.
+   # Stepping on from a restored snapshot only repeats the original steps exactly if deterministic is
+   # set, otherwise the narrowphase's cached axes and the tree's pair order (which aren't saved) can
+   # send it elsewhere, so rollback and replay need deterministic worlds
+
+   def snapshot(self, Snapshot out=None):
+      if out is None:
+         out = Snapshot()
+      self._world.saveSnapshot(out.snapshot)
+      return out
+
+   def restore(self, Snapshot snapshot not None, objs=None):
+      # objs are the objects standing in for the ones the snapshot was taken of, in the same order
+      if objs is None:
+         objs = self._list
+      cdef vector[obj_pointer] c_objs
+      c_objs.reserve(len(objs))
+      for obj in objs:
+         c_objs.push_back((<Object?>obj).thisptr)
+      self._world.restoreSnapshot(snapshot.snapshot, c_objs)
+
+   def measure(self):
+      # Worst case motion, overlap and joint error among awake objects, see wrapper.World.choose_steps.
+      # Motion is speed over the object's smallest half extent, the rest are in world units. Also
+      # counts the awake pairs of dynamic objects that are close together
+      cdef cPhysics.StepMetrics metrics = self._world.measure()
+      return {
+         'max_motion': metrics.maxMotion,
+         'max_penetration': metrics.maxPenetration,
+         'max_joint_error': metrics.maxJointError,
+         'dynamic_pairs': metrics.dynamicPairs,
+      }
+
+   def state_hash(self):
+      # 64 bit hash of every object's sync_id, position and velocity. Two deterministic worlds with
+      # the same hash after stepping the same inputs haven't drifted apart (to within a collision)
+      return self._world.stateHash()
+
+   def pop_deaths(self):
+      # ControlledObjects that have died since the last call, in the order they died
+      cdef vector[obj_pointer] *deaths = &self._world.deaths
+      objs = [<object>object_map[deaths[0][i]] for i in range(deaths.size())]
+      deaths.clear()
+      return objs
+
+   # Queries see objects where they are right now, including sensors unless sensors is False. Anything
+   # found is in the world's tree order, or by sync_id when deterministic
+
+   def raycast(self, start, end, bint sensors=True):
+      # First object the segment from start to end enters as (obj, point, normal, fraction), or None.
+      # The normal points out of obj, objects the segment starts inside aren't hit
+      cdef cPhysics.RaycastHit hit
+      if not self._world.raycast(convert_to_vec2(start), convert_to_vec2(end), sensors, hit):
+         return None
+      return <object>object_map[hit.obj], convert_from_vec2(hit.point), convert_from_vec2(hit.normal), hit.fraction
+
+   def raycast_many(self, starts, ends, bint sensors=True):
+      # raycast for each row of starts and ends as (objs, points, normals, fractions), misses are None in
+      # objs and nan in the arrays
+      cdef const double[:, ::1] starts_view = np.ascontiguousarray(starts, dtype=np.float64)
+      cdef const double[:, ::1] ends_view = np.ascontiguousarray(ends, dtype=np.float64)
+      if starts_view.shape[1] != 2 or ends_view.shape[1] != 2 or starts_view.shape[0] != ends_view.shape[0]:
+         raise ValueError('starts and ends must both have shape (n, 2)')
+
+      cdef Py_ssize_t n = starts_view.shape[0]
+      objs = [None] * n
+      points = np.full((n, 2), np.nan)
+      normals = np.full((n, 2), np.nan)
+      fractions = np.full(n, np.nan)
+      cdef double[:, ::1] points_view = points
+      cdef double[:, ::1] normals_view = normals
+      cdef double[::1] fractions_view = fractions
+
+      cdef cPhysics.RaycastHit hit
+      for i in range(n):
+         if not self._world.raycast(Vec2(starts_view[i, 0], starts_view[i, 1]), Vec2(ends_view[i, 0], ends_view[i, 1]),
+                                    sensors, hit):
+            continue
+         objs[i] = <object>object_map[hit.obj]
+         points_view[i, 0] = hit.point.x
+         points_view[i, 1] = hit.point.y
+         normals_view[i, 0] = hit.normal.x
+         normals_view[i, 1] = hit.normal.y
+         fractions_view[i] = hit.fraction
+      return objs, points, normals, fractions
+
+   def query_point(self, point, bint sensors=True):
+      # Objects with a collider containing point
+      cdef vector[obj_pointer] found
+      self._world.queryPoint(convert_to_vec2(point), sensors, found)
+      return [<object>object_map[found[i]] for i in range(found.size())]
+
+   def query_points(self, points, bint sensors=True):
+      # query_point for each row of points, as a list of lists
+      cdef const double[:, ::1] view = np.ascontiguousarray(points, dtype=np.float64)
+      if view.shape[1] != 2:
+         raise ValueError('points must have shape (n, 2)')
+
+      cdef vector[obj_pointer] found
+      res = []
+      for i in range(view.shape[0]):
+         found.clear()
+         self._world.queryPoint(Vec2(view[i, 0], view[i, 1]), sensors, found)
+         res.append([<object>object_map[found[j]] for j in range(found.size())])
+      return res
+
+   def query_aabb(self, lower, upper, bint sensors=True):
+      # Objects whose bounds overlap the box
+      cdef aabb.AABB box
+      box.lower = convert_to_vec2(lower)
+      box.upper = convert_to_vec2(upper)
+      cdef vector[obj_pointer] found
+      self._world.queryAABB(box, sensors, found)
+      return [<object>object_map[found[i]] for i in range(found.size())]
+
+   def query_visible(self, lower, upper):
+      # Everything whose bounds overlap the box in the world's order, which is the order to draw them in
+      cdef aabb.AABB box
+      box.lower = convert_to_vec2(lower)
+      box.upper = convert_to_vec2(upper)
+      cdef vector[obj_pointer] found
+      self._world.queryVisible(box, found)
+      return [<object>object_map[found[i]] for i in range(found.size())]
+
+   def query_shape(self, collider, pos, float_type rot=0, bint sensors=True):
+      # Objects touching or overlapping collider, a CircleCollider or PolyCollider that isn't attached
+      # to anything, if it were at pos turned by rot
+      if not isinstance(collider, (CircleCollider, PolyCollider)):
+         raise TypeError('collider must be a CircleCollider or PolyCollider')
+
+      cdef vector[obj_pointer] found
+      cdef obj_pointer shape_obj = new objects.Object(-1, -1, -1, -1, NULL)
+      try:
+         shape_obj.pos = convert_to_vec2(pos)
+         shape_obj.rot = rot
+         shape_obj.updateRotMat()
+         self._world.queryShape((<BaseCollider>collider).generate(shape_obj), sensors, found)
+      finally:
+         del shape_obj  # Takes the generated collider with it
+      return [<object>object_map[found[i]] for i in range(found.size())]
+
+   def set_state(self, state, objs=None):
+      # Same as going through the properties, objects only wake if something changed
+      if objs is None:
+         objs = self._list
+      cdef const double[:, ::1] view = np.ascontiguousarray(state, dtype=np.float64)
+      if view.shape[0] != len(objs) or view.shape[1] != 6:
+         raise ValueError('state must have shape ({}, 6)'.format(len(objs)))
+
+      cdef objects.Object *c_obj
+      cdef Vec2 pos, vel
+      cdef Py_ssize_t i = 0
+      for obj in objs:
+         c_obj = (<Object?>obj).thisptr
+         pos = Vec2(view[i, 0], view[i, 1])
+         vel = Vec2(view[i, 2], view[i, 3])
+         if (pos.x != c_obj.pos.x or pos.y != c_obj.pos.y or vel.x != c_obj.vel.x or vel.y != c_obj.vel.y or
+             <float_type>view[i, 4] != c_obj.rot or <float_type>view[i, 5] != c_obj.rotV):
+            c_obj.wake()
+         c_obj.pos = pos
+         c_obj.vel = vel
+         c_obj.rot = view[i, 4]
+         c_obj.rotV = view[i, 5]
+         c_obj.updateRotMat()
+         c_obj.updateBounds()
+         i += 1
    
    def __deepcopy__(self, memo):
       res = type(self).__new__(type(self))
@@ -570,6 +1156,16 @@ cdef class PyWorld(CustomList):
          'solver_steps': self.solver_steps, 
          'slop_p': self.slop_p, 
          'slop_r': self.slop_r, 
+         'warm_start_factor': self.warm_start_factor,
+         'batched_solver': self.batched_solver,
+         'sleep_enabled': self.sleep_enabled,
+         'sleep_linear_threshold': self.sleep_linear_threshold,
+         'sleep_angular_threshold': self.sleep_angular_threshold,
+         'sleep_time': self.sleep_time,
+         'ccd_enabled': self.ccd_enabled,
+         'ccd_threshold': self.ccd_threshold,
+         'narrowphase_threads': self.narrowphase_threads,
+         'deterministic': self.deterministic,
          #'AABBTree': self.AABBTree,
          #'contacts': self.contacts,
       }
@@ -582,10 +1178,22 @@ cdef class PyWorld(CustomList):
       self.solver_steps = state['solver_steps']
       self.slop_p = state['slop_p']
       self.slop_r = state['slop_r']
+      self.warm_start_factor = state['warm_start_factor']
+      self.batched_solver = state['batched_solver']
+      self.sleep_enabled = state['sleep_enabled']
+      self.sleep_linear_threshold = state['sleep_linear_threshold']
+      self.sleep_angular_threshold = state['sleep_angular_threshold']
+      self.sleep_time = state['sleep_time']
+      self.ccd_enabled = state['ccd_enabled']
+      self.ccd_threshold = state['ccd_threshold']
+      self.narrowphase_threads = state['narrowphase_threads']
+      self.deterministic = state['deterministic']
       
       #contacts = state['contacts']
 
-      for key in ('gravity', 'baumgarte_bias', 'solver_steps', 'slop_p', 'slop_r'):
+      for key in ('gravity', 'baumgarte_bias', 'solver_steps', 'slop_p', 'slop_r', 'warm_start_factor', 'batched_solver',
+                  'sleep_enabled', 'sleep_linear_threshold', 'sleep_angular_threshold', 'sleep_time',
+                  'ccd_enabled', 'ccd_threshold', 'narrowphase_threads', 'deterministic'):
          del state[key]
       super().__setstate__(state)
 
@@ -645,17 +1253,131 @@ cdef class PyWorld(CustomList):
    def slop_r(self, val):
       self._world.slopR = val
 
+   @property
+   def warm_start_factor(self):
+      return self._world.warmStartFactor
+   @warm_start_factor.setter
+   def warm_start_factor(self, val):
+      if not 0 <= val <= 1:
+         raise ValueError('warm_start_factor must be between 0 and 1')
+      self._world.warmStartFactor = val
+
+   @property
+   def batched_solver(self):
+      return self._world.useBatchedSolver
+   @batched_solver.setter
+   def batched_solver(self, val):
+      self._world.useBatchedSolver = val
+
+   @property
+   def sleep_enabled(self):
+      return self._world.sleepEnabled
+   @sleep_enabled.setter
+   def sleep_enabled(self, val):
+      self._world.sleepEnabled = val
+
+   @property
+   def sleep_linear_threshold(self):
+      return self._world.sleepLinearThreshold
+   @sleep_linear_threshold.setter
+   def sleep_linear_threshold(self, val):
+      self._world.sleepLinearThreshold = val
+
+   @property
+   def sleep_angular_threshold(self):
+      return self._world.sleepAngularThreshold
+   @sleep_angular_threshold.setter
+   def sleep_angular_threshold(self, val):
+      self._world.sleepAngularThreshold = val
+
+   @property
+   def sleep_time(self):
+      return self._world.sleepTime
+   @sleep_time.setter
+   def sleep_time(self, val):
+      self._world.sleepTime = val
+
+   @property
+   def ccd_enabled(self):
+      return self._world.ccdEnabled
+   @ccd_enabled.setter
+   def ccd_enabled(self, val):
+      self._world.ccdEnabled = val
+
+   @property
+   def ccd_threshold(self):
+      # Objects moving further than this many times their smallest half extent in a step are swept
+      return self._world.ccdThreshold
+   @ccd_threshold.setter
+   def ccd_threshold(self, val):
+      if val < 0:
+         raise ValueError('ccd_threshold must not be negative')
+      self._world.ccdThreshold = val
+
+   @property
+   def narrowphase_threads(self):
+      return self._world.narrowphaseThreads
+   @narrowphase_threads.setter
+   def narrowphase_threads(self, val):
+      if val < 1:
+         raise ValueError('narrowphase_threads must be at least 1')
+      self._world.narrowphaseThreads = val
+
+   @property
+   def deterministic(self):
+      # Steps everything in sync_id order and ignores caches peers can't share, at some cost
+      return self._world.deterministic
+   @deterministic.setter
+   def deterministic(self, val):
+      self._world.deterministic = val
+
+   @property
+   def narrowphase_counters(self):
+      # Totals since the world was made, take the difference of two readings to measure a run
+      return convert_counters(self._world.narrowphaseCounters)
+
+   @property
+   def stats(self):
+      # Where update has spent its time since the world was made or reset_stats was last called. Times
+      # are in seconds, they and the counts are summed over every step, divide by 'steps' for averages
+      cdef cPhysics.StepStats *stats = &self._world.stats
+      return {
+         'steps': stats.steps,
+         'time': {
+            'tree': stats.treeTime,
+            'pairs': stats.pairTime,
+            'narrowphase': stats.narrowphaseTime,
+            'solver': stats.solverTime,
+            'islands': stats.islandTime,
+            'integrate': stats.integrateTime,
+            'total': stats.totalTime,
+         },
+         'pairs': stats.pairs,
+         'contacts': stats.contacts,
+         'contact_points': stats.contactPoints,
+         'awake_objects': stats.awakeObjects,
+         'collision_handler_calls': stats.collisionHandlerCalls,
+         'constraint_callbacks': stats.constraintCallbacks,
+         'narrowphase': convert_counters(stats.narrowphase),
+      }
+
+   def reset_stats(self):
+      self._world.resetStats()
+
    @property
    def contacts(self):
-      cdef objects.ContactPoint c_point
+      cdef const objects.ContactPoint* c_point
+      cdef const objects.ContactConstraint* c_contact
       py_contacts = []
 
-
-      cdef vector[objects.ContactConstraint] c_contacts = self._world.getContacts()
-      for c_contact in c_contacts:
+      # Read straight out of the world's contact array
+      cdef const vector[objects.ContactConstraint]* c_contacts = &self._world.getContacts()
+      for i in range(c_contacts.size()):
+         c_contact = &c_contacts[0][i]
          points = []
 
-         for c_point in c_contact.points:
+         for j in range(c_contact.points.size()):
+            c_point = &c_contact.points[j]
             points.append((convert_from_vec2(c_point.localA),convert_from_vec2(c_point.localB),
                            convert_from_vec2(c_point.globalA),convert_from_vec2(c_point.globalB),
                            convert_from_vec2(c_point.normal),c_point.penetration,
@@ -671,6 +1393,52 @@ cdef class PyWorld(CustomList):
    def AABBTree(self):
       return self.AABBTree
 
+cdef class WorldPool:
+   # Steps independent worlds at the same time, each on one of threads threads
+   cdef cPhysics.ThreadPool *pool
+
+   def __cinit__(self, threads=None):
+      if threads is None:
+         threads = os.cpu_count() or 1
+      if threads < 1:
+         raise ValueError('threads must be at least 1')
+      self.pool = new cPhysics.ThreadPool(threads)
+
+   def __dealloc__(self):
+      del self.pool
+
+   @property
+   def threads(self):
+      return self.pool.size()
+
+   def update(self, worlds, step_size, steps=1):
+      # The same as PyWorld.update(world, step_size, steps) for every world, step_size and steps are
+      # either one value for all of them or one per world. The worlds mustn't share any objects, worlds
+      # that need the GIL (see PyWorld.update) are stepped on this thread before the rest. The others
+      # ignore narrowphase_threads and keep their narrowphase on the pool thread stepping them
+      worlds = list(worlds)
+      if len(set(map(id, worlds))) != len(worlds):
+         raise ValueError('worlds must not repeat')
+      step_sizes = np.broadcast_to(step_size, len(worlds))
+      counts = np.broadcast_to(steps, len(worlds))
+
+      if (counts < 0).any():
+         raise ValueError('steps must not be negative')
+
+      cdef vector[cPhysics.WorldStep] jobs
+      cdef cPhysics.WorldStep job
+      for world, world_step_size, count in zip(worlds, step_sizes, counts):
+         job.world = (<PyWorld?>world)._world
+         job.stepSize = world_step_size
+         job.steps = count
+         if job.world.hasCallbacks():
+            PyWorld.update(world, job.stepSize, job.steps)
+         else:
+            jobs.push_back(job)
+
+      with nogil:
+         cPhysics.stepWorlds(self.pool[0], jobs)
+
 class Module(object):
    def __init__(self):
       self.World = PyWorld
@@ -679,7 +1447,18 @@ class Module(object):
       self.PivotConstraint = PivotConstraint
       self.FixedConstraint = FixedConstraint
       self.SliderConstraint = SliderConstraint
+      self.VelocityConstraint = VelocityConstraint
       self.CustomConstraint = CustomConstraint
       self.Object = Object
+      self.ControlledObject = ControlledObject
+      self.Snapshot = Snapshot
+      self.SnapshotRing = SnapshotRing
+      self.WorldPool = WorldPool
+      self.replay_tree_ops = replay_tree_ops
+      self.TREE_ADD = TREE_ADD
+      self.TREE_REMOVE = TREE_REMOVE
+      self.TREE_MOVE = TREE_MOVE
+      self.TREE_STEP = TREE_STEP
+      self.TREE_QUERY = TREE_QUERY
 
 sys.modules[__name__] = Module()
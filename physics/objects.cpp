@@ -7,6 +7,7 @@
 #include "constraint.h"
 
 const float_type persistenceThresh = 0.05;
+const float_type maxConditionNumber = 1000;
 
 Object::Object(float_type mass, float_type moment, float_type restitution, float_type friction,
                bool (*collisionHandler)(Object*, Object*, Vec2, Vec2, Vec2)) {
@@ -14,6 +15,12 @@ Object::Object(float_type mass, float_type moment, float_type restitution, float
     this->friction = friction;
 
     this->collisionHandler = collisionHandler;
+    sensor = false;
+    oneWay = Vec2(0, 0);
+    reportCollisions = false;
+    lethal = false;
+    isCheckpoint = false;
+    bullet = false;
 
     setMass(mass);
     setMoment(moment);
@@ -24,6 +31,13 @@ Object::Object(float_type mass, float_type moment, float_type restitution, float
     pos = Vec2(0, 0);
     vel = Vec2(0, 0);
 
+    sleeping = false;
+    sleepTime = 0;
+    islandIndex = 0;
+    snapshotIndex = 0;
+    syncId = noSyncId;
+    addOrder = 0;
+
     rotMat.a = 1;
     rotMat.b = 0;
     rotMat.c = 0;
@@ -36,6 +50,10 @@ Object::Object(float_type mass, float_type moment, float_type restitution, float
 }
 
 Object::~Object() {
+    if (island) {
+        island->erase(std::remove(island->begin(), island->end(), this), island->end());
+    }
+
     for (BaseCollider* collider : colliders) {
         delete collider;
     }
@@ -62,11 +80,57 @@ void Object::updateConstraints(const float_type baumgarteBias, const float_type
                                const float_type slopR) {
     for (BaseConstraint* constraint : constraints) {
         if (this == constraint->objB) continue;
+        if (constraint->objA->sleeping && constraint->objB->sleeping) continue;
         constraint->apply(baumgarteBias, slopP, slopR);
     }
 }
 
+void Object::warmStartConstraints(const float_type factor) {
+    for (BaseConstraint* constraint : constraints) {
+        if (this == constraint->objB) continue;
+        if (constraint->objA->sleeping && constraint->objB->sleeping) continue;
+        constraint->warmStart(factor);
+    }
+}
+
+void Object::wake() {
+    if (island) {
+        std::shared_ptr<std::vector<Object*>> members = island;
+        for (Object* obj : *members) {
+            obj->sleeping = false;
+            obj->sleepTime = 0;
+            obj->island.reset();
+        }
+    }
+    sleeping = false;
+    sleepTime = 0;
+}
+
+void Object::sleep(std::shared_ptr<std::vector<Object*>> island) {
+    this->island = island;
+    sleeping = true;
+    vel = ORIGIN;
+    rotV = 0;
+}
+
+void Controller::removeJump() {
+    delete jump;
+    jump = nullptr;
+}
+
+void Controller::revive() {
+    removeJump();
+    state = State::Alive;
+    dyingTime = 0;
+}
+
+void Object::updateColliders() {
+    for (BaseCollider *collider : colliders) collider->updateTransform();
+}
+
 void Object::updateBounds() {
+    updateColliders();
+
     Vec2 min(std::numeric_limits<float_type>::infinity(),
               std::numeric_limits<float_type>::infinity());
     Vec2 max(-std::numeric_limits<float_type>::infinity(),
@@ -81,13 +145,11 @@ void Object::updateBounds() {
         max.y = std::max(max.y, colliderBounds.second.y);
     }
 
-    inner.lower = min;
-    inner.upper = max;
+    setInner(AABB(max, min));
 }
 
-void Object::updateAABB(const float_type margin) {
-    // We must be leaf
-    outer = inner.expand(margin);
+AABB Object::fatten(const float_type margin) const {
+    AABB outer = inner.expand(margin);
 
     const float_type factor = 2;
 
@@ -101,6 +163,7 @@ void Object::updateAABB(const float_type margin) {
     } else {
         outer.lower.y += vel.y*factor;
     }
+    return outer;
 }
 
 void Object::updateRotMat() { rotMat = genRotationMat(rot); }
@@ -113,6 +176,8 @@ void Object::setMass(float_type m) {
         mass = m;
         invMass = 1 / m;
     }
+    wake();
+    touch();
     for (BaseConstraint* constraint : constraints) {
         constraint->updateMassMatrix();
     }
@@ -126,6 +191,8 @@ void Object::setMoment(float_type m) {
         moment = m;
         invMoment = 1 / m;
     }
+    wake();
+    touch();
     for (BaseConstraint* constraint : constraints) {
         constraint->updateMassMatrix();
     }
@@ -144,47 +211,153 @@ std::pair<Vec2, Vec2> CircleCollider::bounds() {
     return std::pair<Vec2, Vec2>{obj->pos - size, obj->pos + size};
 }
 
-Vec2 PolyCollider::support(const Vec2& dir) const {
-    Vec2 point = points[0];
-    float_type maxDot = point.dot(dir);
-    for (uint i = 1; i < points.size(); i++) {
-        float_type curDot = points[i].dot(dir);
-        if (curDot > maxDot) {
-            point = points[i];
-            maxDot = curDot;
+bool CircleCollider::raycast(const Vec2 &from, const Vec2 &to, float_type maxFraction,
+                             float_type &fraction, Vec2 &normal) const {
+    const Vec2 start = from - obj->pos;
+    const Vec2 delta = to - from;
+    const float_type c = start.length2() - radius * radius;
+    if (c <= 0) return false;  // Starts inside
+
+    const float_type b = start.dot(delta);
+    const float_type a = delta.length2();
+    const float_type discriminant = b * b - a * c;
+    if (b >= 0 || a == 0 || discriminant < 0) return false;
+
+    const float_type t = (-b - std::sqrt(discriminant)) / a;
+    if (t > maxFraction) return false;
+    fraction = t;
+    normal = (start + delta * t).normalised();
+    return true;
+}
+
+bool CircleCollider::containsPoint(const Vec2 &point) const {
+    return (point - obj->pos).length2() <= radius * radius;
+}
+
+PolyCollider::PolyCollider(Object *obj, std::vector<Vec2> points)
+    : BaseCollider(obj), points(points) {
+    // Either winding works here, the sign of the area picks which side is outwards
+    float_type area = 0;
+    for (uint i = 0; i < points.size(); i++) {
+        area += points[i].cross(points[(i + 1) % points.size()]);
+    }
+    const float_type side = area < 0 ? -1 : 1;
+
+    normals.reserve(points.size());
+    for (uint i = 0; i < points.size(); i++) {
+        const Vec2 edge = points[(i + 1) % points.size()] - points[i];
+        normals.push_back(Vec2(edge.y, -edge.x).normalised() * side);
+    }
+
+    for (const Vec2 diagonal : {Vec2(1, 1), Vec2(-1, 1), Vec2(1, -1), Vec2(-1, -1)}) {
+        uint best = 0;
+        for (uint i = 1; i < points.size(); i++) {
+            if (points[i].dot(diagonal) > points[best].dot(diagonal)) best = i;
         }
+        supportHints[supportHint(diagonal)] = best;
     }
-    return point;
+
+    // The object's updateBounds ran before the points were set
+    updateTransform();
 }
 
-std::pair<Vec2, Vec2> PolyCollider::bounds() {
-    Vec2 point = obj->rotMat.apply(points[0]);
-    float_type minX = point.x;
-    float_type minY = point.y;
-
-    float_type maxX = point.x;
-    float_type maxY = point.y;
-
-    for (uint i = 1; i < points.size(); i++) {
-        Vec2 point = obj->rotMat.apply(points[i]);
-        if (point.x < minX) {
-            minX = point.x;
-        } else if (point.x > maxX) {
-            maxX = point.x;
+void PolyCollider::updateTransform() {
+    globalPoints.resize(points.size());
+    globalNormals.resize(normals.size());
+    for (uint i = 0; i < points.size(); i++) {
+        globalPoints[i] = localToGlobal(points[i]);
+        globalNormals[i] = localToGlobalVec(normals[i]);
+    }
+}
+
+uint PolyCollider::supportIndex(const std::vector<Vec2> &candidates, const Vec2 &dir, uint start) const {
+    const uint count = candidates.size();
+    uint best = start;
+    float_type maxDot = candidates[best].dot(dir);
+    if (count < hillClimbSize) {
+        for (uint i = 0; i < count; i++) {
+            const float_type curDot = candidates[i].dot(dir);
+            if (curDot > maxDot) {
+                best = i;
+                maxDot = curDot;
+            }
         }
+        return best;
+    }
 
-        if (point.y < minY) {
-            minY = point.y;
-        } else if (point.y > maxY) {
-            maxY = point.y;
+    // Around a convex polygon the dot product only rises on the way to the support point. The hint
+    // is within 45 degrees of it, so the climb is short and never starts from the far side
+    for (const uint stride : {1u, count - 1}) {  // Forwards, then backwards
+        while (true) {
+            const uint next = (best + stride) % count;
+            const float_type nextDot = candidates[next].dot(dir);
+            if (nextDot <= maxDot) break;
+            best = next;
+            maxDot = nextDot;
         }
     }
+    return best;
+}
+
+Vec2 PolyCollider::support(const Vec2& dir) const {
+    return points[supportIndex(points, dir, supportHints[supportHint(dir)])];
+}
 
-    return std::pair<Vec2, Vec2>{Vec2(minX, minY) + obj->pos,
-                                   Vec2(maxX, maxY) + obj->pos};
+Vec2 PolyCollider::globalSupport(const Vec2& dir) const {
+    const uint hint = points.size() < hillClimbSize ? 0 : supportHints[supportHint(globalToLocalVec(dir))];
+    return globalPoints[supportIndex(globalPoints, dir, hint)];
+}
+
+// Clips the segment against each edge's half plane in local space, the last plane it enters through is hit
+bool PolyCollider::raycast(const Vec2 &from, const Vec2 &to, float_type maxFraction,
+                           float_type &fraction, Vec2 &normal) const {
+    const Vec2 start = globalToLocal(from);
+    const Vec2 delta = globalToLocalVec(to - from);
+
+    float_type lower = 0, upper = maxFraction;
+    int entry = -1;
+    for (uint i = 0; i < points.size(); i++) {
+        const float_type numerator = normals[i].dot(points[i] - start);
+        const float_type denominator = normals[i].dot(delta);
+        if (denominator == 0) {
+            if (numerator < 0) return false;  // Parallel and outside
+        } else if (denominator < 0 && numerator < lower * denominator) {
+            lower = numerator / denominator;
+            entry = i;
+        } else if (denominator > 0 && numerator < upper * denominator) {
+            upper = numerator / denominator;
+        }
+        if (upper < lower) return false;
+    }
+    if (entry == -1) return false;  // Starts inside
+
+    fraction = lower;
+    normal = localToGlobalVec(normals[entry]);
+    return true;
+}
+
+bool PolyCollider::containsPoint(const Vec2 &point) const {
+    const Vec2 local = globalToLocal(point);
+    for (uint i = 0; i < points.size(); i++) {
+        if (normals[i].dot(local - points[i]) > 0) return false;
+    }
+    return true;
+}
+
+std::pair<Vec2, Vec2> PolyCollider::bounds() {
+    Vec2 min = globalPoints[0], max = globalPoints[0];
+    for (uint i = 1; i < globalPoints.size(); i++) {
+        min.x = std::min(min.x, globalPoints[i].x);
+        min.y = std::min(min.y, globalPoints[i].y);
+        max.x = std::max(max.x, globalPoints[i].x);
+        max.y = std::max(max.y, globalPoints[i].y);
+    }
+    return std::pair<Vec2, Vec2>{min, max};
 }
 
 BaseConstraint::~BaseConstraint() {
+    objA->wake();
+    objB->wake();
     objA->constraints.erase(
         std::remove(objA->constraints.begin(), objA->constraints.end(), this),
         objA->constraints.end());
@@ -293,6 +466,19 @@ void ContactConstraint::apply() {
     set_velocity(*objA, *objB, V);
 }
 
+void ContactConstraint::warmStart(const float_type factor) {
+    Vec6 V = get_velocity_vector(*objA, *objB);
+    Vec6 M = get_inverse_mass_matrix(*objA, *objB);
+
+    for (ContactPoint& point : points) {
+        point.nImpulseSum *= factor;
+        point.tImpulseSum *= factor;
+        V += apply_constraint(point.J, M, point.nImpulseSum);
+        V += apply_constraint(point.JT, M, point.tImpulseSum);
+    }
+    set_velocity(*objA, *objB, V);
+}
+
 void ContactConstraint::updatePoints(const float_type baumgarteBias, const float_type slopP, const float_type slopR, const Vec2& tickGravity) {
     for (auto it = points.begin(); it != points.end();) {
         ContactPoint& point = *it;
@@ -363,8 +549,18 @@ void ContactConstraint::updatePoints(const float_type baumgarteBias, const float
 
         point.bias = -baumgarteBias * std::max(point.penetration - slopP, -slopP*(float_type)0.5) + 
                     std::min(closingVelocity + slopR, (float_type)0.0) * restitution;
+    }
 
-        point.tImpulseSum = 0;
+    if (points.size() == 2) {
+        // Points pushing along nearly the same line make the block solve blow up, so keep the deeper one
+        const Vec6 M = get_inverse_mass_matrix(*objA, *objB);
+        const float_type k00 = points[0].J.dot(M * points[0].J);
+        const float_type k01 = points[0].J.dot(M * points[1].J);
+        const float_type k11 = points[1].J.dot(M * points[1].J);
+        if (k00 * k00 >= maxConditionNumber * (k00 * k11 - k01 * k01)) {
+            if (points[1].penetration > points[0].penetration) std::swap(points[0], points[1]);
+            points.pop_back();
+        }
     }
 }
 
@@ -373,7 +569,7 @@ void ContactConstraint::addPoint(Collision col) {
     Vec2 globalB = objB->localToGlobal(col.localB);
 
     
-    for (ContactPoint point : points) {
+    for (ContactPoint& point : points) {  // Matching points keep their accumulated impulses
         if ((point.globalA - globalA).length2() < persistenceThresh ||
             (point.globalB - globalB).length2() < persistenceThresh) {
             
@@ -403,6 +599,22 @@ void ContactConstraint::addPoint(Collision col) {
     points.push_back(point);
 }
 
+static std::array<Vec6, 2> pivotJacobian(const Vec2& rA, const Vec2& rB) {
+    return {
+        Vec6(-1,  0,  rA.y, 1, 0, -rB.y),
+        Vec6( 0, -1, -rA.x, 0, 1,  rB.x),
+    };
+}
+
+static std::array<Vec6, 3> fixedJacobian(const Vec2& rA, const Vec2& rB) {
+    std::array<Vec6, 2> pivot = pivotJacobian(rA, rB);
+    return {
+        pivot[0],
+        pivot[1],
+        Vec6(0, 0, -1, 0, 0, 1),
+    };
+}
+
 void PivotConstraint::apply(const float_type baumgarteBias, const float_type slopP,
                             const float_type slopR) {
     Vec2 rA = objA->localToGlobalVec(localA);
@@ -410,14 +622,29 @@ void PivotConstraint::apply(const float_type baumgarteBias, const float_type slo
 
     Vec6 V = get_velocity_vector(*objA, *objB);
 
-    std::array<Vec6, 2> J = {
-        Vec6(-1,  0,  rA.y, 1, 0, -rB.y),
-        Vec6( 0, -1, -rA.x, 0, 1,  rB.x),
-    };
+    std::array<Vec6, 2> J = pivotJacobian(rA, rB);
 
     Vec2 bias = baumgarteBias * (objB->pos + rB - objA->pos - rA);
 
-    V += apply_constraint(J, M, resolve_constraint(J, M, V, bias));
+    Vec2 lambda = resolve_constraint(J, M, V, bias);
+    impulseSum += lambda;
+
+    V += apply_constraint(J, M, lambda);
+    set_velocity(*objA, *objB, V);
+}
+
+float_type PivotConstraint::positionError() const {
+    return (objB->localToGlobal(localB) - objA->localToGlobal(localA)).length();
+}
+
+void PivotConstraint::warmStart(const float_type factor) {
+    Vec2 rA = objA->localToGlobalVec(localA);
+    Vec2 rB = objB->localToGlobalVec(localB);
+
+    impulseSum *= factor;
+
+    Vec6 V = get_velocity_vector(*objA, *objB);
+    V += apply_constraint(pivotJacobian(rA, rB), M, impulseSum);
     set_velocity(*objA, *objB, V);
 }
 
@@ -428,15 +655,31 @@ void FixedConstraint::apply(const float_type baumgarteBias, const float_type slo
 
     Vec6 V = get_velocity_vector(*objA, *objB);
 
-    std::array<Vec6, 3> J = {
-        Vec6(-1,  0,  rA.y, 1, 0, -rB.y),
-        Vec6( 0, -1, -rA.x, 0, 1,  rB.x),
-        Vec6( 0,  0,    -1, 0, 0,     1),
-    };
+    std::array<Vec6, 3> J = fixedJacobian(rA, rB);
 
     Vec2 linear_bias = baumgarteBias * (objB->pos + rB - objA->pos - rA);
     float_type rotation_bias = 2 * baumgarteBias * (objB->rot - objA->rot);
-    V += apply_constraint(J, M, resolve_constraint(J, M, V, Vec3(linear_bias.x, linear_bias.y, rotation_bias)));
+
+    Vec3 lambda = resolve_constraint(J, M, V, Vec3(linear_bias.x, linear_bias.y, rotation_bias));
+    impulseSum += lambda;
+
+    V += apply_constraint(J, M, lambda);
+    set_velocity(*objA, *objB, V);
+}
+
+// Only the anchors, the angle is left out as it's in different units
+float_type FixedConstraint::positionError() const {
+    return (objB->localToGlobal(localB) - objA->localToGlobal(localA)).length();
+}
+
+void FixedConstraint::warmStart(const float_type factor) {
+    Vec2 rA = objA->localToGlobalVec(localA);
+    Vec2 rB = objB->localToGlobalVec(localB);
+
+    impulseSum *= factor;
+
+    Vec6 V = get_velocity_vector(*objA, *objB);
+    V += apply_constraint(fixedJacobian(rA, rB), M, impulseSum);
     set_velocity(*objA, *objB, V);
 }
 
@@ -460,7 +703,58 @@ void SliderConstraint::apply(const float_type baumgarteBias, const float_type sl
 
     Vec2 bias(-J1.dot(V) - baumgarteBias * d.dot(normal), -J2.dot(V) - 2 * baumgarteBias * (objB->rot - objA->rot));
     Vec2 l = mat.solve(bias);
+    impulseSum += l;
 
     V += J1M * l.x + J2M * l.y;
     set_velocity(*objA, *objB, V);
 }
+
+float_type SliderConstraint::positionError() const {
+    const Vec2 d = objB->localToGlobal(localB) - objA->localToGlobal(localA);
+    return std::abs(d.dot(objA->localToGlobalVec(localN)));
+}
+
+void SliderConstraint::warmStart(const float_type factor) {
+    Vec2 rA = objA->localToGlobalVec(localA);
+    Vec2 rB = objB->localToGlobalVec(localB);
+    Vec2 normal = objA->localToGlobalVec(localN);
+
+    Vec2 d = objB->pos + rB - objA->pos - rA;
+
+    Vec6 J1(-normal.x, -normal.y, -(rA + d).cross(normal), normal.x, normal.y, rB.cross(normal));
+    Vec6 J2(0, 0, -1, 0, 0, 1);
+
+    impulseSum *= factor;
+
+    Vec6 V = get_velocity_vector(*objA, *objB);
+    V += J1.component_multiply(M) * impulseSum.x + J2.component_multiply(M) * impulseSum.y;
+    set_velocity(*objA, *objB, V);
+}
+
+Vec6 VelocityConstraint::jacobian() const {
+    Vec2 rA = objA->localToGlobalVec(localA);
+    Vec2 rB = objB->localToGlobalVec(localB);
+    return Vec6(-normal.x, -normal.y, normal.cross(rA), normal.x, normal.y, -normal.cross(rB));
+}
+
+void VelocityConstraint::apply(const float_type baumgarteBias, const float_type slopP,
+                               const float_type slopR) {
+    Vec6 V = get_velocity_vector(*objA, *objB);
+    Vec6 J = jacobian();
+
+    float_type lambda = resolve_constraint(J, M, V, -targetVelocity);
+    float_type newImpulseSum = std::min(std::max(impulseSum + lambda, -maxImpulse), maxImpulse);
+    lambda = newImpulseSum - impulseSum;
+    impulseSum = newImpulseSum;
+
+    V += apply_constraint(J, M, lambda);
+    set_velocity(*objA, *objB, V);
+}
+
+void VelocityConstraint::warmStart(const float_type factor) {
+    impulseSum *= factor;
+
+    Vec6 V = get_velocity_vector(*objA, *objB);
+    V += apply_constraint(jacobian(), M, impulseSum);
+    set_velocity(*objA, *objB, V);
+}
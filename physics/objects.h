@@ -1,6 +1,9 @@
 #pragma once
 
+#include <cstdint>
 #include <iostream>
+#include <limits>
+#include <memory>
 #include <vector>
 
 #include "vector.h"
@@ -8,8 +11,37 @@
 
 class BaseCollider;
 class BaseConstraint;
+class VelocityConstraint;
+class Object;
+
+// Rolls and jumps a ball from a (roll, jump/brake) action, run by the World at the start of every step.
+// Touching a lethal object starts a countdown, once it runs out (or straight away if the ball falls
+// below everything else in the world) the object is added to World::deaths and ignores its action
+// until revive is called
+struct Controller {
+    enum class State { Alive, Dying, Dead };
+
+    static constexpr float_type rollAcceleration = 0.01;  // Change in rotational energy per unit time
+    static constexpr float_type assistSpeed = 0.7;  // Below this the roll is also added directly
+    static constexpr float_type jumpSpeed = 8;  // At full strength
+    static constexpr float_type jumpThreshold = 0.7;  // Ground normal against gravity needed to jump
+    static constexpr float_type jumpDuration = 1;  // Time the ground push is kept up for
+    static constexpr float_type deathDelay = 3;
+
+    Vec2 action = Vec2(0, 0);  // x rolls, y > 0 brakes and y < -0.1 jumps with a strength of -y
+    State state = State::Alive;
+    float_type dyingTime = 0;
+    Object *checkpoint = nullptr;  // Last checkpoint touched
+
+    VelocityConstraint *jump = nullptr;  // Pushes off the ground for the current jump
+    float_type jumpTime = 0;
+
+    bool wantsJump() const { return state == State::Alive && action.y < -0.1; }
+    void removeJump();
+    void revive();
+};
 
-class Object final : public Node {
+class Object final : public Proxy {
     private:
         float_type mass;
         float_type moment;
@@ -23,12 +55,32 @@ class Object final : public Node {
 
         std::vector<BaseConstraint *> constraints;
         std::vector<BaseCollider *> colliders;
+        std::vector<uint> contacts;  // Indices into the World's contacts
 
         float_type rot, rotV;
         Vec2 pos, vel;
         mat2x2 rotMat;
 
+        bool sleeping;
+        float_type sleepTime;  // Time spent below the sleep thresholds
+        std::shared_ptr<std::vector<Object *>> island;  // Set while asleep, shared by the whole island
+        uint islandIndex;  // Scratch space for World island detection
+        uint solverIndex;  // Scratch space for BatchedContactSolver
+        uint snapshotIndex;  // Scratch space for World snapshots
+
+        // Orders the object in a deterministic World, so it has to be the same on every peer
+        static constexpr uint64_t noSyncId = std::numeric_limits<uint64_t>::max();
+        uint64_t syncId;  // Left as noSyncId, the World hands one out from 2^32 up
+        uint64_t addOrder;  // Grows with every World::addObject, puts query results back in the world's order
+
         bool (*collisionHandler)(Object *, Object *, Vec2, Vec2, Vec2);
+        bool sensor;  // Still detects collisions but never gets a contact constraint
+        Vec2 oneWay;  // Objects moving this way relative to it pass through, zero for none
+        bool reportCollisions;  // Collisions are recorded in the World's event buffer
+        bool lethal;  // Starts the countdown of any controller touching it
+        bool isCheckpoint;  // Becomes the checkpoint of any controller touching it
+        bool bullet;  // Swept against dynamic objects as well as static ones, however slow it moves
+        std::unique_ptr<Controller> controller;  // Only set for players
 
         Object(float_type mass, float_type moment, float_type restitution, float_type friction,
             bool (*collisionHandler)(Object *, Object *, Vec2, Vec2, Vec2));
@@ -37,6 +89,7 @@ class Object final : public Node {
         void update(const float_type stepSize);
         void updateConstraints(const float_type baumgarteBias, const float_type slopP,
                             const float_type slopR);
+        void warmStartConstraints(const float_type factor);
 
         void setMass(const float_type mass);
         float_type getMass() const { return mass; }
@@ -46,6 +99,14 @@ class Object final : public Node {
         float_type getMoment() const { return moment; }
         float_type getInvMoment() const { return invMoment; }
 
+        bool isOneWay() const { return oneWay.x != 0 || oneWay.y != 0; }
+        // Whether other is moving through this along oneWay, in which case they don't touch
+        bool passedBy(const Object *other) const { return oneWay.dot(other->vel - vel) > 0; }
+
+        virtual bool isStatic() const override { return invMass == 0 && invMoment == 0; }
+        void wake();
+        void sleep(std::shared_ptr<std::vector<Object *>> island);
+
         Vec2 localToGlobal(const Vec2& point) const {
             return rotMat.apply(point) + pos;
         }
@@ -61,7 +122,10 @@ class Object final : public Node {
         }
 
         AABB getBounds() const { return inner; };
+        // Also brings the colliders up to date, anything that moves the object has to call it
         void updateBounds();
+        // Brings the colliders' cached geometry up to date with pos and rotMat, without touching the tree
+        void updateColliders();
         void updateRotMat();
 
         void applyImpulse(Vec2 impulse, Vec2 position) {
@@ -71,9 +135,11 @@ class Object final : public Node {
         }
     
     protected:
-        virtual void updateAABB(const float_type margin) override;
+        virtual AABB fatten(const float_type margin) const override;
 };
 
+enum class ColliderType { Circle, Polygon, Other };
+
 class BaseCollider {
     public:
         BaseCollider(Object *obj) : obj(obj) {
@@ -86,11 +152,24 @@ class BaseCollider {
             return std::pair<Vec2, Vec2>(Vec2(0, 0), Vec2(0, 0));
         }
 
+        virtual ColliderType getType() const { return ColliderType::Other; }
+
+        // Refreshes whatever is cached from the object's position and rotation, see Object::updateColliders
+        virtual void updateTransform() {}
+
         virtual Vec2 support(const Vec2 &direction) const { return ORIGIN; };
         virtual Vec2 globalSupport(const Vec2 &direction) const { 
             return localToGlobal(support(globalToLocalVec(direction))); 
         }
 
+        // World space segment from -> to, hits if it enters the collider within maxFraction of its
+        // length. Segments that start inside don't hit, normal is the outward normal at the entry
+        virtual bool raycast(const Vec2 &from, const Vec2 &to, float_type maxFraction,
+                             float_type &fraction, Vec2 &normal) const { return false; }
+        virtual bool containsPoint(const Vec2 &point) const { return false; }
+
+        Object* getObject() const { return obj; }
+
         Vec2 localToGlobal(const Vec2& point) const {
             return obj->localToGlobal(point);
         }
@@ -118,24 +197,54 @@ class CircleCollider : public BaseCollider {
         CircleCollider(Object *obj, float_type radius)
             : BaseCollider(obj), radius(radius) {}
 
+        ColliderType getType() const override { return ColliderType::Circle; }
+        float_type getRadius() const { return radius; }
+        Vec2 getCentre() const { return obj->pos; }
+
         std::pair<Vec2, Vec2> bounds();
         Vec2 support(const Vec2& direction) const override;
         Vec2 globalSupport(const Vec2& direction) const override;
+
+        bool raycast(const Vec2 &from, const Vec2 &to, float_type maxFraction,
+                     float_type &fraction, Vec2 &normal) const override;
+        bool containsPoint(const Vec2 &point) const override;
 };
 
 class PolyCollider : public BaseCollider {
     private:
         std::vector<Vec2> points;  // Winding must be pre checked
-    public:
-        PolyCollider(Object *obj, std::vector<Vec2> points)
-            : BaseCollider(obj), points(points) {
-            /*centre = ORIGIN;
-            for (const Vec2 point : points) centre = centre + point;
-            centre = centre / points.size();*/
+        std::vector<Vec2> normals;  // Outward normal of the edge from points[i] to points[i + 1]
+        // points and normals in global space as of the last updateTransform
+        std::vector<Vec2> globalPoints, globalNormals;
+
+        // Support points for the local directions (+-1, +-1), indexed by supportHint
+        uint supportHints[4];
+        static uint supportHint(const Vec2 &localDirection) {
+            return (localDirection.x < 0) + 2 * (localDirection.y < 0);
         }
+        uint supportIndex(const std::vector<Vec2> &candidates, const Vec2 &direction, uint start) const;
+
+    public:
+        // Polygons with at least this many points find support points by hill climbing from a hint
+        // instead of checking every point
+        static const uint hillClimbSize = 8;
+
+        PolyCollider(Object *obj, std::vector<Vec2> points);
+
+        ColliderType getType() const override { return ColliderType::Polygon; }
+        const std::vector<Vec2>& getPoints() const { return points; }
+        const std::vector<Vec2>& getNormals() const { return normals; }
+        const std::vector<Vec2>& getGlobalPoints() const { return globalPoints; }
+        const std::vector<Vec2>& getGlobalNormals() const { return globalNormals; }
 
+        void updateTransform() override;
         std::pair<Vec2, Vec2> bounds();
         Vec2 support(const Vec2 &direction) const;
+        Vec2 globalSupport(const Vec2 &direction) const override;
+
+        bool raycast(const Vec2 &from, const Vec2 &to, float_type maxFraction,
+                     float_type &fraction, Vec2 &normal) const override;
+        bool containsPoint(const Vec2 &point) const override;
 };
 
 class BaseConstraint {
@@ -148,6 +257,8 @@ class BaseConstraint {
             : objA(objA), objB(objB), allowCollision(allowCollision) {
             objA->constraints.push_back(this);
             objB->constraints.push_back(this);
+            objA->wake();
+            objB->wake();
             updateMassMatrix();
         }
 
@@ -158,7 +269,20 @@ class BaseConstraint {
         virtual ~BaseConstraint();
         virtual void apply(const float_type baumgarteBias, const float_type slopP,
                         const float_type slopR) {}
+        // Reapplies the impulse accumulated over the last step, scaled by factor
+        virtual void warmStart(const float_type factor) {}
         void updateMassMatrix();
+
+        // Distance between the anchors the joint is meant to hold together, in world units
+        virtual float_type positionError() const { return 0; }
+
+        // Whether apply hands off to code outside the engine, see World::hasCallbacks
+        virtual bool hasCallback() const { return false; }
+
+        // The accumulated impulse as stateSize floats, for World snapshots
+        virtual uint stateSize() const { return 0; }
+        virtual void saveState(float_type *out) const {}
+        virtual void loadState(const float_type *in) {}
 };
 
 struct Collision {
@@ -168,6 +292,12 @@ struct Collision {
     Vec2 localA, localB;
 };
 
+// Contact points between a pair of colliders, deepest first
+struct Manifold {
+    uint count;
+    Collision points[2];
+};
+
 struct ContactPoint {
     Vec2 localA, localB, globalA, globalB, normal;
     Vec6 J, JT;
@@ -194,6 +324,7 @@ class ContactConstraint {
         ~ContactConstraint();
 
         void apply();
+        void warmStart(const float_type factor);
         void updatePoints(const float_type baumgarteBias, const float_type slopP, const float_type slopR, const Vec2& tickGravity);
         void addPoint(Collision col);
         size_t numPoints() { return points.size(); }
@@ -202,6 +333,7 @@ class ContactConstraint {
 class PivotConstraint : public BaseConstraint {
     private:
         const Vec2 localA, localB;
+        Vec2 impulseSum;
 
     public:
         PivotConstraint(Object *objA, Object *objB, Vec2 localA, Vec2 localB)
@@ -209,11 +341,19 @@ class PivotConstraint : public BaseConstraint {
 
         void apply(const float_type baumgarteBias, const float_type slopP,
                 const float_type slopR);
+        void warmStart(const float_type factor);
+
+        float_type positionError() const;
+
+        uint stateSize() const { return 2; }
+        void saveState(float_type *out) const { out[0] = impulseSum.x; out[1] = impulseSum.y; }
+        void loadState(const float_type *in) { impulseSum = Vec2(in[0], in[1]); }
 };
 
 class FixedConstraint : public BaseConstraint {
     private:
         const Vec2 localA, localB;
+        Vec3 impulseSum;
 
     public:
         FixedConstraint(Object *objA, Object *objB, Vec2 localA, Vec2 localB)
@@ -221,11 +361,19 @@ class FixedConstraint : public BaseConstraint {
 
         void apply(const float_type baumgarteBias, const float_type slopP,
                 const float_type slopR);
+        void warmStart(const float_type factor);
+
+        float_type positionError() const;
+
+        uint stateSize() const { return 3; }
+        void saveState(float_type *out) const { out[0] = impulseSum.x; out[1] = impulseSum.y; out[2] = impulseSum.z; }
+        void loadState(const float_type *in) { impulseSum = Vec3(in[0], in[1], in[2]); }
 };
 
 class SliderConstraint : public BaseConstraint {
     private:
         const Vec2 localA, localB, localN;  // normal in A local space
+        Vec2 impulseSum;
     public:
         SliderConstraint(Object *objA, Object *objB, Vec2 localA, Vec2 localB,
                         Vec2 localN)
@@ -236,6 +384,44 @@ class SliderConstraint : public BaseConstraint {
 
         void apply(const float_type baumgarteBias, const float_type slopP,
                 const float_type slopR);
+        void warmStart(const float_type factor);
+
+        float_type positionError() const;
+
+        uint stateSize() const { return 2; }
+        void saveState(float_type *out) const { out[0] = impulseSum.x; out[1] = impulseSum.y; }
+        void loadState(const float_type *in) { impulseSum = Vec2(in[0], in[1]); }
+};
+
+// Drives the velocity of B's anchor relative to A's anchor along a fixed world space normal
+// towards targetVelocity, using no more than maxImpulse either way
+class VelocityConstraint : public BaseConstraint {
+    friend class World;  // Snapshots rebuild controller jumps from the parameters
+
+    private:
+        const Vec2 localA, localB, normal;
+        const float_type targetVelocity, maxImpulse;
+        float_type impulseSum = 0;
+
+        Vec6 jacobian() const;
+
+    public:
+        VelocityConstraint(Object *objA, Object *objB, Vec2 localA, Vec2 localB, Vec2 normal,
+                           float_type targetVelocity, float_type maxImpulse)
+            : BaseConstraint(objA, objB),
+            localA(localA),
+            localB(localB),
+            normal(normal),
+            targetVelocity(targetVelocity),
+            maxImpulse(maxImpulse){};
+
+        void apply(const float_type baumgarteBias, const float_type slopP,
+                const float_type slopR);
+        void warmStart(const float_type factor);
+
+        uint stateSize() const { return 1; }
+        void saveState(float_type *out) const { out[0] = impulseSum; }
+        void loadState(const float_type *in) { impulseSum = in[0]; }
 };
 
 template <typename T>
@@ -253,4 +439,6 @@ class CustomConstraint : public BaseConstraint {
                 const float_type slopR) {
             callback(value, objA, objB);
         }
+
+        bool hasCallback() const override { return true; }
 };
\ No newline at end of file
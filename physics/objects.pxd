@@ -1,10 +1,11 @@
 # distutils: language = c++
 
 from vector cimport Vec2, float_type
-from aabb cimport AABB, Node
+from aabb cimport AABB, Proxy
 
 from libcpp.vector cimport vector
 from libcpp.utility cimport pair
+from libcpp.memory cimport unique_ptr
 from libcpp cimport bool
 
 ctypedef bool (*handler)(Object*, Object*, Vec2, Vec2, Vec2)
@@ -24,6 +25,9 @@ cdef extern from "objects.h":
    cdef cppclass FixedConstraint(BaseConstraint):
       FixedConstraint(Object*, Object*, Vec2, Vec2)
 
+   cdef cppclass VelocityConstraint(BaseConstraint):
+      VelocityConstraint(Object*, Object*, Vec2, Vec2, Vec2, float_type, float_type)
+
    cdef struct ContactPoint:
       Vec2 localA
       Vec2 localB
@@ -62,7 +66,22 @@ cdef extern from "objects.h":
    cdef cppclass PolyCollider(BaseCollider):
       PolyCollider(Object*, vector[Vec2])
 
-   cdef cppclass Object(Node):
+   cdef enum ControllerState "Controller::State":
+      Alive "Controller::State::Alive"
+      Dying "Controller::State::Dying"
+      Dead "Controller::State::Dead"
+
+   cdef cppclass Controller:
+      Vec2 action
+      ControllerState state
+      Object *checkpoint
+
+      Controller()
+      void revive()
+
+   const unsigned long long noSyncId "Object::noSyncId"
+
+   cdef cppclass Object(Proxy):
       float_type friction
       float_type restitution
 
@@ -74,6 +93,17 @@ cdef extern from "objects.h":
       Vec2 pos
       Vec2 vel
       handler collisionHandler
+      bool sensor
+      Vec2 oneWay
+      bool reportCollisions
+      bool lethal
+      bool isCheckpoint
+      unsigned long long syncId
+      bool bullet
+      unique_ptr[Controller] controller
+
+      bool sleeping
+      float_type sleepTime
       
       Object(float_type, float_type, float_type, float_type, handler)
 
@@ -85,6 +115,9 @@ cdef extern from "objects.h":
       float_type getInvMoment()
       float_type getMoment()
 
+      bool isStatic()
+      void wake()
+
       Vec2 globalToLocal(Vec2)
       Vec2 localToGlobal(Vec2)
 
@@ -1,10 +1,16 @@
 #include "physics.h"
 
 #include <algorithm>
+#include <chrono>
 #include <cmath>
+#include <cstring>
 #include <iostream>
+#include <limits>
 #include <list>
+#include <memory>
 #include <optional>
+#include <stdexcept>
+#include <string>
 
 #include "aabb.h"
 #include "util.h"
@@ -81,25 +87,66 @@ Vec2 originToTriangle(const Vec2 &a, const Vec2 &b, const Vec2 &c) {
 
 const Collision nocollision = {-1.0, Vec2(), Vec2(), Vec2()};
 
-Collision evaluateCollision(BaseCollider *a, BaseCollider *b,
-                            Vec2 initialDir) {  // const Vec2& initialAxis) {
+NarrowphaseCounters& NarrowphaseCounters::operator+=(const NarrowphaseCounters &other) {
+    gjkQueries += other.gjkQueries;
+    gjkIterations += other.gjkIterations;
+    epaIterations += other.epaIterations;
+    satQueries += other.satQueries;
+    satCachedExits += other.satCachedExits;
+    ccdQueries += other.ccdQueries;
+    ccdHits += other.ccdHits;
+    for (uint i = 0; i < histogramBuckets; i++) {
+        gjkHistogram[i] += other.gjkHistogram[i];
+        epaHistogram[i] += other.epaHistogram[i];
+    }
+    return *this;
+}
+
+void recordIterations(uint64_t *histogram, uint iterations) {
+    uint bucket = 0;
+    while (bucket + 1 < NarrowphaseCounters::histogramBuckets && (1u << bucket) < iterations) bucket++;
+    histogram[bucket]++;
+}
+
+typedef std::chrono::steady_clock Clock;
+
+// Seconds since start, which is moved up to now so the next phase can be timed from it
+double lap(Clock::time_point &start) {
+    const Clock::time_point now = Clock::now();
+    const double seconds = std::chrono::duration<double>(now - start).count();
+    start = now;
+    return seconds;
+}
+
+// axis seeds the search and is left as the direction that separated the pair, or the normal
+Collision evaluateCollision(BaseCollider *a, BaseCollider *b, Vec2 &axis,
+                            NarrowphaseCounters &counters) {
     CSOResult simplex[3];
 
-    // initialDir = Vec2(0.7, 0.4);
     const float_type epsilon = 0.03 * 0.03;
     // const float_type epsilon2 = 0.001*0.001;
 
+    counters.gjkQueries++;
+
     // GJK
-    simplex[0] = CSOSupport(a, b, initialDir);
-    if (simplex[0].res.dot(initialDir) <= 0) return nocollision;
+    simplex[0] = CSOSupport(a, b, axis);
+    if (simplex[0].res.dot(axis) <= 0) {
+        recordIterations(counters.gjkHistogram, 0);
+        return nocollision;
+    }
 
     Vec2 direction = -simplex[0].res;
 
     unsigned int length = 1;
     unsigned int i;
     for (i = 0; i < 20; i++) {
+        counters.gjkIterations++;
         simplex[length] = CSOSupport(a, b, direction);
-        if (simplex[length].res.dot(direction) <= 0) return nocollision;
+        if (simplex[length].res.dot(direction) <= 0) {
+            recordIterations(counters.gjkHistogram, i + 1);
+            axis = direction;
+            return nocollision;
+        }
 
         if (length == 1) {
             Vec2 d = simplex[0].res - simplex[1].res;
@@ -157,6 +204,7 @@ Collision evaluateCollision(BaseCollider *a, BaseCollider *b,
             }
         }
     }
+    recordIterations(counters.gjkHistogram, std::min(i + 1, 20u));
     if (i == 20) return nocollision;
 
     struct node {
@@ -183,6 +231,7 @@ Collision evaluateCollision(BaseCollider *a, BaseCollider *b,
     node *next;
     node *best;
     for (uint i = 3;; i++) {
+        counters.epaIterations++;
         /*node *current = nodes[0].next;
         best = &nodes[0];
         while (current != &nodes[0]) {
@@ -208,10 +257,14 @@ Collision evaluateCollision(BaseCollider *a, BaseCollider *b,
 
         if ((result.res - next->val.res).length2() < epsilon ||
             (result.res - best->val.res).length2() < epsilon) {
+            recordIterations(counters.epaHistogram, i - 2);
             break;
         }
 
-        if (i == EPA_ITERATIONS + 2) return nocollision;
+        if (i == EPA_ITERATIONS + 2) {
+            recordIterations(counters.epaHistogram, i - 2);
+            return nocollision;
+        }
 
         node *newNode = &nodes[i];
 
@@ -236,6 +289,85 @@ Collision evaluateCollision(BaseCollider *a, BaseCollider *b,
     
     col.localA = a->support(a->globalToLocalVec(pA.src)) * (1 - proportion) + a->support(a->globalToLocalVec(pB.src)) * proportion;
     col.localB = b->support(b->globalToLocalVec(-pA.src)) * (1 - proportion) + b->support(b->globalToLocalVec(-pB.src)) * proportion;
+    axis = col.normal;
+
+#ifdef DEBUG
+    collisions.push_back(a->localToGlobal(col.localA));
+    collisions.push_back(b->localToGlobal(col.localB));
+#endif
+
+    return col;
+}
+
+Collision evaluateCircleCircle(const CircleCollider *a, const CircleCollider *b) {
+    const Vec2 delta = b->getCentre() - a->getCentre();
+    const float_type radii = a->getRadius() + b->getRadius();
+    const float_type dist2 = delta.length2();
+    if (dist2 >= radii * radii) return nocollision;
+
+    const float_type dist = std::sqrt(dist2);
+
+    Collision col;
+    col.penetration = radii - dist;
+    col.normal = dist == 0 ? Vec2(0, 1) : delta / dist;
+    col.localA = a->globalToLocalVec(col.normal * a->getRadius());
+    col.localB = b->globalToLocalVec(-col.normal * b->getRadius());
+
+#ifdef DEBUG
+    collisions.push_back(a->localToGlobal(col.localA));
+    collisions.push_back(b->localToGlobal(col.localB));
+#endif
+
+    return col;
+}
+
+// Normal points from the polygon to the circle
+Collision evaluatePolyCircle(const PolyCollider *a, const CircleCollider *b) {
+    const std::vector<Vec2> &points = a->getPoints();
+    const std::vector<Vec2> &normals = a->getNormals();
+    const float_type radius = b->getRadius();
+    const Vec2 centre = a->globalToLocal(b->getCentre());  // Worked out in the polygon's space
+
+    // Face the centre is furthest in front of
+    uint face = 0;
+    float_type separation = -std::numeric_limits<float_type>::infinity();
+    for (uint i = 0; i < points.size(); i++) {
+        const float_type s = normals[i].dot(centre - points[i]);
+        if (s >= radius) return nocollision;
+        if (s > separation) {
+            separation = s;
+            face = i;
+        }
+    }
+
+    const Vec2 v1 = points[face];
+    const Vec2 v2 = points[(face + 1) % points.size()];
+
+    Vec2 normal = normals[face];
+    float_type dist = separation;  // Distance from the polygon's surface to the centre
+    if (separation > 0) {
+        // Outside the polygon, the closest feature may be one of the face's vertices
+        const Vec2 *vertex = nullptr;
+        if ((centre - v1).dot(v2 - v1) <= 0) {
+            vertex = &v1;
+        } else if ((centre - v2).dot(v1 - v2) <= 0) {
+            vertex = &v2;
+        }
+
+        if (vertex != nullptr) {
+            const Vec2 delta = centre - *vertex;
+            const float_type dist2 = delta.length2();
+            if (dist2 >= radius * radius) return nocollision;
+            dist = std::sqrt(dist2);
+            normal = delta / dist;
+        }
+    }
+
+    Collision col;
+    col.penetration = radius - dist;
+    col.normal = a->localToGlobalVec(normal);
+    col.localA = centre - normal * dist;
+    col.localB = b->globalToLocalVec(-col.normal * radius);
 
 #ifdef DEBUG
     collisions.push_back(a->localToGlobal(col.localA));
@@ -245,6 +377,162 @@ Collision evaluateCollision(BaseCollider *a, BaseCollider *b,
     return col;
 }
 
+// Greatest separation of b's vertices in front of one of a's faces, all in global space
+static float_type findMaxSeparation(const std::vector<Vec2> &pointsA, const std::vector<Vec2> &normalsA,
+                                    const std::vector<Vec2> &pointsB, uint &face) {
+    float_type maxSeparation = -std::numeric_limits<float_type>::infinity();
+    for (uint i = 0; i < pointsA.size(); i++) {
+        float_type separation = std::numeric_limits<float_type>::infinity();
+        for (const Vec2 &point : pointsB) {
+            separation = std::min(separation, normalsA[i].dot(point - pointsA[i]));
+        }
+        if (separation > maxSeparation) {
+            maxSeparation = separation;
+            face = i;
+        }
+    }
+    return maxSeparation;
+}
+
+// Keeps the part of the segment where normal.dot(point) <= offset
+static uint clipSegment(Vec2 out[2], const Vec2 in[2], const Vec2 &normal, float_type offset) {
+    const float_type dist0 = normal.dot(in[0]) - offset;
+    const float_type dist1 = normal.dot(in[1]) - offset;
+
+    uint count = 0;
+    if (dist0 <= 0) out[count++] = in[0];
+    if (dist1 <= 0) out[count++] = in[1];
+    if (dist0 * dist1 < 0) out[count++] = in[0] + (in[1] - in[0]) * (dist0 / (dist0 - dist1));
+    return count;
+}
+
+// Whether the given face of ref has all of other in front of it
+static bool faceSeparates(const PolyCollider *ref, uint face, const PolyCollider *other) {
+    const Vec2 normal = ref->getGlobalNormals()[face];
+    const Vec2 origin = ref->getGlobalPoints()[face];
+    for (const Vec2 &point : other->getGlobalPoints()) {
+        if (normal.dot(point - origin) < 0) return false;
+    }
+    return true;
+}
+
+// SAT to find the reference face, then the most opposed face of the other polygon is clipped to it.
+// Separated pairs usually stay separated by the same face, so that is tried before the full test
+Manifold evaluatePolyPoly(const PolyCollider *a, const PolyCollider *b, SeparatingAxis &cache,
+                          NarrowphaseCounters &counters) {
+    // A is preferred as the reference so it doesn't flip between steps when both are about equal
+    const float_type referenceTolerance = 0.03;
+
+    Manifold manifold;
+    manifold.count = 0;
+
+    counters.satQueries++;
+    if (cache.face >= 0) {
+        const PolyCollider *ref = cache.faceOnB ? b : a;
+        const PolyCollider *other = cache.faceOnB ? a : b;
+        if ((uint)cache.face < ref->getPoints().size() && faceSeparates(ref, cache.face, other)) {
+            counters.satCachedExits++;
+            return manifold;
+        }
+    }
+
+    const std::vector<Vec2> &pointsA = a->getGlobalPoints(), &normalsA = a->getGlobalNormals();
+    const std::vector<Vec2> &pointsB = b->getGlobalPoints(), &normalsB = b->getGlobalNormals();
+
+    uint faceA = 0, faceB = 0;
+    const float_type separationA = findMaxSeparation(pointsA, normalsA, pointsB, faceA);
+    if (separationA >= 0) {
+        cache.face = faceA;
+        cache.faceOnB = false;
+        return manifold;
+    }
+    const float_type separationB = findMaxSeparation(pointsB, normalsB, pointsA, faceB);
+    if (separationB >= 0) {
+        cache.face = faceB;
+        cache.faceOnB = true;
+        return manifold;
+    }
+
+    const bool flip = separationB > separationA + referenceTolerance;
+    cache.face = flip ? faceB : faceA;
+    cache.faceOnB = flip;
+    const std::vector<Vec2> &refPoints = flip ? pointsB : pointsA;
+    const std::vector<Vec2> &incPoints = flip ? pointsA : pointsB;
+    const std::vector<Vec2> &incNormals = flip ? normalsA : normalsB;
+    const uint refFace = flip ? faceB : faceA;
+    const Vec2 normal = flip ? normalsB[faceB] : normalsA[faceA];
+
+    uint incFace = 0;
+    float_type minDot = std::numeric_limits<float_type>::infinity();
+    for (uint i = 0; i < incNormals.size(); i++) {
+        const float_type dot = normal.dot(incNormals[i]);
+        if (dot < minDot) {
+            minDot = dot;
+            incFace = i;
+        }
+    }
+
+    const Vec2 v1 = refPoints[refFace];
+    const Vec2 v2 = refPoints[(refFace + 1) % refPoints.size()];
+    const Vec2 tangent = (v2 - v1).normalised();
+
+    const Vec2 incident[2] = {incPoints[incFace], incPoints[(incFace + 1) % incPoints.size()]};
+    Vec2 clipped1[2], clipped2[2];
+    if (clipSegment(clipped1, incident, -tangent, -tangent.dot(v1)) < 2) return manifold;
+    if (clipSegment(clipped2, clipped1, tangent, tangent.dot(v2)) < 2) return manifold;
+
+    for (const Vec2 &point : clipped2) {
+        const float_type separation = normal.dot(point - v1);
+        if (separation >= 0) continue;
+
+        const Vec2 refPoint = point - normal * separation;  // Projected onto the reference face
+
+        Collision &col = manifold.points[manifold.count++];
+        col.penetration = -separation;
+        col.normal = flip ? -normal : normal;
+        col.localA = a->globalToLocal(flip ? point : refPoint);
+        col.localB = b->globalToLocal(flip ? refPoint : point);
+
+#ifdef DEBUG
+        collisions.push_back(a->localToGlobal(col.localA));
+        collisions.push_back(b->localToGlobal(col.localB));
+#endif
+    }
+    if (manifold.count == 2 && manifold.points[1].penetration > manifold.points[0].penetration) {
+        std::swap(manifold.points[0], manifold.points[1]);
+    }
+    return manifold;
+}
+
+// Uses a closed form where there is one, GJK + EPA otherwise
+Manifold evaluateManifold(BaseCollider *a, BaseCollider *b, SeparatingAxis &cache,
+                          NarrowphaseCounters &counters) {
+    const ColliderType typeA = a->getType();
+    const ColliderType typeB = b->getType();
+
+    if (typeA == ColliderType::Polygon && typeB == ColliderType::Polygon) {
+        return evaluatePolyPoly(static_cast<PolyCollider*>(a), static_cast<PolyCollider*>(b), cache, counters);
+    }
+
+    Collision col;
+    if (typeA == ColliderType::Circle && typeB == ColliderType::Circle) {
+        col = evaluateCircleCircle(static_cast<CircleCollider*>(a), static_cast<CircleCollider*>(b));
+    } else if (typeA == ColliderType::Polygon && typeB == ColliderType::Circle) {
+        col = evaluatePolyCircle(static_cast<PolyCollider*>(a), static_cast<CircleCollider*>(b));
+    } else if (typeA == ColliderType::Circle && typeB == ColliderType::Polygon) {
+        col = evaluatePolyCircle(static_cast<PolyCollider*>(b), static_cast<CircleCollider*>(a));
+        col.normal = -col.normal;
+        std::swap(col.localA, col.localB);
+    } else {
+        col = evaluateCollision(a, b, cache.direction, counters);
+    }
+
+    Manifold manifold;
+    manifold.count = col.penetration < 0 ? 0 : 1;
+    manifold.points[0] = col;
+    return manifold;
+}
+
 bool originInTriangle(const Vec2 &a, const Vec2 &b, const Vec2 &c) {
     Vec2 ab = b - a;
     Vec2 bc = c - b;
@@ -260,22 +548,169 @@ bool originInTriangle(const Vec2 &a, const Vec2 &b, const Vec2 &c) {
     return true;
 }
 
+// Circles are swept as their centre plus a radius, GJK converges slowly on round shapes
+static Vec2 coreSupport(const BaseCollider *collider, const Vec2 &direction) {
+    if (collider->getType() == ColliderType::Circle) return static_cast<const CircleCollider*>(collider)->getCentre();
+    return collider->globalSupport(direction);
+}
+
+static float_type coreRadius(const BaseCollider *collider) {
+    if (collider->getType() == ColliderType::Circle) return static_cast<const CircleCollider*>(collider)->getRadius();
+    return 0;
+}
+
+// Reduces the segment simplex[0], simplex[1] to the part nearest the origin and returns that point
+static Vec2 reduceSegment(Vec2 *simplex, uint &length) {
+    const Vec2 d = simplex[1] - simplex[0];
+    const float_type m = d.length2();
+    const float_type v = -simplex[0].dot(d);
+    if (v <= 0) {
+        length = 1;
+        return simplex[0];
+    }
+    if (v >= m) {
+        simplex[0] = simplex[1];
+        length = 1;
+        return simplex[0];
+    }
+    return simplex[0] + d * (v / m);
+}
+
+// GJK distance between the two colliders at their objects' current transforms, negative when
+// the circles' radii overlap and 0 when the cores do. normal points from A towards B
+static float_type colliderDistance(const BaseCollider *a, const BaseCollider *b, Vec2 &normal) {
+    auto support = [a, b](const Vec2 &direction) {
+        return coreSupport(a, direction) - coreSupport(b, -direction);
+    };
+    const float_type radii = coreRadius(a) + coreRadius(b);
+
+    Vec2 simplex[3];
+    uint length = 1;
+    simplex[0] = support(Vec2(1, 0));
+    Vec2 closest = simplex[0];  // Point of the difference (A - B) nearest the origin
+    for (uint i = 0; i < 32; i++) {
+        const float_type closest2 = closest.length2();
+        if (closest2 == 0) return 0;
+
+        const Vec2 point = support(-closest);
+        if (closest2 - closest.dot(point) <= closest2 * 1e-4) break;  // No closer point to find
+        simplex[length++] = point;
+
+        if (length == 2) {
+            closest = reduceSegment(simplex, length);
+            continue;
+        }
+        if (originInTriangle(simplex[0], simplex[1], simplex[2])) return 0;
+
+        // Keep whichever edge is nearest
+        float_type best = std::numeric_limits<float_type>::infinity();
+        Vec2 bestSimplex[2];
+        uint bestLength = 0;
+        for (uint edge = 0; edge < 3; edge++) {
+            Vec2 candidate[2] = {simplex[edge], simplex[(edge + 1) % 3]};
+            uint candidateLength = 2;
+            const Vec2 nearest = reduceSegment(candidate, candidateLength);
+            if (nearest.length2() < best) {
+                best = nearest.length2();
+                closest = nearest;
+                bestSimplex[0] = candidate[0];
+                bestSimplex[1] = candidate[1];
+                bestLength = candidateLength;
+            }
+        }
+        simplex[0] = bestSimplex[0];
+        simplex[1] = bestSimplex[1];
+        length = bestLength;
+    }
+
+    const float_type distance = closest.length();
+    normal = closest * (-1 / distance);
+    return distance - radii;
+}
+
+// Furthest any point can be from the object's position, circles are left out as turning doesn't move them
+static float_type turningRadius(const Object *obj) {
+    float_type radius = 0;
+    for (const BaseCollider *collider : obj->colliders) {
+        if (collider->getType() != ColliderType::Polygon) continue;
+        for (const Vec2 &point : static_cast<const PolyCollider*>(collider)->getPoints()) {
+            radius = std::max(radius, point.length());
+        }
+    }
+    return radius;
+}
+
+// Moves the object to where it'll be after time along its current velocity, without telling the tree
+static void placeAt(Object *obj, const Vec2 &pos, float_type rot, float_type time) {
+    obj->pos = pos + obj->vel * time;
+    obj->rot = rot + obj->rotV * time;
+    obj->updateRotMat();
+    obj->updateColliders();
+}
+
+// Conservative advancement: both objects keep their velocities, each iteration moves time forward
+// by as much as the gap allows given how fast any of their points could be closing it. Returns when
+// the colliders come within tolerance, or maxTime if they don't in time. Colliders that start
+// within tolerance are left to their contact. The objects are put back where they were
+static float_type timeOfImpact(const BaseCollider *colliderA, const BaseCollider *colliderB, Object *a, Object *b,
+                               float_type maxTime, float_type tolerance) {
+    const Vec2 posA = a->pos, posB = b->pos;
+    const float_type rotA = a->rot, rotB = b->rot;
+    const float_type angularBound = std::abs(a->rotV) * turningRadius(a) + std::abs(b->rotV) * turningRadius(b);
+
+    float_type time = 0;
+    float_type result = maxTime;
+    for (uint i = 0; i < 20; i++) {
+        Vec2 normal;
+        const float_type distance = colliderDistance(colliderA, colliderB, normal);
+        if (distance <= tolerance) {
+            if (i != 0) result = time;
+            break;
+        }
+
+        // The distance is convex in time without rotation, so once they stop approaching they never will
+        const float_type approach = (a->vel - b->vel).dot(normal) + angularBound;
+        if (approach <= 0) break;
+        time += distance / approach;
+        if (time >= maxTime) break;
+
+        placeAt(a, posA, rotA, time);
+        placeAt(b, posB, rotB, time);
+    }
+
+    placeAt(a, posA, rotA, 0);
+    placeAt(b, posB, rotB, 0);
+    return result;
+}
+
 // f(x,0) = 0, f(x,y) = f(y,x), f(x,x) = x
 float_type combineProperties(float_type a, float_type b) { return sqrt(a * b); }
 
-void World::resolveCollision(Object *a, Object *b, const Collision &col) {
+void World::resolveCollision(Object *a, Object *b, const Manifold &manifold) {
+    // Only called for pairs with an active object, so a sleeping one is being touched
+    if (a->sleeping && !a->isStatic()) a->wake();
+    if (b->sleeping && !b->isStatic()) b->wake();
+
+    // Handlers and events see the deepest point only, once per collider pair
+    const Collision &col = manifold.points[0];
+    if (a->reportCollisions || b->reportCollisions) {
+        collisionEvents.push_back({a, b, col.normal, col.localA, col.localB, 0});
+    }
+
+    stats.collisionHandlerCalls += (a->collisionHandler != nullptr) + (b->collisionHandler != nullptr);
     bool resA = a->collisionHandler != nullptr &&
                 a->collisionHandler(a, b, -col.normal, col.localA, col.localB);
     bool resB =
         b->collisionHandler != nullptr && b->collisionHandler(b, a, col.normal, col.localB, col.localA);
-    if (resA || resB) return;
-
-    try {
-        contactConstraints.at({a,b}).addPoint(col);
-    } catch (std::out_of_range&) {
-        ContactConstraint newConstraint = ContactConstraint(a, b, combineProperties(a->friction, b->friction), combineProperties(a->restitution, b->restitution));
-        newConstraint.addPoint(col);
-        contactConstraints[{a,b}] = newConstraint;
+    // A jump takes the place of the contact with the ground
+    bool jumpA = a->controller && controllerCollision(a, b, -col.normal, col.localA, col.localB);
+    bool jumpB = b->controller && controllerCollision(b, a, col.normal, col.localB, col.localA);
+    if (resA || resB || jumpA || jumpB || a->sensor || b->sensor) return;
+    if (a->passedBy(b) || b->passedBy(a)) return;
+
+    ContactConstraint &contact = findContact(a, b);
+    for (uint i = 0; i < manifold.count; i++) {
+        contact.addPoint(manifold.points[i]);
     }
     
     /*ContactConstraint *emptyConstraint = nullptr;
@@ -299,123 +734,973 @@ void World::resolveCollision(Object *a, Object *b, const Collision &col) {
     }*/
 }
 
+// Normal points from other towards obj, returns true if a jump was started
+bool World::controllerCollision(Object *obj, Object *other, Vec2 normal, Vec2 local, Vec2 otherLocal) {
+    Controller &controller = *obj->controller;
+    if (other->lethal && controller.state == Controller::State::Alive) {
+        controller.state = Controller::State::Dying;
+        controller.dyingTime = 0;
+    }
+    if (other->isCheckpoint) controller.checkpoint = other;
+
+    if (controller.jump != nullptr || !controller.wantsJump() ||
+        normal.dot(gravity.normalised()) >= -Controller::jumpThreshold) {
+        return false;
+    }
+
+    // Other's anchor is driven away from obj's, so heavy or static ground throws obj upwards
+    const float_type speed = Controller::jumpSpeed * -controller.action.y;
+    controller.jump = new VelocityConstraint(obj, other, local, otherLocal, normal, -speed,
+                                             obj->getMass() * speed * 2);
+    controller.jumpTime = 0;
+    return true;
+}
+
+void World::kill(Object *obj) {
+    obj->controller->removeJump();
+    obj->controller->state = Controller::State::Dead;
+    deaths.push_back(obj);
+}
+
+void World::updateControllers(float_type stepSize) {
+    const std::vector<Object *> &order = stepObjects();
+    // Falling past the lowest corner of the tree along gravity can never be recovered from
+    bool bounded = false;
+    AABB bounds;
+    if (deterministic) {
+        // Fat bounds depend on the tree's history, so they're rebuilt from the inner bounds
+        for (Object *obj : order) {
+            const AABB fat = obj->getInner().expand(tree.margin);
+            bounds = bounded ? bounds.mkUnion(fat) : fat;
+            bounded = true;
+        }
+    } else {
+        for (bool staticTree : {false, true}) {
+            const int root = tree.getRoot(staticTree);
+            if (root == NULL_NODE) continue;
+            bounds = bounded ? bounds.mkUnion(tree.getNode(root).aabb) : tree.getNode(root).aabb;
+            bounded = true;
+        }
+    }
+    const Vec2 lowest(gravity.x > 0 ? bounds.upper.x : bounds.lower.x,
+                      gravity.y > 0 ? bounds.upper.y : bounds.lower.y);
+
+    // Timers are compared half a step early so float error can't add a whole extra step
+    const float_type tolerance = stepSize * 0.5;
+    for (Object *obj : order) {
+        if (!obj->controller) continue;
+        Controller &controller = *obj->controller;
+
+        if (controller.jump != nullptr) {
+            controller.jumpTime += stepSize;
+            if (controller.jumpTime + tolerance >= Controller::jumpDuration) controller.removeJump();
+        }
+
+        if (controller.state == Controller::State::Dead) continue;
+        if (controller.state == Controller::State::Dying) {
+            controller.dyingTime += stepSize;
+            if (controller.dyingTime + tolerance >= Controller::deathDelay) kill(obj);
+            continue;
+        }
+        if (bounded && lowest.dot(gravity) < obj->pos.dot(gravity) + obj->vel.dot(gravity) * 0.5) {
+            kill(obj);
+            continue;
+        }
+
+        if (controller.wantsJump()) obj->wake();  // Sleeping pairs aren't collided, so it would never find the ground
+        if (controller.action == ORIGIN) continue;
+
+        // Rolling adds to the rotational energy, braking takes from it until the spin reverses
+        const bool braking = controller.action.y > 0;
+        const float_type before = obj->rotV;
+        float_type roll = braking ? (before > 0 ? -1 : 1) : controller.action.x;
+        roll *= Controller::rollAcceleration * stepSize;
+
+        const float_type energy = std::abs(before) * before + roll;
+        float_type rotV = std::sqrt(std::abs(energy)) * (energy > 0 ? 1 : -1);
+        if (braking && (rotV > 0) != (before > 0)) rotV = 0;
+
+        // Energy barely changes the speed near zero, so slow balls get the roll directly
+        const float_type limit = std::abs(rotV) > Controller::assistSpeed ? std::abs(rotV) : Controller::assistSpeed;
+        if (std::abs(rotV + roll) < limit) rotV += roll;
+
+        if (rotV != before) {
+            obj->wake();
+            obj->rotV = rotV;
+        }
+    }
+}
+
+// Searches whichever object has fewer contacts, making a new contact if there isn't one yet
+ContactConstraint& World::findContact(Object *a, Object *b) {
+    const Object *fewer = a->contacts.size() <= b->contacts.size() ? a : b;
+    for (uint index : fewer->contacts) {
+        if (contacts[index].objA == a && contacts[index].objB == b) return contacts[index];
+    }
+
+    const uint index = contacts.size();
+    contacts.emplace_back(a, b, combineProperties(a->friction, b->friction), combineProperties(a->restitution, b->restitution));
+    a->contacts.push_back(index);
+    b->contacts.push_back(index);
+    return contacts.back();
+}
+
+const ContactConstraint* World::lookupContact(Object *a, Object *b) const {
+    const Object *fewer = a->contacts.size() <= b->contacts.size() ? a : b;
+    for (uint index : fewer->contacts) {
+        if (contacts[index].objA == a && contacts[index].objB == b) return &contacts[index];
+    }
+    return nullptr;
+}
+
+static void replaceContactIndex(Object *obj, uint from, uint to) {
+    *std::find(obj->contacts.begin(), obj->contacts.end(), from) = to;
+}
+
+static void removeContactIndex(Object *obj, uint index) {
+    auto iter = std::find(obj->contacts.begin(), obj->contacts.end(), index);
+    *iter = obj->contacts.back();
+    obj->contacts.pop_back();
+}
+
+// The last contact is moved into the gap, so only the objects involved are touched
+void World::removeContact(uint index) {
+    removeContactIndex(contacts[index].objA, index);
+    removeContactIndex(contacts[index].objB, index);
+
+    const uint last = contacts.size() - 1;
+    if (index != last) {
+        contacts[index] = std::move(contacts[last]);
+        replaceContactIndex(contacts[index].objA, last, index);
+        replaceContactIndex(contacts[index].objB, last, index);
+    }
+    contacts.pop_back();
+}
+
+void World::removeEmptyContacts() {
+    for (uint i = contacts.size(); i-- > 0;) {
+        if (contacts[i].points.size() == 0) removeContact(i);
+    }
+}
+
+static bool syncIdLess(const Object *a, const Object *b) {
+    return a->syncId < b->syncId;
+}
+
+// Removing contacts shuffles them, so a deterministic world puts them back in pair order
+void World::sortContacts() {
+    auto contactLess = [](const ContactConstraint &a, const ContactConstraint &b) {
+        if (a.objA->syncId != b.objA->syncId) return a.objA->syncId < b.objA->syncId;
+        return a.objB->syncId < b.objB->syncId;
+    };
+    if (std::is_sorted(contacts.begin(), contacts.end(), contactLess)) return;
+
+    std::sort(contacts.begin(), contacts.end(), contactLess);
+    for (const ContactConstraint &contact : contacts) {
+        contact.objA->contacts.clear();
+        contact.objB->contacts.clear();
+    }
+    for (uint i = 0; i < contacts.size(); i++) {
+        contacts[i].objA->contacts.push_back(i);
+        contacts[i].objB->contacts.push_back(i);
+    }
+}
+
+static bool jointPreventsCollision(const Object *a, const Object *b) {
+    return std::any_of(a->constraints.begin(), a->constraints.end(), [b](const BaseConstraint *c) {
+        return !c->allowCollision && (c->objA == b || c->objB == b);
+    });
+}
+
 std::vector<std::pair<Object *, Object *>> World::broadphase() {
     /*for (std::pair<Node *, Object *> pair : nodeMap) {
         const std::pair<Vec2, Vec2> bounds = pair.second->getBounds();
         pair.first->inner = AABB(bounds.second, bounds.first);
     }*/
 
+    Clock::time_point start = Clock::now();
     tree.update();
+    stats.treeTime += lap(start);
 
     // std::cout << objects.size() << std::endl;
 
     std::vector<std::pair<Object *, Object *>> result;
     for (auto& pair : tree.computePairs()) {
-        Object *objA = reinterpret_cast<Object*>(pair.first); //nodeMap.at(pair.first);
-        Object *objB = reinterpret_cast<Object*>(pair.second); //nodeMap.at(pair.second);
+        Object *objA = static_cast<Object*>(pair.first);
+        Object *objB = static_cast<Object*>(pair.second);
 
-        if (objA->getInvMass() == 0 && objB->getInvMass() == 0 &&
-            objA->getInvMoment() == 0 && objB->getInvMoment() == 0)
+        if (objA->sleeping && objB->sleeping)
             continue;
-        if (std::any_of(objA->constraints.begin(), objA->constraints.end(),
-                        [objB](BaseConstraint *c) {
-                            return !c->allowCollision &&
-                                   (c->objA == objB || c->objB == objB);
-                        }))
+        if (jointPreventsCollision(objA, objB))
             continue;
+        if (deterministic && syncIdLess(objB, objA)) std::swap(objA, objB);
         result.emplace_back(objA, objB);
     }
 
+    // The tree's pair order depends on where leaves ended up, which peers don't share
+    if (deterministic) {
+        std::sort(result.begin(), result.end(), [](const std::pair<Object *, Object *> &a,
+                                                   const std::pair<Object *, Object *> &b) {
+            if (a.first->syncId != b.first->syncId) return a.first->syncId < b.first->syncId;
+            return a.second->syncId < b.second->syncId;
+        });
+    }
+
+    stats.pairTime += lap(start);
+    stats.pairs += result.size();
     return result;
 }
 
-void World::update(float_type stepSize) {
+void World::narrowphase(const std::vector<std::pair<Object *, Object *>> &pairs) {
+    const uint pairsPerChunk = 32;
+    uint threads = narrowphaseThreads;
 #ifdef DEBUG
-    collisions.clear();
+    threads = 1;  // Debug collision list isn't thread safe
 #endif
-    for (auto& potential : broadphase()) {
-        const Object *a = potential.first;
-        const Object *b = potential.second;
-
-        Vec2 initialDir = Vec2(0.7, 0.4);  // b->pos - a->pos;
-
-        for (BaseCollider *colliderA : a->colliders) {
-            for (BaseCollider *colliderB : b->colliders) {
-                Collision col =
-                    evaluateCollision(colliderA, colliderB, initialDir);
-                if (col.penetration < 0) continue;
-                resolveCollision(potential.first, potential.second, col);
+    if (pairs.size() < pairsPerChunk * 2) threads = 1;
+
+    if (threads <= 1) {
+        pool.reset();
+    } else if (!pool || pool->size() != threads) {
+        pool = std::make_unique<ThreadPool>(threads);
+    }
+
+    uint chunks = threads <= 1 ? 1 : (pairs.size() + pairsPerChunk - 1) / pairsPerChunk;
+    if (narrowphaseChunks.size() < chunks) narrowphaseChunks.resize(chunks);
+
+    const uint64_t step = ++narrowphaseStep;
+
+    // Chunks cover consecutive pairs, so reading them back in chunk order matches a serial run.
+    // The axis cache is only read by the threads, each collider pair belongs to one chunk so its
+    // entry can be updated in place, new entries wait until the threads are done
+    auto evaluateChunk = [&](size_t chunk) {
+        NarrowphaseChunk &out = narrowphaseChunks[chunk];
+        out.results.clear();
+        out.newAxes.clear();
+        out.counters = NarrowphaseCounters();
+
+        size_t begin = chunk * pairsPerChunk;
+        size_t end = chunks == 1 ? pairs.size() : std::min(begin + pairsPerChunk, pairs.size());
+        for (size_t i = begin; i < end; i++) {
+            const Object *a = pairs[i].first;
+            const Object *b = pairs[i].second;
+
+            for (BaseCollider *colliderA : a->colliders) {
+                for (BaseCollider *colliderB : b->colliders) {
+                    if (deterministic) {
+                        // What was cached depends on which pairs this peer happened to test before
+                        SeparatingAxis axis;
+                        Manifold manifold = evaluateManifold(colliderA, colliderB, axis, out.counters);
+                        if (manifold.count != 0) out.results.push_back({(uint)i, manifold});
+                        continue;
+                    }
+
+                    const ColliderPair key(colliderA, colliderB);
+                    auto iter = axisCache.find(key);
+
+                    SeparatingAxis newAxis;
+                    SeparatingAxis &axis = iter == axisCache.end() ? newAxis : iter->second;
+                    axis.lastStep = step;
+
+                    Manifold manifold =
+                        evaluateManifold(colliderA, colliderB, axis, out.counters);
+                    if (iter == axisCache.end()) out.newAxes.emplace_back(key, newAxis);
+
+                    if (manifold.count == 0) continue;
+                    out.results.push_back({(uint)i, manifold});
+                }
             }
         }
+    };
+
+    if (chunks == 1) {
+        evaluateChunk(0);
+    } else {
+        pool->run(chunks, evaluateChunk);
     }
 
+    for (uint chunk = 0; chunk < chunks; chunk++) {
+        for (const auto &entry : narrowphaseChunks[chunk].newAxes) axisCache.insert(entry);
+        narrowphaseCounters += narrowphaseChunks[chunk].counters;
+        stats.narrowphase += narrowphaseChunks[chunk].counters;
+    }
+    // Pairs that weren't tested this step have drifted apart or are asleep, a stale hint is worthless
+    for (auto iter = axisCache.begin(); iter != axisCache.end();) {
+        if (iter->second.lastStep != step) {
+            iter = axisCache.erase(iter);
+        } else {
+            iter++;
+        }
+    }
+
+    // Collision handlers may call back into Python, so they only run here on the calling thread
+    for (uint chunk = 0; chunk < chunks; chunk++) {
+        for (const PairCollision &result : narrowphaseChunks[chunk].results) {
+            resolveCollision(pairs[result.pair].first, pairs[result.pair].second, result.manifold);
+        }
+    }
+}
+
+void World::update(float_type stepSize) {
+    const Clock::time_point stepStart = Clock::now();
+    if (deterministic) {
+        sortedObjects = objects;
+        std::sort(sortedObjects.begin(), sortedObjects.end(), syncIdLess);
+    }
+    const std::vector<Object *> &order = stepObjects();
+#ifdef DEBUG
+    collisions.clear();
+#endif
+    const size_t firstEvent = collisionEvents.size();
+    updateControllers(stepSize);
+    const std::vector<std::pair<Object *, Object *>> pairs = broadphase();
+    Clock::time_point start = Clock::now();
+    narrowphase(pairs);
+    stats.narrowphaseTime += lap(start);
+
     float_type adjustedBaumgarteBias = baumgarteBias / stepSize;
     Vec2 tickGravity = gravity * stepSize;
 
-    for (auto& entry : contactConstraints)
-        entry.second.updatePoints(adjustedBaumgarteBias, slopP, slopR, tickGravity);
-
+    for (ContactConstraint &contact : contacts) {
+        Object *a = contact.objA;
+        Object *b = contact.objB;
+        if (a->sleeping == b->sleeping || contact.points.size() == 0) continue;
+        if (a->sleeping && !a->isStatic()) a->wake();
+        if (b->sleeping && !b->isStatic()) b->wake();
+    }
 
-    for (auto& entry : contactConstraints) {
-        auto V = get_velocity_vector(*entry.second.objA, *entry.second.objB);
-        auto M = get_inverse_mass_matrix(*entry.second.objA, *entry.second.objB);
-        for (auto& point : entry.second.points) {
-            V += apply_constraint(point.J, M, point.nImpulseSum);
+    for (ContactConstraint &contact : contacts) {
+        if (contact.objA->sleeping && contact.objB->sleeping) continue;
+        contact.updatePoints(adjustedBaumgarteBias, slopP, slopR, tickGravity);
+    }
+    removeEmptyContacts();
+    if (deterministic) sortContacts();
+
+    // Impulses scale with the step, so last step's are rescaled when the step size changes
+    const float_type warmStart = warmStartFactor * (lastStepSize > 0 ? stepSize / lastStepSize : 1);
+    lastStepSize = stepSize;
+    for (Object *obj : order) {
+        obj->warmStartConstraints(warmStart);
+        for (BaseConstraint *constraint : obj->constraints) {
+            // Applied once per solver iteration, the same as Object::updateConstraints
+            if (obj == constraint->objB || !constraint->hasCallback()) continue;
+            if (constraint->objA->sleeping && constraint->objB->sleeping) continue;
+            stats.constraintCallbacks += solverSteps;
         }
-        set_velocity(*entry.second.objA, *entry.second.objB, V);
+    }
+    for (ContactConstraint &contact : contacts) {
+        if (contact.objA->sleeping && contact.objB->sleeping) continue;
+        contact.warmStart(warmStart);
+        stats.contacts++;
+        stats.contactPoints += contact.points.size();
     }
     
+    solveContacts(adjustedBaumgarteBias);
+
+    for (size_t i = firstEvent; i < collisionEvents.size(); i++) {
+        CollisionEvent &event = collisionEvents[i];
+        const ContactConstraint *contact = lookupContact(event.objA, event.objB);
+        if (contact == nullptr) continue;
+        for (const ContactPoint &point : contact->points) event.impulse += point.nImpulseSum;
+    }
+    stats.solverTime += lap(start);
+
+    updateSleep(stepSize);
+    stats.islandTime += lap(start);
+
+    limitFastObjects(stepSize);
+    for (size_t i = 0; i < order.size(); i++) {
+        Object *obj = order[i];
+        if (obj->sleeping) continue;
+        obj->update(stepTimes[i]);
+        if (obj->getInvMass() != 0) {
+            obj->vel += tickGravity;
+        }
+        stats.awakeObjects++;
+    }
+    stats.integrateTime += lap(start);
+
+    stats.totalTime += std::chrono::duration<double>(Clock::now() - stepStart).count();
+    stats.steps++;
+}
+
+void World::solveContacts(float_type baumgarteBias) {
+    const std::vector<Object *> &order = stepObjects();
+    if (!useBatchedSolver) {
+        for (int j = 0; j < solverSteps; j++) {
+            for (Object *obj : order)
+                obj->updateConstraints(baumgarteBias, slopP, slopR);
+            for (ContactConstraint &contact : contacts) {
+                if (contact.objA->sleeping && contact.objB->sleeping) continue;
+                contact.apply();
+            }
+        }
+        return;
+    }
+
+    std::vector<ContactConstraint*> active;
+    for (ContactConstraint &contact : contacts) {
+        if (contact.objA->sleeping && contact.objB->sleeping) continue;
+        active.push_back(&contact);
+    }
+    const bool hasJoints = std::any_of(order.begin(), order.end(),
+                                       [](Object *obj) { return !obj->constraints.empty(); });
+
+    batchedSolver.prepare(active);
     for (int j = 0; j < solverSteps; j++) {
-        for (Object *obj : objects)
-            obj->updateConstraints(adjustedBaumgarteBias, slopP, slopR);
-        for (auto& entry : contactConstraints) {
-            if (entry.second.points.size() != 0) {
-                entry.second.apply();
+        // Joints work on the objects directly, so velocities have to be synced around them
+        if (hasJoints) {
+            batchedSolver.storeVelocities();
+            for (Object *obj : order)
+                obj->updateConstraints(baumgarteBias, slopP, slopR);
+            batchedSolver.loadVelocities();
+        }
+        batchedSolver.solve();
+    }
+    batchedSolver.finish();
+}
+
+// Fills stepTimes, shortening the step of anything fast enough to pass through what's in its way
+void World::limitFastObjects(float_type stepSize) {
+    const std::vector<Object *> &order = stepObjects();
+    stepTimes.assign(order.size(), stepSize);
+    if (!ccdEnabled) return;
+
+    const float_type tolerance = slopP * 0.25;
+    for (size_t i = 0; i < order.size(); i++) {
+        Object *obj = order[i];
+        if (obj->sleeping || obj->isStatic() || obj->sensor || obj->isOneWay() || obj->collisionHandler != nullptr) continue;
+
+        const AABB inner = obj->getInner();
+        const Vec2 motion = obj->vel * stepSize;
+        if (!obj->bullet) {
+            const float_type limit = ccdThreshold * 0.5 *
+                std::min(inner.upper.x - inner.lower.x, inner.upper.y - inner.lower.y);
+            if (motion.length2() <= limit * limit) continue;
+        }
+        narrowphaseCounters.ccdQueries++;
+        stats.narrowphase.ccdQueries++;
+
+        const float_type turning = turningRadius(obj);
+        const AABB swept = inner.mkUnion(AABB(inner.upper + motion, inner.lower + motion))
+                               .expand(std::abs(obj->rotV) * stepSize * turning);
+        ccdCandidates.clear();
+        tree.queryBounds(swept, ccdCandidates);
+
+        // Handlers, sensors and one way objects can turn a collision down, so there's no telling
+        // whether to stop for them
+        float_type time = stepSize;
+        for (Proxy *proxy : ccdCandidates) {
+            Object *other = static_cast<Object *>(proxy);
+            if (other == obj || other->sensor || other->isOneWay() || other->collisionHandler != nullptr) continue;
+            if (!obj->bullet && !other->isStatic()) continue;
+            if (jointPreventsCollision(obj, other)) continue;
+
+            for (const BaseCollider *colliderA : obj->colliders) {
+                for (const BaseCollider *colliderB : other->colliders) {
+                    time = timeOfImpact(colliderA, colliderB, obj, other, time, tolerance);
+                }
             }
         }
+        if (time >= stepSize) continue;
+
+        // Carrying on a little past the impact gets the contact found next step, without going so
+        // deep that it pushes back
+        narrowphaseCounters.ccdHits++;
+        stats.narrowphase.ccdHits++;
+        const float_type speed = obj->vel.length() + std::abs(obj->rotV) * turning;
+        stepTimes[i] = std::min<float_type>(stepSize, time + slopP * 0.5 / speed);
     }
+}
 
-    for (Object *obj : objects) {
-        obj->update(stepSize);
-        if (obj->getInvMass() != 0) {
-            obj->vel += tickGravity;
+static uint findIsland(std::vector<uint> &parents, uint i) {
+    while (parents[i] != i) {
+        parents[i] = parents[parents[i]];
+        i = parents[i];
+    }
+    return i;
+}
+
+void World::updateSleep(float_type stepSize) {
+    const std::vector<Object *> &order = stepObjects();
+    if (!sleepEnabled) {
+        for (Object *obj : order) {
+            if (obj->sleeping) obj->wake();
         }
+        return;
+    }
+
+    // Anything resting on something carries up to a step's worth of gravity, which its contacts take
+    // back next step. That much is allowed on top of the thresholds, for turning as measured at the
+    // object's edge, otherwise piles jitter just above them and never sleep
+    const float_type slack = gravity.length() * stepSize;
+    const float_type linear = sleepLinearThreshold + slack;
+
+    // Static objects only stay awake while they're moving, or for a step after being moved
+    std::vector<uint> parents(order.size());
+    for (uint i = 0; i < order.size(); i++) {
+        Object *obj = order[i];
+        obj->islandIndex = i;
+        parents[i] = i;
+
+        if (obj->sleeping) continue;
+        if (obj->isStatic()) {
+            obj->sleeping = obj->vel == ORIGIN && obj->rotV == 0;
+            continue;
+        }
+
+        const AABB inner = obj->getInner();
+        const float_type extent = std::max(inner.upper.x - inner.lower.x, inner.upper.y - inner.lower.y) * 0.5;
+        const float_type angular = sleepAngularThreshold + (extent > 0 ? slack / extent : 0);
+        if (obj->vel.length2() > linear * linear || obj->rotV * obj->rotV > angular * angular) {
+            obj->sleepTime = 0;
+        } else {
+            obj->sleepTime += stepSize;
+        }
+    }
+
+    // Islands are joined through contacts and constraints, but never through static objects
+    for (const ContactConstraint &contact : contacts) {
+        Object *a = contact.objA;
+        Object *b = contact.objB;
+        if (a->sleeping && b->sleeping) continue;
+
+        if (a->isStatic()) {
+            if (!a->sleeping) b->sleepTime = 0;  // Resting on something that's moving
+        } else if (b->isStatic()) {
+            if (!b->sleeping) a->sleepTime = 0;
+        } else {
+            parents[findIsland(parents, a->islandIndex)] = findIsland(parents, b->islandIndex);
+        }
+    }
+    for (Object *obj : order) {
+        for (BaseConstraint *constraint : obj->constraints) {
+            if (obj != constraint->objA) continue;
+            Object *a = constraint->objA;
+            Object *b = constraint->objB;
+            if (a->isStatic() || b->isStatic()) continue;
+            parents[findIsland(parents, a->islandIndex)] = findIsland(parents, b->islandIndex);
+        }
+    }
+
+    std::vector<float_type> islandSleepTime(order.size(), std::numeric_limits<float_type>::infinity());
+    for (Object *obj : order) {
+        if (obj->sleeping || obj->isStatic()) continue;
+        uint root = findIsland(parents, obj->islandIndex);
+        islandSleepTime[root] = std::min(islandSleepTime[root], obj->sleepTime);
+    }
+
+    std::vector<std::shared_ptr<std::vector<Object *>>> islands(order.size());
+    for (Object *obj : order) {
+        if (obj->sleeping || obj->isStatic()) continue;
+        uint root = findIsland(parents, obj->islandIndex);
+        if (islandSleepTime[root] < sleepTime) continue;
+
+        if (!islands[root]) islands[root] = std::make_shared<std::vector<Object *>>();
+        islands[root]->push_back(obj);
+        obj->sleep(islands[root]);
     }
 }
 
 void World::clear() {
     for (Object *obj : objects) delete obj;
     objects.clear();
-    contactConstraints.clear();
+    sortedObjects.clear();
+    contacts.clear();
+    axisCache.clear();
+    collisionEvents.clear();
+    deaths.clear();
 }
 
 void World::addObject(Object *obj) {
+    // Objects copied from another world keep their ids, so the counter has to skip past them
+    if (obj->syncId == Object::noSyncId) {
+        obj->syncId = nextSyncId++;
+    } else if (obj->syncId >= nextSyncId) {
+        nextSyncId = obj->syncId + 1;
+    }
+    obj->addOrder = nextAddOrder++;
+    obj->wake();
     objects.push_back(obj);
 
-    tree.addNode(obj);
+    tree.addProxy(obj);
 }
 
 void World::removeObject(Object *obj) {
     objects.erase(std::remove(objects.begin(), objects.end(), obj),
                   objects.end());
+    obj->wake();
+
+    collisionEvents.erase(std::remove_if(collisionEvents.begin(), collisionEvents.end(),
+                                         [obj](const CollisionEvent &event) {
+                                             return event.objA == obj || event.objB == obj;
+                                         }),
+                          collisionEvents.end());
+    deaths.erase(std::remove(deaths.begin(), deaths.end(), obj), deaths.end());
+
+    // Jumps and checkpoints can't outlive the objects they point at
+    for (Object *other : objects) {
+        if (!other->controller) continue;
+        Controller &controller = *other->controller;
+        if (controller.checkpoint == obj) controller.checkpoint = nullptr;
+        if (controller.jump != nullptr && controller.jump->objB == obj) controller.removeJump();
+    }
+    if (obj->controller) obj->controller->removeJump();
 
-    for (auto iter = contactConstraints.begin(); iter != contactConstraints.end();) {
-        ContactConstraint &contact = (*iter).second;
-        if (contact.objA == obj || contact.objB == obj) {
-            iter = contactConstraints.erase(iter);
-        } else {
-            iter++;
+    while (!obj->contacts.empty()) {
+        const ContactConstraint &contact = contacts[obj->contacts.back()];
+        Object *other = contact.objA == obj ? contact.objB : contact.objA;
+        if (!other->isStatic()) other->wake();
+        removeContact(obj->contacts.back());
+    }
+
+    tree.removeProxy(obj);
+}
+
+StepMetrics World::measure() {
+    StepMetrics metrics;
+    for (const Object *obj : objects) {
+        if (obj->sleeping || obj->isStatic()) continue;
+
+        const AABB inner = obj->getInner();
+        const float_type halfExtent = std::min(inner.upper.x - inner.lower.x, inner.upper.y - inner.lower.y) * 0.5;
+        const float_type speed = obj->vel.length() + std::abs(obj->rotV) * turningRadius(obj);
+        if (halfExtent > 0) metrics.maxMotion = std::max(metrics.maxMotion, speed / halfExtent);
+
+        for (const BaseConstraint *constraint : obj->constraints) {
+            // Once per joint, from B when A is skipped
+            const Object *a = constraint->objA;
+            if (obj != a && !a->sleeping && !a->isStatic()) continue;
+            metrics.maxJointError = std::max(metrics.maxJointError, constraint->positionError());
+        }
+    }
+    for (const ContactConstraint &contact : contacts) {
+        if (contact.objA->sleeping && contact.objB->sleeping) continue;
+        for (const ContactPoint &point : contact.points) {
+            metrics.maxPenetration = std::max(metrics.maxPenetration, point.penetration);
+        }
+    }
+    // The tree's cached pairs go by fat bounds, which depend on how objects have moved before
+    tree.update();
+    for (const Object *obj : objects) {
+        if (obj->sleeping || obj->isStatic()) continue;
+
+        const AABB inner = obj->getInner();
+        queryCandidates.clear();
+        tree.queryBounds(inner, queryCandidates);
+        for (Proxy *proxy : queryCandidates) {
+            const Object *other = static_cast<const Object *>(proxy);
+            if (other == obj || other->isStatic() || !other->getInner().intersect(inner)) continue;
+            // Pairs of awake objects turn up from both sides
+            if (!other->sleeping && other < obj) continue;
+            metrics.dynamicPairs++;
+        }
+    }
+    return metrics;
+}
+
+void World::sortQueryResults(std::vector<Object *> &out, size_t start) const {
+    if (deterministic) std::sort(out.begin() + start, out.end(), syncIdLess);
+}
+
+bool World::raycast(const Vec2 &from, const Vec2 &to, bool sensors, RaycastHit &hit) {
+    tree.update();  // Anything moved since the last step
+    hit = RaycastHit();
+    tree.raycast(from, to, [&](Proxy *proxy, float_type maxFraction) {
+        Object *obj = static_cast<Object *>(proxy);
+        if (obj->sensor && !sensors) return maxFraction;
+
+        for (const BaseCollider *collider : obj->colliders) {
+            float_type fraction;
+            Vec2 normal;
+            if (!collider->raycast(from, to, maxFraction, fraction, normal)) continue;
+            // Ties go to the lower syncId, so peers agree on what was hit
+            if (fraction == maxFraction && hit.obj != nullptr && !syncIdLess(obj, hit.obj)) continue;
+
+            maxFraction = fraction;
+            hit.obj = obj;
+            hit.normal = normal;
+            hit.fraction = fraction;
+        }
+        return maxFraction;
+    });
+    if (hit.obj == nullptr) return false;
+
+    hit.point = from + (to - from) * hit.fraction;
+    return true;
+}
+
+void World::queryPoint(const Vec2 &point, bool sensors, std::vector<Object *> &out) {
+    const size_t start = out.size();
+    queryCandidates.clear();
+    tree.update();
+    tree.queryBounds(AABB(point, point), queryCandidates);
+    for (Proxy *proxy : queryCandidates) {
+        Object *obj = static_cast<Object *>(proxy);
+        if (obj->sensor && !sensors) continue;
+
+        for (const BaseCollider *collider : obj->colliders) {
+            if (!collider->containsPoint(point)) continue;
+            out.push_back(obj);
+            break;
+        }
+    }
+    sortQueryResults(out, start);
+}
+
+void World::queryAABB(const AABB &aabb, bool sensors, std::vector<Object *> &out) {
+    const size_t start = out.size();
+    queryCandidates.clear();
+    tree.update();
+    tree.queryBounds(aabb, queryCandidates);
+    for (Proxy *proxy : queryCandidates) {
+        Object *obj = static_cast<Object *>(proxy);
+        if ((!obj->sensor || sensors) && obj->getInner().intersect(aabb)) out.push_back(obj);
+    }
+    sortQueryResults(out, start);
+}
+
+void World::queryShape(const BaseCollider *shape, bool sensors, std::vector<Object *> &out) {
+    const size_t start = out.size();
+    queryCandidates.clear();
+    tree.update();
+    shape->getObject()->updateBounds();
+    const AABB bounds = shape->getObject()->getInner();
+    tree.queryBounds(bounds, queryCandidates);
+    for (Proxy *proxy : queryCandidates) {
+        Object *obj = static_cast<Object *>(proxy);
+        if ((obj->sensor && !sensors) || !obj->getInner().intersect(bounds)) continue;
+
+        for (const BaseCollider *collider : obj->colliders) {
+            Vec2 normal;
+            if (colliderDistance(shape, collider, normal) > 0) continue;
+            out.push_back(obj);
+            break;
+        }
+    }
+    sortQueryResults(out, start);
+}
+
+void World::queryVisible(const AABB &aabb, std::vector<Object *> &out) {
+    const size_t start = out.size();
+    queryAABB(aabb, true, out);
+    // Later objects are drawn over earlier ones, the same as when drawing every object
+    std::sort(out.begin() + start, out.end(), [](const Object *a, const Object *b) { return a->addOrder < b->addOrder; });
+}
+
+bool World::hasCallbacks() const {
+    for (const Object *obj : objects) {
+        if (obj->collisionHandler != nullptr) return true;
+        for (const BaseConstraint *constraint : obj->constraints) {
+            if (constraint->hasCallback()) return true;
+        }
+    }
+    return false;
+}
+
+void stepWorlds(ThreadPool &pool, const std::vector<WorldStep> &jobs) {
+    pool.run(jobs.size(), [&jobs](size_t i) {
+        // The pool's threads are already busy with the other worlds, a narrowphase pool per world on
+        // top of them would only add threads fighting over the same cores
+        World &world = *jobs[i].world;
+        const uint narrowphaseThreads = world.narrowphaseThreads;
+        world.narrowphaseThreads = 1;
+        for (uint step = 0; step < jobs[i].steps; step++) {
+            world.update(jobs[i].stepSize);
         }
+        world.narrowphaseThreads = narrowphaseThreads;
+    });
+}
+
+// splitmix64's finaliser
+static uint64_t mixHash(uint64_t x) {
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb;
+    return x ^ (x >> 31);
+}
+
+static uint64_t floatBits(float_type value) {
+    value += 0;  // -0 becomes 0, the two compare equal so they shouldn't look like a desync
+    uint64_t bits = 0;
+    std::memcpy(&bits, &value, sizeof(value));
+    return bits;
+}
+
+uint64_t World::stateHash() const {
+    // Summed so it doesn't matter what order a peer keeps its objects in
+    uint64_t hash = 0;
+    for (const Object *obj : objects) {
+        uint64_t objHash = mixHash(obj->syncId);
+        for (float_type value : {obj->pos.x, obj->pos.y, obj->vel.x, obj->vel.y, obj->rot, obj->rotV}) {
+            objHash = mixHash(objHash ^ floatBits(value));
+        }
+        hash += objHash;
+    }
+    return hash;
+}
+
+// Index of obj in the snapshot being saved, snapshotIndex is only trusted if it points back at obj
+static int snapshotIndexOf(const std::vector<Object *> &objects, const Object *obj) {
+    if (obj == nullptr || obj->snapshotIndex >= objects.size() || objects[obj->snapshotIndex] != obj) return -1;
+    return obj->snapshotIndex;
+}
+
+static bool isControllerJump(const Object *obj, const BaseConstraint *constraint) {
+    return obj->controller && obj->controller->jump == constraint;
+}
+
+void World::saveSnapshot(WorldSnapshot &snapshot) const {
+    snapshot.lastStepSize = lastStepSize;
+    snapshot.bodies.resize(objects.size());
+    snapshot.controllers.clear();
+    snapshot.contacts.resize(contacts.size());
+    snapshot.points.clear();
+    snapshot.constraints.clear();
+
+    for (uint i = 0; i < objects.size(); i++) objects[i]->snapshotIndex = i;
+    for (uint i = 0; i < objects.size(); i++) {
+        const Object *obj = objects[i];
+        const int island = obj->island ? snapshotIndexOf(objects, obj->island->front()) : -1;
+        snapshot.bodies[i] = {obj->pos, obj->vel, obj->rot, obj->rotV, obj->sleepTime,
+                              obj->sleeping, island, tree.getFatBounds(obj)};
     }
 
-    tree.removeNode(obj);
+    for (uint i = 0; i < contacts.size(); i++) {
+        const ContactConstraint &contact = contacts[i];
+        snapshot.contacts[i] = {contact.objA->snapshotIndex, contact.objB->snapshotIndex, contact.friction,
+                                contact.restitution, (uint)snapshot.points.size(), (uint)contact.points.size()};
+        snapshot.points.insert(snapshot.points.end(), contact.points.begin(), contact.points.end());
+    }
+
+    // Joints belong to their first object, controller jumps are stored with the controller instead
+    for (const Object *obj : objects) {
+        for (const BaseConstraint *constraint : obj->constraints) {
+            if (constraint->objA != obj || isControllerJump(obj, constraint)) continue;
+            const size_t offset = snapshot.constraints.size();
+            snapshot.constraints.resize(offset + constraint->stateSize());
+            constraint->saveState(snapshot.constraints.data() + offset);
+        }
+
+        if (!obj->controller) continue;
+        const Controller &controller = *obj->controller;
+        WorldSnapshot::ControllerState state = {};
+        state.action = controller.action;
+        state.state = controller.state;
+        state.dyingTime = controller.dyingTime;
+        state.checkpoint = snapshotIndexOf(objects, controller.checkpoint);
+        state.jumpOther = -1;
+        if (controller.jump != nullptr) {
+            const VelocityConstraint &jump = *controller.jump;
+            state.jumpOther = snapshotIndexOf(objects, jump.objB);
+            state.jumpLocalA = jump.localA;
+            state.jumpLocalB = jump.localB;
+            state.jumpNormal = jump.normal;
+            state.jumpTarget = jump.targetVelocity;
+            state.jumpMaxImpulse = jump.maxImpulse;
+            state.jumpImpulse = jump.impulseSum;
+            state.jumpTime = controller.jumpTime;
+        }
+        snapshot.controllers.push_back(state);
+    }
 }
 
-std::vector<ContactConstraint> World::getContacts() const {
-    std::vector<ContactConstraint> contacts;
-    contacts.reserve(contacts.size());
-    for (auto& entry : contactConstraints) contacts.push_back(entry.second);
-    return contacts;
+void World::restoreSnapshot(const WorldSnapshot &snapshot, const std::vector<Object *> &objs) {
+    if (objs.size() != snapshot.bodies.size()) {
+        throw std::invalid_argument("snapshot has " + std::to_string(snapshot.bodies.size()) +
+                                    " objects but " + std::to_string(objs.size()) + " were given");
+    }
+    size_t controllerCount = 0;
+    size_t constraintSize = 0;
+    for (const Object *obj : objs) {
+        if (obj->controller) controllerCount++;
+        for (const BaseConstraint *constraint : obj->constraints) {
+            if (constraint->objA != obj || isControllerJump(obj, constraint)) continue;
+            constraintSize += constraint->stateSize();
+        }
+    }
+    if (controllerCount != snapshot.controllers.size() || constraintSize != snapshot.constraints.size()) {
+        throw std::invalid_argument("snapshot controllers or joints don't match the objects");
+    }
+
+    lastStepSize = snapshot.lastStepSize;
+
+    // Jumps are rebuilt below, dropping them first keeps them out of the joint walk
+    for (Object *obj : objects) {
+        if (obj->controller) obj->controller->removeJump();
+    }
+    for (Object *obj : objs) {
+        if (obj->controller) obj->controller->removeJump();
+    }
+
+    for (uint i = 0; i < objs.size(); i++) {
+        Object *obj = objs[i];
+        const WorldSnapshot::Body &body = snapshot.bodies[i];
+        obj->wake();
+        obj->pos = body.pos;
+        obj->vel = body.vel;
+        obj->rot = body.rot;
+        obj->rotV = body.rotV;
+        obj->sleepTime = body.sleepTime;
+        obj->updateRotMat();
+        obj->updateBounds();
+        tree.setFatBounds(obj, body.fatBounds);
+    }
+
+    // Everything was woken above, islands are put back together in their original order
+    std::vector<std::shared_ptr<std::vector<Object *>>> islands(objs.size());
+    for (uint i = 0; i < objs.size(); i++) {
+        const WorldSnapshot::Body &body = snapshot.bodies[i];
+        if (!body.sleeping) continue;
+        if (body.island == -1) {
+            objs[i]->sleeping = true;
+            continue;
+        }
+        std::shared_ptr<std::vector<Object *>> &island = islands[body.island];
+        if (!island) island = std::make_shared<std::vector<Object *>>();
+        island->push_back(objs[i]);
+        objs[i]->sleep(island);
+    }
+
+    for (Object *obj : objects) obj->contacts.clear();
+    for (Object *obj : objs) obj->contacts.clear();
+    contacts.clear();
+    for (const WorldSnapshot::Contact &saved : snapshot.contacts) {
+        Object *a = objs[saved.objA];
+        Object *b = objs[saved.objB];
+        a->contacts.push_back(contacts.size());
+        b->contacts.push_back(contacts.size());
+        contacts.emplace_back(a, b, saved.friction, saved.restitution);
+        contacts.back().points.assign(snapshot.points.begin() + saved.firstPoint,
+                                      snapshot.points.begin() + saved.firstPoint + saved.numPoints);
+    }
+
+    const float_type *constraintState = snapshot.constraints.data();
+    uint controllerIndex = 0;
+    for (Object *obj : objs) {
+        for (BaseConstraint *constraint : obj->constraints) {
+            if (constraint->objA != obj) continue;
+            constraint->loadState(constraintState);
+            constraintState += constraint->stateSize();
+        }
+
+        if (!obj->controller) continue;
+        Controller &controller = *obj->controller;
+        const WorldSnapshot::ControllerState &state = snapshot.controllers[controllerIndex++];
+        controller.action = state.action;
+        controller.state = state.state;
+        controller.dyingTime = state.dyingTime;
+        controller.checkpoint = state.checkpoint == -1 ? nullptr : objs[state.checkpoint];
+        if (state.jumpOther != -1) {
+            controller.jump = new VelocityConstraint(obj, objs[state.jumpOther], state.jumpLocalA, state.jumpLocalB,
+                                                     state.jumpNormal, state.jumpTarget, state.jumpMaxImpulse);
+            controller.jump->impulseSum = state.jumpImpulse;
+            controller.jumpTime = state.jumpTime;
+        }
+    }
+
+    // Anything buffered belongs to steps that are being undone
+    collisionEvents.clear();
+    deaths.clear();
 }
 
 /*
@@ -446,10 +1731,12 @@ int main(int argc, const char *argv[]) {
         objA->pos = Vec2(0, 0);
         objA->rot = 0;
         objA->updateRotMat();
+        objA->updateBounds();
 
         objB->pos = Vec2(1.999, 0).rotate(M_PI * i / 20);
         objB->rot = 0;
         objB->updateRotMat();
+        objB->updateBounds();
 
         Vec2 initialDir = Vec2(0.7, 0.4);  // objA->pos - objB->pos;
 
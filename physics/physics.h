@@ -1,10 +1,14 @@
 #pragma once
 
+#include <cstdint>
+#include <memory>
 #include <unordered_map>
 #include <vector>
 
 #include "aabb.h"
 #include "objects.h"
+#include "solver.h"
+#include "threadpool.h"
 #include "vector.h"
 
 //#define DEBUG
@@ -17,22 +21,190 @@ extern std::vector<Vec2> collisions;
 template <typename T, typename U> 
 struct std::hash<std::pair<T, U>> {
     std::size_t operator()(const std::pair<T, U> &key) const {
-      return std::hash<T>()(key.first) ^ std::hash<U>()(key.second);
+      // Order matters and pointers share their low bits, so a plain xor clusters badly
+      const std::size_t first = std::hash<T>()(key.first);
+      return first ^ (std::hash<U>()(key.second) + 0x9e3779b97f4a7c15 + (first << 6) + (first >> 2));
    }
 };
 
 
 
+struct PairCollision {
+   uint pair;  // Index into the broadphase pairs
+   Manifold manifold;
+};
+
+// Recorded for collider pairs where either object has reportCollisions set
+struct CollisionEvent {
+   Object *objA, *objB;
+   Vec2 normal;  // From A to B
+   Vec2 localA, localB;  // Deepest point
+   float_type impulse;  // Normal impulse of the pair's contact for the step, 0 if it had none
+};
+
+// What was learnt about a collider pair last time it was tested, used to seed the next test
+struct SeparatingAxis {
+   Vec2 direction = Vec2(0.7, 0.4);  // GJK search direction, from A towards B
+   int face = -1;  // SAT face that last separated the pair or was the reference face
+   bool faceOnB = false;
+   uint64_t lastStep = 0;
+};
+
+typedef std::pair<BaseCollider *, BaseCollider *> ColliderPair;
+
+// Running totals, diff two readings to measure a stretch of steps
+struct NarrowphaseCounters {
+   uint64_t gjkQueries = 0;
+   uint64_t gjkIterations = 0;
+   uint64_t epaIterations = 0;
+   uint64_t satQueries = 0;
+   uint64_t satCachedExits = 0;  // Polygon pairs rejected by the cached face alone
+   uint64_t ccdQueries = 0;  // Objects swept for being too fast for the step
+   uint64_t ccdHits = 0;  // Sweeps that had to stop short
+
+   // Queries by how many iterations they took. Bucket i holds those that took at most 2^i, the last
+   // bucket also holds everything longer
+   static const uint histogramBuckets = 6;
+   uint64_t gjkHistogram[histogramBuckets] = {};
+   uint64_t epaHistogram[histogramBuckets] = {};
+
+   NarrowphaseCounters& operator+=(const NarrowphaseCounters &other);
+};
+
+struct NarrowphaseChunk {
+   std::vector<PairCollision> results;
+   std::vector<std::pair<ColliderPair, SeparatingAxis>> newAxes;  // Inserted after the threads finish
+   NarrowphaseCounters counters;
+};
+
+// How demanding the current state is to step, to pick a number of substeps from
+struct StepMetrics {
+   float_type maxMotion = 0;  // Fastest awake object's speed over its smallest half extent
+   float_type maxPenetration = 0;  // Deepest awake contact point
+   float_type maxJointError = 0;  // Furthest apart any awake joint's anchors are
+   uint dynamicPairs = 0;  // Awake pairs of dynamic objects whose bounds overlap, as in a stack
+};
+
+// Where World::update spends its time, added up over every step until the owner resets it
+struct StepStats {
+   uint64_t steps = 0;
+
+   // Wall time of each phase in seconds
+   double treeTime = 0;  // Refitting the AABB tree
+   double pairTime = 0;  // Finding and filtering the overlapping pairs
+   double narrowphaseTime = 0;  // Testing the pairs, including collision handlers
+   double solverTime = 0;  // Updating, warm starting and solving contacts and joints
+   double islandTime = 0;  // Finding islands to put to sleep
+   double integrateTime = 0;  // Continuous collision and moving the objects
+   double totalTime = 0;  // Whole steps, so controllers and collision events as well
+
+   uint64_t pairs = 0;  // Found by the broadphase
+   uint64_t contacts = 0;  // Awake contacts solved
+   uint64_t contactPoints = 0;
+   uint64_t awakeObjects = 0;
+   uint64_t collisionHandlerCalls = 0;
+   uint64_t constraintCallbacks = 0;  // CustomConstraint applications
+
+   NarrowphaseCounters narrowphase;
+};
+
+// Closest thing a World::raycast found
+struct RaycastHit {
+   Object *obj = nullptr;
+   Vec2 point;
+   Vec2 normal;  // Outward from obj
+   float_type fraction = 1;  // How far along the ray, 0 at its start and 1 at its end
+};
+
+// Everything a World changes while stepping, with objects referred to by their position in the
+// world. The arrays keep their capacity, so saving into the same snapshot again doesn't allocate.
+// Caches that only speed stepping up are left out: the narrowphase's separating axes and the shape
+// of the AABB tree, which sets the order pairs are found in. Those change the result slightly, so
+// stepping again from a restored snapshot only repeats the original steps exactly when the world
+// is deterministic, which ignores the axes and sorts the pairs. Rollback needs deterministic set
+struct WorldSnapshot {
+   struct Body {
+      Vec2 pos, vel;
+      float_type rot, rotV;
+      float_type sleepTime;
+      bool sleeping;
+      int island;  // First object of the sleeping island, -1 for awake or static objects
+      AABB fatBounds;  // As kept by the tree, the fall check and pairing depend on it
+   };
+
+   struct ControllerState {
+      Vec2 action;
+      Controller::State state;
+      float_type dyingTime;
+      int checkpoint;  // -1 for none
+
+      int jumpOther;  // -1 when not jumping
+      Vec2 jumpLocalA, jumpLocalB, jumpNormal;
+      float_type jumpTarget, jumpMaxImpulse, jumpImpulse, jumpTime;
+   };
+
+   struct Contact {
+      uint objA, objB;
+      float_type friction, restitution;
+      uint firstPoint, numPoints;
+   };
+
+   std::vector<Body> bodies;
+   std::vector<ControllerState> controllers;  // In the order of the controlled objects
+   std::vector<Contact> contacts;
+   std::vector<ContactPoint> points;
+   std::vector<float_type> constraints;  // Accumulated impulses of every joint, see BaseConstraint::saveState
+   float_type lastStepSize;  // The impulses were accumulated over steps of this size
+
+   size_t objectCount() const { return bodies.size(); }
+   size_t contactCount() const { return contacts.size(); }
+   size_t byteSize() const {
+      return bodies.size() * sizeof(Body) + controllers.size() * sizeof(ControllerState) +
+             contacts.size() * sizeof(Contact) + points.size() * sizeof(ContactPoint) +
+             constraints.size() * sizeof(float_type);
+   }
+};
+
 class World {
    private:
       std::vector<Object *> objects;
 
+      std::unique_ptr<ThreadPool> pool;
+      BatchedContactSolver batchedSolver;
+      std::vector<NarrowphaseChunk> narrowphaseChunks;
+
+      std::unordered_map<ColliderPair, SeparatingAxis> axisCache;
+      uint64_t narrowphaseStep = 0;
+      float_type lastStepSize = 0;  // 0 until the first update
+
+      std::vector<Object *> sortedObjects;  // By syncId, refreshed every update in deterministic mode
+      uint64_t nextSyncId = (uint64_t)1 << 32;
+      uint64_t nextAddOrder = 0;
+      const std::vector<Object *>& stepObjects() const { return deterministic ? sortedObjects : objects; }
+
       std::vector<std::pair<Object *, Object *>> broadphase();
-      void resolveCollision(Object *a, Object *b, const Collision &col);
+      void narrowphase(const std::vector<std::pair<Object *, Object *>> &pairs);
+      void resolveCollision(Object *a, Object *b, const Manifold &manifold);
+      void updateSleep(float_type stepSize);
+      void updateControllers(float_type stepSize);
+      bool controllerCollision(Object *obj, Object *other, Vec2 normal, Vec2 local, Vec2 otherLocal);
+      void kill(Object *obj);
+      void solveContacts(float_type baumgarteBias);
+
+      std::vector<float_type> stepTimes;  // How far each object in stepObjects moves this step
+      std::vector<Proxy *> ccdCandidates;
+      void limitFastObjects(float_type stepSize);
 
-      std::unordered_map<std::pair<Object *, Object *>, ContactConstraint>
-         contactConstraints = std::unordered_map<std::pair<Object *, Object *>,
-                                                   ContactConstraint>();
+      // Dense so the solver walks it in order, each object lists the indices of its own contacts
+      std::vector<ContactConstraint> contacts;
+      ContactConstraint& findContact(Object *a, Object *b);
+      const ContactConstraint* lookupContact(Object *a, Object *b) const;
+      void removeContact(uint index);
+      void removeEmptyContacts();
+      void sortContacts();
+
+      std::vector<Proxy *> queryCandidates;
+      void sortQueryResults(std::vector<Object *> &out, size_t start) const;
 
    public:
       AABBTree tree;
@@ -41,6 +213,33 @@ class World {
       float_type baumgarteBias;
       int solverSteps;
       float_type slopP, slopR;
+      float_type warmStartFactor = 1;  // Fraction of last step's impulses applied before solving
+      bool useBatchedSolver = false;
+
+      // Objects count as at rest below these speeds, plus the velocity gravity adds in a step (for
+      // turning, that velocity at the edge of the object's bounds)
+      bool sleepEnabled = true;
+      float_type sleepLinearThreshold = 0.05;
+      float_type sleepAngularThreshold = 0.005;
+      float_type sleepTime = 30;  // Time an island must be at rest before it sleeps
+
+      // Continuous collision: anything moving further than ccdThreshold times its smallest half extent
+      // in a step, and any bullet, stops short of the first static object in its way. Bullets also
+      // stop for dynamic objects
+      bool ccdEnabled = true;
+      float_type ccdThreshold = 0.5;
+
+      uint narrowphaseThreads = 1;
+
+      // Steps objects, pairs and contacts in syncId order and ignores anything cached from earlier
+      // steps besides contacts, so peers holding the same state and sync ids step it identically
+      bool deterministic = false;
+
+      // Piles up across updates until the owner clears it
+      std::vector<CollisionEvent> collisionEvents;
+      std::vector<Object *> deaths;  // Controlled objects that have died and are waiting to be revived
+      NarrowphaseCounters narrowphaseCounters;
+      StepStats stats;
 
       World(Vec2 gravity, float_type baumgarteBias, int solverSteps, float_type slopP,
             float_type slopR, float_type aabbMargin)
@@ -58,5 +257,45 @@ class World {
       void addObject(Object *obj);
       void removeObject(Object *obj);
 
-      std::vector<ContactConstraint> getContacts() const;
-};
\ No newline at end of file
+      const std::vector<ContactConstraint>& getContacts() const { return contacts; }
+
+      // Depends only on the objects' state, not on anything cached, so peers holding the same state
+      // measure the same
+      StepMetrics measure();
+      void resetStats() { stats = StepStats(); }
+
+      // Queries see the objects where they are now, sensors only if asked. Objects that overlap the
+      // query are appended to out, in syncId order when deterministic
+      bool raycast(const Vec2 &from, const Vec2 &to, bool sensors, RaycastHit &hit);
+      void queryPoint(const Vec2 &point, bool sensors, std::vector<Object *> &out);
+      void queryAABB(const AABB &aabb, bool sensors, std::vector<Object *> &out);
+      // shape's object is placed where it should be tested and mustn't be in the world
+      void queryShape(const BaseCollider *shape, bool sensors, std::vector<Object *> &out);
+      // Objects and sensors whose bounds overlap aabb, in the order they were added, for drawing
+      void queryVisible(const AABB &aabb, std::vector<Object *> &out);
+
+      // Whether stepping can call a collision handler or custom constraint. The bindings implement
+      // those in Python, so they can only step without the GIL when there are none
+      bool hasCallbacks() const;
+
+      // Cheap fingerprint of every object's syncId, position and velocity, to compare between peers
+      uint64_t stateHash() const;
+
+      void saveSnapshot(WorldSnapshot &snapshot) const;
+      // objs are the objects standing in for the snapshot's, in the same order. They're normally this
+      // world's own objects, but any world holding the same objects and joints will do. Throws
+      // std::invalid_argument, before changing anything, if the layout doesn't match
+      void restoreSnapshot(const WorldSnapshot &snapshot, const std::vector<Object *> &objs);
+};
+
+// One world's part of a stepWorlds call, the same as calling world->update(stepSize) steps times
+struct WorldStep {
+   World *world;
+   float_type stepSize;
+   uint steps;
+};
+
+// Steps each world on its own thread of pool, returning once they've all finished. The worlds
+// mustn't share objects or joints, or have callbacks. Their narrowphases run on the thread stepping
+// them, whatever narrowphaseThreads is set to
+void stepWorlds(ThreadPool &pool, const std::vector<WorldStep> &jobs);
@@ -1,14 +1,74 @@
 # distutils: language = c++
 
 from libcpp.vector cimport vector
+from libcpp cimport bool
+from libc.stdint cimport uint64_t
 cimport objects, util, aabb
 from vector cimport Vec2, float_type
 
 
 ctypedef objects.Object* objectP
 
+cdef extern from "threadpool.h":
+   cdef cppclass ThreadPool:
+      ThreadPool(size_t)
+      size_t size()
+
 cdef extern from "physics.h":
    extern vector[Vec2] collisions
+   cdef struct NarrowphaseCounters:
+      unsigned long long gjkQueries
+      unsigned long long gjkIterations
+      unsigned long long epaIterations
+      unsigned long long satQueries
+      unsigned long long satCachedExits
+      unsigned long long ccdQueries
+      unsigned long long ccdHits
+      uint64_t gjkHistogram[6]
+      uint64_t epaHistogram[6]
+
+   cdef struct StepStats:
+      unsigned long long steps
+      double treeTime
+      double pairTime
+      double narrowphaseTime
+      double solverTime
+      double islandTime
+      double integrateTime
+      double totalTime
+      unsigned long long pairs
+      unsigned long long contacts
+      unsigned long long contactPoints
+      unsigned long long awakeObjects
+      unsigned long long collisionHandlerCalls
+      unsigned long long constraintCallbacks
+      NarrowphaseCounters narrowphase
+
+   cdef struct CollisionEvent:
+      objects.Object* objA
+      objects.Object* objB
+      Vec2 normal
+      Vec2 localA
+      Vec2 localB
+      float_type impulse
+
+   cdef struct StepMetrics:
+      float_type maxMotion
+      float_type maxPenetration
+      float_type maxJointError
+      unsigned int dynamicPairs
+
+   cdef struct RaycastHit:
+      objects.Object* obj
+      Vec2 point
+      Vec2 normal
+      float_type fraction
+
+   cdef cppclass WorldSnapshot:
+      size_t objectCount()
+      size_t contactCount()
+      size_t byteSize()
+
    cdef cppclass World:
       aabb.AABBTree tree
 
@@ -17,12 +77,49 @@ cdef extern from "physics.h":
       float_type baumgarteBias
       float_type slopP
       float_type slopR
+      float_type warmStartFactor
+      bool useBatchedSolver
+
+      bool sleepEnabled
+      float_type sleepLinearThreshold
+      float_type sleepAngularThreshold
+      float_type sleepTime
+
+      bool ccdEnabled
+      float_type ccdThreshold
+
+      unsigned int narrowphaseThreads
+      bool deterministic
+      NarrowphaseCounters narrowphaseCounters
+      StepStats stats
+      vector[CollisionEvent] collisionEvents
+      vector[objects.Object*] deaths
 
       World(Vec2, float_type, int, float_type, float_type, float_type)
-      void update(float_type)
+      void update(float_type) nogil
 
       void clear()
       void addObject(objects.Object* obj)
       void removeObject(objects.Object* obj)
 
-      vector[objects.ContactConstraint] getContacts()
+      const vector[objects.ContactConstraint]& getContacts()
+      unsigned long long stateHash()
+      bool hasCallbacks()
+      StepMetrics measure()
+      void resetStats()
+
+      bool raycast(Vec2, Vec2, bool, RaycastHit&)
+      void queryPoint(Vec2, bool, vector[objects.Object*]&)
+      void queryAABB(aabb.AABB, bool, vector[objects.Object*]&)
+      void queryShape(objects.BaseCollider*, bool, vector[objects.Object*]&)
+      void queryVisible(aabb.AABB, vector[objects.Object*]&)
+
+      void saveSnapshot(WorldSnapshot&)
+      void restoreSnapshot(const WorldSnapshot&, const vector[objects.Object*]&) except +
+
+   cdef struct WorldStep:
+      World* world
+      float_type stepSize
+      unsigned int steps
+
+   void stepWorlds(ThreadPool&, const vector[WorldStep]&) nogil
@@ -1,11 +1,21 @@
+import sys
+
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
 
+# std::thread needs pthreads on older glibc
+thread_args = [] if sys.platform == 'win32' else ['-pthread']
+# Fused multiply-adds round differently to separate ones, and whether they're used depends on the
+# target, which would break deterministic worlds between machines. MSVC doesn't contract by default
+float_args = [] if sys.platform == 'win32' else ['-ffp-contract=off']
+
 setup(name='Physics Engine', ext_modules=cythonize(
     [
         Extension("physics", 
-            ["main.pyx", "physics.cpp", "objects.cpp", "aabb.cpp"])
+            ["main.pyx", "physics.cpp", "objects.cpp", "aabb.cpp", "solver.cpp", "treebench.cpp"],
+            extra_compile_args=thread_args + float_args,
+            extra_link_args=thread_args)
         ], 
         language="c++", 
         gdb_debug=True)
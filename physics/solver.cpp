@@ -0,0 +1,262 @@
+#include "solver.h"
+
+#include <cmath>
+#include <cstdint>
+#include <limits>
+
+#include "constraint.h"
+
+const uint unassigned = std::numeric_limits<uint>::max();
+
+void BatchedContactSolver::resize(size_t numContacts) {
+    for (auto *array : {&invK00, &invK01, &invK10, &invK11, &friction}) {
+        array->resize(numContacts);
+    }
+    for (auto *array : {&normalX, &normalY, &normalA, &normalB, &normalMass,
+                        &tangentX, &tangentY, &tangentA, &tangentB, &tangentMass,
+                        &bias, &nImpulseSum, &tImpulseSum}) {
+        array->assign(numContacts * 2, 0);
+    }
+    bodyA.resize(numContacts);
+    bodyB.resize(numContacts);
+    pointCount.resize(numContacts);
+    valid.resize(numContacts);
+}
+
+void BatchedContactSolver::prepare(const std::vector<ContactConstraint*> &active) {
+    // Give every object touched by a contact a slot
+    bodies.clear();
+    for (ContactConstraint *contact : active) {
+        contact->objA->solverIndex = unassigned;
+        contact->objB->solverIndex = unassigned;
+    }
+    for (ContactConstraint *contact : active) {
+        for (Object *obj : {contact->objA, contact->objB}) {
+            if (obj->solverIndex != unassigned) continue;
+            obj->solverIndex = bodies.size();
+            bodies.push_back(obj);
+        }
+    }
+
+    // Greedy colouring, static objects never have their velocity changed so they can be shared
+    std::vector<uint64_t> usedColours(bodies.size(), 0);
+    std::vector<uint> colours(active.size());
+    std::vector<size_t> counts(maxColours + 1, 0);
+    for (size_t i = 0; i < active.size(); i++) {
+        Object *a = active[i]->objA;
+        Object *b = active[i]->objB;
+        uint64_t &usedA = usedColours[a->solverIndex];
+        uint64_t &usedB = usedColours[b->solverIndex];
+
+        const uint64_t used = (a->isStatic() ? 0 : usedA) | (b->isStatic() ? 0 : usedB);
+        uint colour = 0;
+        while (colour < maxColours && (used & ((uint64_t)1 << colour))) colour++;
+
+        if (colour < maxColours) {
+            if (!a->isStatic()) usedA |= (uint64_t)1 << colour;
+            if (!b->isStatic()) usedB |= (uint64_t)1 << colour;
+        }
+        colours[i] = colour;
+        counts[colour]++;
+    }
+
+    colourStarts.clear();
+    colourStarts.push_back(0);
+    for (uint colour = 0; colour <= maxColours; colour++) {
+        if (counts[colour] == 0) continue;
+        colourStarts.push_back(colourStarts.back() + counts[colour]);
+    }
+
+    std::vector<size_t> offsets(maxColours + 1, 0);
+    for (uint colour = 0, offset = 0; colour <= maxColours; colour++) {
+        offsets[colour] = offset;
+        offset += counts[colour];
+    }
+    contacts.resize(active.size());
+    for (size_t i = 0; i < active.size(); i++) {
+        contacts[offsets[colours[i]]++] = active[i];
+    }
+
+    for (auto *array : {&velX, &velY, &rotV, &invMass, &invMoment}) {
+        array->resize(bodies.size());
+    }
+    for (size_t i = 0; i < bodies.size(); i++) {
+        invMass[i] = bodies[i]->getInvMass();
+        invMoment[i] = bodies[i]->getInvMoment();
+    }
+    loadVelocities();
+
+    resize(contacts.size());
+    for (size_t i = 0; i < contacts.size(); i++) {
+        const ContactConstraint &contact = *contacts[i];
+        const uint a = contact.objA->solverIndex;
+        const uint b = contact.objB->solverIndex;
+        const Vec6 M = get_inverse_mass_matrix(*contact.objA, *contact.objB);
+
+        bodyA[i] = a;
+        bodyB[i] = b;
+        pointCount[i] = contact.points.size();
+        friction[i] = contact.friction;
+
+        for (uint p = 0; p < pointCount[i]; p++) {
+            const ContactPoint &point = contact.points[p];
+            const size_t k = 2 * i + p;
+
+            normalX[k] = point.J[3];
+            normalY[k] = point.J[4];
+            normalA[k] = point.J[2];
+            normalB[k] = point.J[5];
+            normalMass[k] = compute_inverse_effective_mass(point.J, M);
+
+            tangentX[k] = point.JT[3];
+            tangentY[k] = point.JT[4];
+            tangentA[k] = point.JT[2];
+            tangentB[k] = point.JT[5];
+            tangentMass[k] = compute_inverse_effective_mass(point.JT, M);
+
+            bias[k] = point.bias;
+            nImpulseSum[k] = point.nImpulseSum;
+            tImpulseSum[k] = point.tImpulseSum;
+        }
+
+        // Same cases where ContactConstraint::apply gives up on a contact
+        if (pointCount[i] == 2) {
+            const mat2x2 invK = compute_inverse_effective_mass(
+                std::array<Vec6, 2>{contact.points[0].J, contact.points[1].J}, M);
+            invK00[i] = invK.a;
+            invK01[i] = invK.b;
+            invK10[i] = invK.c;
+            invK11[i] = invK.d;
+            valid[i] = std::isfinite(invK.a) && std::isfinite(invK.b) &&
+                       std::isfinite(invK.c) && std::isfinite(invK.d);
+        } else {
+            valid[i] = std::isfinite(normalMass[2 * i]);
+        }
+    }
+}
+
+void BatchedContactSolver::loadVelocities() {
+    for (size_t i = 0; i < bodies.size(); i++) {
+        velX[i] = bodies[i]->vel.x;
+        velY[i] = bodies[i]->vel.y;
+        rotV[i] = bodies[i]->rotV;
+    }
+}
+
+void BatchedContactSolver::storeVelocities() {
+    for (size_t i = 0; i < bodies.size(); i++) {
+        bodies[i]->vel.x = velX[i];
+        bodies[i]->vel.y = velY[i];
+        bodies[i]->rotV = rotV[i];
+    }
+}
+
+void BatchedContactSolver::solve() {
+    for (size_t colour = 0; colour < numColours(); colour++) {
+        solveRange(colourStarts[colour], colourStarts[colour + 1]);
+    }
+}
+
+// Mirrors ContactConstraint::apply, contacts in [begin, end) must not share a dynamic object
+// unless they're solved in order (as the overflow colour is)
+void BatchedContactSolver::solveRange(size_t begin, size_t end) {
+    for (size_t i = begin; i < end; i++) {
+        if (!valid[i]) continue;
+
+        const uint a = bodyA[i];
+        const uint b = bodyB[i];
+        const float_type imA = invMass[a], iiA = invMoment[a];
+        const float_type imB = invMass[b], iiB = invMoment[b];
+        float_type vxA = velX[a], vyA = velY[a], wA = rotV[a];
+        float_type vxB = velX[b], vyB = velY[b], wB = rotV[b];
+
+        auto normalVel = [&](size_t k) {
+            return normalX[k] * (vxB - vxA) + normalY[k] * (vyB - vyA) + normalA[k] * wA + normalB[k] * wB;
+        };
+        auto applyNormal = [&](size_t k, float_type lambda) {
+            vxA -= normalX[k] * imA * lambda;
+            vyA -= normalY[k] * imA * lambda;
+            wA += normalA[k] * iiA * lambda;
+            vxB += normalX[k] * imB * lambda;
+            vyB += normalY[k] * imB * lambda;
+            wB += normalB[k] * iiB * lambda;
+        };
+        auto solvePoint = [&](size_t k) {
+            float_type lambda = normalMass[k] * -(bias[k] + normalVel(k));
+            if (nImpulseSum[k] + lambda < 0) {
+                lambda = -nImpulseSum[k];
+                nImpulseSum[k] = 0;
+            } else {
+                nImpulseSum[k] += lambda;
+            }
+            applyNormal(k, lambda);
+        };
+
+        const size_t k0 = 2 * i;
+        const size_t k1 = 2 * i + 1;
+        if (pointCount[i] == 1) {
+            solvePoint(k0);
+        } else {
+            const float_type rhs0 = -(bias[k0] + normalVel(k0));
+            const float_type rhs1 = -(bias[k1] + normalVel(k1));
+            float_type lambda0 = invK00[i] * rhs0 + invK01[i] * rhs1;
+            float_type lambda1 = invK10[i] * rhs0 + invK11[i] * rhs1;
+
+            const bool sep0 = lambda0 + nImpulseSum[k0] < 0;
+            const bool sep1 = lambda1 + nImpulseSum[k1] < 0;
+
+            if (sep0 && !sep1) {  // First separating, second holding
+                applyNormal(k0, -nImpulseSum[k0]);
+                nImpulseSum[k0] = 0;
+                solvePoint(k1);
+            } else if (sep1 && !sep0) {  // Second separating, first holding
+                applyNormal(k1, -nImpulseSum[k1]);
+                nImpulseSum[k1] = 0;
+                solvePoint(k0);
+            } else {
+                if (sep0 && sep1) {  // Both separating
+                    lambda0 = -nImpulseSum[k0];
+                    lambda1 = -nImpulseSum[k1];
+                    nImpulseSum[k0] = 0;
+                    nImpulseSum[k1] = 0;
+                } else {  // Both holding
+                    nImpulseSum[k0] += lambda0;
+                    nImpulseSum[k1] += lambda1;
+                }
+                applyNormal(k0, lambda0);
+                applyNormal(k1, lambda1);
+            }
+        }
+
+        for (size_t k = k0; k < k0 + pointCount[i]; k++) {  // Friction
+            float_type lambda = tangentMass[k] * -(tangentX[k] * (vxB - vxA) + tangentY[k] * (vyB - vyA) +
+                                                   tangentA[k] * wA + tangentB[k] * wB);
+            if (pointCount[i] == 2) lambda *= 0.5;
+
+            const float_type maxImpulse = nImpulseSum[k] * friction[i];
+            const float_type newTImpulseSum = std::min(std::max(tImpulseSum[k] + lambda, -maxImpulse), maxImpulse);
+            lambda = newTImpulseSum - tImpulseSum[k];
+            tImpulseSum[k] = newTImpulseSum;
+
+            vxA -= tangentX[k] * imA * lambda;
+            vyA -= tangentY[k] * imA * lambda;
+            wA += tangentA[k] * iiA * lambda;
+            vxB += tangentX[k] * imB * lambda;
+            vyB += tangentY[k] * imB * lambda;
+            wB += tangentB[k] * iiB * lambda;
+        }
+
+        velX[a] = vxA; velY[a] = vyA; rotV[a] = wA;
+        velX[b] = vxB; velY[b] = vyB; rotV[b] = wB;
+    }
+}
+
+void BatchedContactSolver::finish() {
+    storeVelocities();
+    for (size_t i = 0; i < contacts.size(); i++) {
+        for (uint p = 0; p < pointCount[i]; p++) {
+            contacts[i]->points[p].nImpulseSum = nImpulseSum[2 * i + p];
+            contacts[i]->points[p].tImpulseSum = tImpulseSum[2 * i + p];
+        }
+    }
+}
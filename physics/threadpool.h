@@ -0,0 +1,80 @@
+#pragma once
+
+#include <condition_variable>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+// Fixed set of workers for splitting a loop into chunks, the calling thread helps out too
+class ThreadPool {
+   private:
+      std::vector<std::thread> workers;
+      std::mutex mutex;
+      std::condition_variable startCondition, doneCondition;
+
+      const std::function<void(size_t)> *task = nullptr;
+      size_t numChunks = 0;
+      size_t nextChunk = 0;
+      size_t remaining = 0;
+      size_t generation = 0;
+      bool stopping = false;
+
+      ThreadPool(const ThreadPool&) = delete;
+      ThreadPool& operator=(const ThreadPool&) = delete;
+
+      void runChunks(std::unique_lock<std::mutex> &lock) {
+         while (nextChunk < numChunks) {
+            size_t chunk = nextChunk++;
+            lock.unlock();
+            (*task)(chunk);
+            lock.lock();
+            if (--remaining == 0) doneCondition.notify_all();
+         }
+      }
+
+      void workerLoop() {
+         std::unique_lock<std::mutex> lock(mutex);
+         size_t seen = 0;
+         while (true) {
+            startCondition.wait(lock, [&] { return stopping || generation != seen; });
+            if (stopping) return;
+            seen = generation;
+            runChunks(lock);
+         }
+      }
+
+   public:
+      ThreadPool(size_t numThreads) {
+         for (size_t i = 1; i < numThreads; i++) {
+            workers.emplace_back(&ThreadPool::workerLoop, this);
+         }
+      }
+
+      ~ThreadPool() {
+         {
+            std::lock_guard<std::mutex> lock(mutex);
+            stopping = true;
+         }
+         startCondition.notify_all();
+         for (std::thread &worker : workers) worker.join();
+      }
+
+      size_t size() const { return workers.size() + 1; }
+
+      // Calls func(chunk) for every chunk in [0, chunks), returns once all have finished
+      void run(size_t chunks, const std::function<void(size_t)> &func) {
+         if (chunks == 0) return;
+         std::unique_lock<std::mutex> lock(mutex);
+         task = &func;
+         numChunks = chunks;
+         nextChunk = 0;
+         remaining = chunks;
+         generation++;
+         startCondition.notify_all();
+
+         runChunks(lock);
+         doneCondition.wait(lock, [&] { return remaining == 0; });
+         task = nullptr;
+      }
+};
@@ -0,0 +1,374 @@
+#include "treebench.h"
+
+#include <algorithm>
+#include <chrono>
+#include <memory>
+#include <unordered_map>
+#include <vector>
+
+#include "aabb.h"
+
+namespace {
+
+typedef std::chrono::steady_clock Clock;
+
+double lap(Clock::time_point &start) {
+    const Clock::time_point now = Clock::now();
+    const double seconds = std::chrono::duration<double>(now - start).count();
+    start = now;
+    return seconds;
+}
+
+// The tree as it was before it moved into a node pool, kept as the baseline: every node is its own
+// allocation, inserts never rebalance, update walks every leaf and pairs are found from scratch
+namespace baseline {
+
+struct Node {
+    AABB inner;
+    AABB outer;
+    Node *parent = nullptr;
+    Node *children[2] = {nullptr, nullptr};
+    bool isStatic = false;
+
+    bool isLeaf() const { return children[0] == nullptr; }
+    Node* getSibling() { return parent->children[0] == this ? parent->children[1] : parent->children[0]; }
+
+    void updateAABB(const float_type margin) {
+        if (isLeaf()) {
+            outer = inner.expand(margin);
+        } else {
+            outer = children[0]->outer.mkUnion(children[1]->outer);
+        }
+    }
+};
+
+class Tree {
+    private:
+        std::vector<Node*> invalidNodes;
+        std::vector<std::pair<Node*, Node*>> pairs;
+        Node *root = nullptr;
+        size_t allocated = 0;  // Nodes it made and hasn't freed, removing a leaf under the root leaked one
+
+        Node* newBranch() {
+            allocated++;
+            return new Node();
+        }
+
+        void insertNode(Node *node, Node *newNode) {
+            if (node->isLeaf()) {
+                Node *newParent = newBranch();
+
+                if (node == root) {
+                    root = newParent;
+                } else {
+                    (node->parent->children[0] == node ?
+                    node->parent->children[0] : node->parent->children[1]) = newParent;
+                }
+
+                newParent->parent = node->parent;
+                newNode->parent = node->parent = newParent;
+
+                newParent->children[0] = node;
+                newParent->children[1] = newNode;
+
+                newParent->updateAABB(margin);
+            } else {
+                const AABB aabb0 = node->children[0]->outer;
+                const AABB aabb1 = node->children[1]->outer;
+
+                const float_type areaDiff0 = aabb0.mkUnion(newNode->outer).area() - aabb0.area();
+                const float_type areaDiff1 = aabb1.mkUnion(newNode->outer).area() - aabb1.area();
+
+                if (areaDiff0 < areaDiff1) {
+                    insertNode(node->children[0], newNode);
+                } else {
+                    insertNode(node->children[1], newNode);
+                }
+
+                node->updateAABB(margin);
+            }
+        }
+
+        void findInvalid(Node *node) {
+            if (node->isLeaf()) {
+                if (!node->outer.contains(node->inner)) {
+                    invalidNodes.push_back(node);
+                }
+            } else {
+                findInvalid(node->children[0]);
+                findInvalid(node->children[1]);
+            }
+        }
+
+        void findPairsForLeaf(Node *leaf, Node *branch) {
+            if (branch->isLeaf()) {
+                if (branch->inner.intersect(leaf->inner)) {
+                    pairs.emplace_back(leaf, branch);
+                }
+            } else {
+                if (branch->outer.intersect(leaf->inner)) {
+                    findPairsForLeaf(leaf, branch->children[0]);
+                    findPairsForLeaf(leaf, branch->children[1]);
+                }
+            }
+        }
+
+        void findPairs(Node *n0, Node *n1) {
+            if (n0->isLeaf()) {
+                if (n1->isLeaf()) {
+                    if (n0->inner.intersect(n1->inner)) {
+                        pairs.emplace_back(n0, n1);
+                    }
+                } else {
+                    if (n0->inner.intersect(n1->outer)) {
+                        findPairsForLeaf(n0, n1->children[0]);
+                        findPairsForLeaf(n0, n1->children[1]);
+                    }
+                }
+            } else {
+                if (n1->isLeaf()) {
+                    if (n0->outer.intersect(n1->inner)) {
+                        findPairsForLeaf(n1, n0->children[0]);
+                        findPairsForLeaf(n1, n0->children[1]);
+                    }
+                } else {
+                    if (n0->outer.intersect(n1->outer)) {
+                        findPairs(n0->children[0], n1->children[0]);
+                        findPairs(n0->children[0], n1->children[1]);
+                        findPairs(n0->children[1], n1->children[0]);
+                        findPairs(n0->children[1], n1->children[1]);
+                    }
+                }
+            }
+        }
+
+        void findAllPairs(Node *node) {
+            if (!node->isLeaf()) {
+                findPairs(node->children[0], node->children[1]);
+
+                findAllPairs(node->children[0]);
+                findAllPairs(node->children[1]);
+            }
+        }
+
+        void query(Node *node, const AABB &aabb, std::vector<Node*> &out) {
+            if (!node->outer.intersect(aabb)) return;
+            if (node->isLeaf()) {
+                out.push_back(node);
+            } else {
+                query(node->children[0], aabb, out);
+                query(node->children[1], aabb, out);
+            }
+        }
+
+        void shape(Node *node, int depth, size_t &nodes, int &height) const {
+            nodes++;
+            height = std::max(height, depth);
+            if (!node->isLeaf()) {
+                shape(node->children[0], depth + 1, nodes, height);
+                shape(node->children[1], depth + 1, nodes, height);
+            }
+        }
+
+        void freeBranches(Node *node) {
+            if (node->isLeaf()) return;
+            freeBranches(node->children[0]);
+            freeBranches(node->children[1]);
+            delete node;
+        }
+
+    public:
+        const float_type margin;
+
+        Tree(float_type margin) : margin(margin) {}
+        ~Tree() {
+            if (root != nullptr) freeBranches(root);
+        }
+
+        void addNode(Node *node) {
+            allocated++;
+            node->updateAABB(margin);
+            if (root == nullptr) {
+                root = node;
+            } else {
+                insertNode(root, node);
+            }
+        }
+
+        void removeNode(Node *node) {
+            allocated--;
+            if (node == root) {
+                root = nullptr;
+            } else {
+                Node *parent = node->parent;
+                Node *sibling = node->getSibling();
+
+                if (parent == root) {
+                    // Where the old tree leaked the parent. It's still counted in allocated, but freed
+                    // so replays don't pile up garbage
+                    root = sibling;
+                    sibling->parent = nullptr;
+                    delete parent;
+                } else {
+                    sibling->parent = parent->parent;
+
+                    (parent->parent->children[0] == parent
+                         ? parent->parent->children[0]
+                         : parent->parent->children[1]) = sibling;
+                    delete parent;
+                    allocated--;
+                }
+            }
+        }
+
+        void update() {
+            if (root == nullptr) return;
+
+            if (root->isLeaf()) {
+                root->updateAABB(margin);
+            } else {
+                findInvalid(root);
+                for (Node *node : invalidNodes) {
+                    removeNode(node);
+                    addNode(node);
+                }
+                invalidNodes.clear();
+            }
+        }
+
+        const std::vector<std::pair<Node*, Node*>>& computePairs() {
+            pairs.clear();
+            if (root != nullptr) findAllPairs(root);
+            return pairs;
+        }
+
+        void queryBounds(const AABB &aabb, std::vector<Node*> &out) {
+            if (root != nullptr) query(root, aabb, out);
+        }
+
+        void measure(TreeTimings &timings) const {
+            timings.nodes = 0;
+            timings.height = 0;
+            if (root != nullptr) shape(root, 0, timings.nodes, timings.height);
+            timings.memory = allocated * sizeof(Node);
+        }
+};
+
+}  // namespace baseline
+
+// A proxy that takes its bounds from the recording
+class ReplayProxy : public Proxy {
+    public:
+        bool staticProxy = false;
+
+        void setBounds(const AABB &aabb) { setInner(aabb); }
+        bool isStatic() const override { return staticProxy; }
+};
+
+AABB opBounds(const double *op) {
+    return AABB(Vec2(op[5], op[6]), Vec2(op[3], op[4]));
+}
+
+void replayCurrent(const double *ops, size_t count, float_type margin, TreeTimings &timings) {
+    AABBTree tree(margin);
+    std::unordered_map<int, std::unique_ptr<ReplayProxy>> proxies;
+    std::vector<Proxy*> found;
+
+    for (size_t i = 0; i < count; i++) {
+        const double *op = ops + i * TREE_OP_COLUMNS;
+        const int id = op[1];
+        Clock::time_point start;
+
+        switch ((int)op[0]) {
+            case TREE_ADD: {
+                std::unique_ptr<ReplayProxy> &proxy = proxies[id];
+                proxy.reset(new ReplayProxy());
+                proxy->staticProxy = op[2] != 0;
+                proxy->setBounds(opBounds(op));
+                tree.addProxy(proxy.get());
+                break;
+            }
+            case TREE_REMOVE:
+                tree.removeProxy(proxies[id].get());
+                proxies.erase(id);
+                break;
+            case TREE_MOVE:
+                proxies[id]->setBounds(opBounds(op));
+                break;
+            case TREE_STEP:
+                start = Clock::now();
+                tree.update();
+                timings.update += lap(start);
+                timings.pairCount += tree.computePairs().size();
+                timings.pairs += lap(start);
+                break;
+            case TREE_QUERY:
+                found.clear();
+                start = Clock::now();
+                tree.queryBounds(opBounds(op), found);
+                timings.query += lap(start);
+                break;
+        }
+    }
+
+    timings.nodes = tree.getNodeCount();
+    timings.height = std::max(tree.getHeight(false), tree.getHeight(true));
+    timings.memory = tree.getMemoryUsage();
+}
+
+void replayBaseline(const double *ops, size_t count, float_type margin, TreeTimings &timings) {
+    baseline::Tree tree(margin);
+    std::unordered_map<int, std::unique_ptr<baseline::Node>> nodes;
+    std::vector<baseline::Node*> found;
+
+    for (size_t i = 0; i < count; i++) {
+        const double *op = ops + i * TREE_OP_COLUMNS;
+        const int id = op[1];
+        Clock::time_point start;
+
+        switch ((int)op[0]) {
+            case TREE_ADD: {
+                std::unique_ptr<baseline::Node> &node = nodes[id];
+                node.reset(new baseline::Node());
+                node->isStatic = op[2] != 0;
+                node->inner = opBounds(op);
+                tree.addNode(node.get());
+                break;
+            }
+            case TREE_REMOVE:
+                tree.removeNode(nodes[id].get());
+                nodes.erase(id);
+                break;
+            case TREE_MOVE:
+                nodes[id]->inner = opBounds(op);
+                break;
+            case TREE_STEP:
+                start = Clock::now();
+                tree.update();
+                timings.update += lap(start);
+                // Pairs of static nodes were thrown away by the world, the current tree never makes them
+                for (const auto &pair : tree.computePairs()) {
+                    if (!pair.first->isStatic || !pair.second->isStatic) timings.pairCount++;
+                }
+                timings.pairs += lap(start);
+                break;
+            case TREE_QUERY:
+                found.clear();
+                start = Clock::now();
+                tree.queryBounds(opBounds(op), found);
+                timings.query += lap(start);
+                break;
+        }
+    }
+
+    tree.measure(timings);
+}
+
+}  // namespace
+
+void replayTreeOps(const double *ops, size_t count, float_type margin, TreeTimings &current, TreeTimings &baseline) {
+    current = TreeTimings();
+    baseline = TreeTimings();
+    replayCurrent(ops, count, margin, current);
+    replayBaseline(ops, count, margin, baseline);
+}
@@ -0,0 +1,26 @@
+#pragma once
+
+#include <cstddef>
+
+#include "vector.h"
+
+// Replays tree operations recorded from a session, see tree_benchmark.py, on the current AABBTree
+// and on the pointer based tree it replaced, so both are timed doing the same work.
+
+// Each op is a row of TREE_OP_COLUMNS doubles: kind, id, static, lower x, lower y, upper x, upper y.
+// Ids are the recorder's own, the bounds are only read for adds, moves and queries
+enum TreeOpKind { TREE_ADD, TREE_REMOVE, TREE_MOVE, TREE_STEP, TREE_QUERY };
+const int TREE_OP_COLUMNS = 7;
+
+struct TreeTimings {
+   double update = 0;  // Seconds spent moving leaves that left their fat bounds
+   double pairs = 0;  // Seconds spent finding the pairs with overlapping bounds
+   double query = 0;  // Seconds spent on bounds queries
+   size_t pairCount = 0;  // Pairs found over every step, not counting pairs of two static proxies
+   size_t nodes = 0;  // As of the end of the session
+   int height = 0;
+   size_t memory = 0;  // Bytes held by the nodes, including any the tree lost track of
+};
+
+// margin is the fat bounds margin both trees use
+void replayTreeOps(const double *ops, size_t count, float_type margin, TreeTimings &current, TreeTimings &baseline);
@@ -0,0 +1,21 @@
+from vector cimport float_type
+
+cdef extern from "treebench.h":
+   enum TreeOpKind:
+      TREE_ADD
+      TREE_REMOVE
+      TREE_MOVE
+      TREE_STEP
+      TREE_QUERY
+   const int TREE_OP_COLUMNS
+
+   cdef struct TreeTimings:
+      double update
+      double pairs
+      double query
+      size_t pairCount
+      size_t nodes
+      int height
+      size_t memory
+
+   void replayTreeOps(const double*, size_t, float_type, TreeTimings&, TreeTimings&)
@@ -16,22 +16,33 @@ class ObjectSync:
 
         self.new = True
         self.ever_dirty = False
+        self.asleep = False
+
+    def update(self, state):
+        # state is the object's row from World.get_state
+        pos = state[0:2]
+        vel = state[2:4]
 
-    def update(self):
         obj_packets = []
         if self.new:
-            self.prev_vel = np.array(self.obj.vel, dtype=float)
-            self.prev_pos = np.array(self.obj.pos, dtype=float)
+            self.prev_vel = vel.copy()
+            self.prev_pos = pos.copy()
             self.new = False
 
             obj_packets += self.get_creation_packets()
+        elif self.obj.sleeping:
+            if not self.asleep: # Make sure clients get the state it came to rest in
+                self.asleep = True
+                self.priority = max(self.priority, 1)
+
+            if self.obj.dirty_state:
+                self.priority += 1
+                self.obj.dirty_state = False
         else:
+            self.asleep = False
             self.priority += 0.02 if self.obj.mass < 0 and self.obj.moment < 0 else 0.1
             self.dt += 1
 
-            pos = np.array(self.obj.pos, dtype=float)
-            vel = np.array(self.obj.vel, dtype=float)
-
             if sum(vel**2) < 0.2**2 and sum(np.array(self.prev_vel)**2): # if stationary
                 pos_prediction = self.prev_pos + self.prev_vel*self.dt
                 vel_prediction = self.prev_vel
@@ -62,9 +73,9 @@ class ObjectSync:
         return obj_packets
 
 
-    def reset(self):
-        self.prev_pos = np.array(self.obj.pos, dtype=float)
-        self.prev_vel = np.array(self.obj.vel, dtype=float)
+    def reset(self, state):
+        self.prev_pos = state[0:2].copy()
+        self.prev_vel = state[2:4].copy()
         self.dt = 0
         self.priority = 0
 
@@ -174,29 +185,33 @@ class Server:
         if not self.paused:
             self.world.update()
 
-        updating_objects = []
-        for obj_sync in self.object_syncs:
-            for packet in obj_sync.update():
+        syncs = self.object_syncs
+        state = self.world.get_state([obj_sync.obj for obj_sync in syncs])
+        updating = []
+        for i, obj_sync in enumerate(syncs):
+            for packet in obj_sync.update(state[i]):
                 self.sendall(packet)
 
             if obj_sync.priority >= 1:
-                obj_sync.reset()
-                updating_objects.append((obj_sync.id, obj_sync.obj))
+                obj_sync.reset(state[i])
+                updating.append(i)
 
         for packet in self.pending_constraints: # TODO handle case where play joins same tick as this
             self.sendall(packet)
         self.pending_constraints.clear()
 
-        for i in range(0, len(updating_objects), 20):
-            self.sendall(packets.UpdateObjectsPacketClient(self.world.tick, updating_objects[i:i+20]))
+        ids = np.array([syncs[i].id for i in updating], dtype=np.uint32)
+        for i in range(0, len(updating), 20):
+            self.sendall(packets.UpdateObjectsPacketClient(self.world.tick, ids[i:i+20], state[updating[i:i+20]]))
 
         for ID, action in actions.items():
             try:
                 player = self.playerIDs[ID]
             except KeyError:
                 continue
+            packet = packets.PlayerStatePacketClient(self.world.tick, ID, player)
             for connection, _ in self.connections.items():
-                connection.send(packets.PlayerStatePacketClient(self.world.tick, ID, player))
+                connection.send(packet)
 
     '''def get_connection(self, player):
        for connection, other in self.connections.items():
@@ -261,6 +276,7 @@ class Server:
                 new_players.append(new_player)
 
                 self.playerIDs[ID] = new_player
+                new_player.sync_id = objects.PLAYER_SYNC_ID + ID
                 world.add_object(new_player)
             new_connections[connection] = new_players
         self.connections = new_connections
@@ -269,8 +285,10 @@ class Server:
 
         self.sendall(packets.LevelPropsPacketClient(world.gravity, world.spawn))
 
-        for obj_sync in self.object_syncs:
-            for packet in obj_sync.update():
+        syncs = self.object_syncs
+        state = self.world.get_state([obj_sync.obj for obj_sync in syncs])
+        for i, obj_sync in enumerate(syncs):
+            for packet in obj_sync.update(state[i]):
                 self.sendall(packet)
 
         if client_script is None:
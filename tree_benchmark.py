@@ -0,0 +1,94 @@
+'''Benchmarks the broadphase AABB tree over long sessions on the bundled levels.
+
+Usage: python tree_benchmark.py [ticks] [level ...]
+
+Every level gets a prototype made from a handful of its dynamic objects, which is then
+spawned repeatedly while old copies are removed, like the prototype spawning in journey.json.
+The session records what happened to the tree, objects coming and going, their bounds each
+tick and some bounds queries, and the recording is replayed on the current tree and on the
+pointer based tree it replaced (kept in physics/treebench.cpp). Reports the time each spent
+refitting, finding pairs and answering queries, along with the size, height and memory of the
+tree at the end.
+'''
+from typing import *
+
+import sys, random, glob, os.path
+import numpy as np
+
+import main, editor
+import physics.physics as physics
+
+SPAWN_INTERVAL = 10
+MAX_SPAWNED = 20
+QUERIES_PER_TICK = 20
+QUERY_SIZE = 64
+
+def is_static(obj) -> bool:
+    return obj.inv_mass == 0 and obj.inv_moment == 0
+
+def record_session(path: str, ticks: int) -> Tuple[np.ndarray, float, int]:
+    # Returns the tree ops, see physics.replay_tree_ops, the tree's margin and the final object count
+    random.seed(0)
+    np.random.seed(0)
+    world = main.create_world(editor.load_file(path))
+    rng = random.Random(0)
+
+    dynamic = [obj for obj in world.objects.values() if obj.mass > 0 and not obj.constraints]
+    spawned: List[list] = []
+    prototype = None
+    if dynamic:
+        prototype = world.make_prototype(random.sample(dynamic, min(len(dynamic), 5)))
+
+    ids: Dict[Any, int] = {}
+    next_id = 0
+    bounds: Dict[Any, tuple] = {}
+    ops = []
+    for tick in range(ticks):
+        if prototype is not None and tick % SPAWN_INTERVAL == 0:
+            spawned.append(prototype())
+            if len(spawned) > MAX_SPAWNED:
+                for obj in spawned.pop(0):
+                    world.remove_object(obj)
+
+        world.update()
+
+        present = set(world)
+        for obj in [obj for obj in ids if obj not in present]:
+            ops.append((physics.TREE_REMOVE, ids.pop(obj), 0, 0, 0, 0, 0))
+            del bounds[obj]
+        for obj in world:
+            lower, upper = obj.bounds
+            box = (*lower, *upper)
+            if obj not in ids:
+                ids[obj] = next_id
+                next_id += 1
+                ops.append((physics.TREE_ADD, ids[obj], is_static(obj), *box))
+            elif bounds[obj] != box:
+                ops.append((physics.TREE_MOVE, ids[obj], 0, *box))
+            bounds[obj] = box
+        ops.append((physics.TREE_STEP, 0, 0, 0, 0, 0, 0))
+
+        # Boxes around random objects, the sort of thing scripts and players look for
+        for obj in rng.choices(list(bounds), k=QUERIES_PER_TICK):
+            x, y = (bounds[obj][0] + bounds[obj][2]) / 2, (bounds[obj][1] + bounds[obj][3]) / 2
+            ops.append((physics.TREE_QUERY, 0, 0, x - QUERY_SIZE / 2, y - QUERY_SIZE / 2,
+                        x + QUERY_SIZE / 2, y + QUERY_SIZE / 2))
+
+    return np.array(ops, dtype=np.float64), world.AABBTree.margin, len(world)
+
+def run(ticks: int, levels: List[str]):
+    print('{:<20} {:>8} {:>9} {:>10} {:>9} {:>9} {:>11} {:>7} {:>7} {:>10}'.format(
+        'level', 'objects', 'tree', 'update ms', 'pairs ms', 'query ms', 'pairs/tick', 'nodes', 'height', 'memory'))
+    for path in levels:
+        ops, margin, objects = record_session(path, ticks)
+        current, baseline = physics.replay_tree_ops(ops, margin)
+        for name, result in (('old', baseline), ('new', current)):
+            print('{:<20} {:>8} {:>9} {:>10.4f} {:>9.4f} {:>9.4f} {:>11.1f} {:>7} {:>7} {:>10}'.format(
+                os.path.basename(path), objects, name, 1000 * result['update'] / ticks, 1000 * result['pairs'] / ticks,
+                1000 * result['query'] / ticks, result['pair_count'] / ticks, result['nodes'], result['height'],
+                result['memory']))
+
+if __name__ == '__main__':
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    levels = [os.path.join('levels', name if name.endswith('.json') else name + '.json') for name in sys.argv[2:]]
+    run(ticks, levels or sorted(glob.glob('levels/*.json')))
@@ -5,10 +5,38 @@ from traceback import print_exc
 import physics.physics as physics
 import util, objects, actions
 
+# Adaptive substepping gives a tick enough substeps that no awake object moves more than SUBSTEP_MOTION
+# of its smallest half extent in one, that contacts are no deeper than SUBSTEP_PENETRATION slops per
+# substep and joints no further apart than SUBSTEP_JOINT_ERROR per substep. Dynamic objects close to
+# each other get at least STACK_STEPS, stacks that settle with fewer creep and never fall asleep
+SUBSTEP_MOTION = 0.5
+SUBSTEP_PENETRATION = 2
+SUBSTEP_JOINT_ERROR = 1
+STACK_STEPS = 3
+
+def update_worlds(pool, worlds, dt=1):
+    # World.update for each world, with the physics of all of them stepped at once on pool (a physics.WorldPool).
+    # The pool's threads are the only ones used, narrowphase_threads is ignored while a world is stepped on one
+    # so a pool as big as the machine doesn't end up with a narrowphase pool as big again under each thread
+    worlds = list(worlds)
+    steps = []
+    for world in worlds:
+        world.last_steps = world.choose_steps(dt)
+        steps.append(world.last_steps)
+    pool.update(worlds, [dt/max(n, 1) for n in steps], steps)
+    for world in worlds:
+        world.finish_update(dt)
+
 class World(physics.World):
     def __init__(self, isHost):
-        super().__init__(baumgarte_bias=0.1, solver_steps=10, slop_p=0.3, slop_r=0.01)
-        self.steps = 3
+        # The narrowphase stays on this thread, a pool only pays off once a level has enough pairs to split.
+        # Measure with benchmark.py --narrowphase-threads before raising it
+        super().__init__(baumgarte_bias=0.1, solver_steps=4, slop_p=0.3, slop_r=0.01)
+        self.steps = 3 # Substeps per tick when adaptive_steps is off
+        self.adaptive_steps = True
+        self.min_steps = 1
+        self.max_steps = 4
+        self.last_steps = 0 # Substeps the last update ran
         self.script = {}
         self.spawn = 0,0
 
@@ -42,6 +70,7 @@ class World(physics.World):
         if '__builtins__' in script:
             memo[id(script['__builtins__'])] = script['__builtins__']
         res = copy.deepcopy(self, memo=memo)
+        res.restore(self.snapshot()) # Contacts and joint impulses don't survive deepcopy
 
         for key, val in res.script.items(): # Update script scopes
             if type(val) == types.FunctionType and val.__globals__ is self.script:
@@ -53,22 +82,54 @@ class World(physics.World):
                 res.script[key] = func
         return res
 
+    def choose_steps(self, dt=1):
+        # Nothing to measure before the first update, there are no contacts yet. Deterministic worlds
+        # keep to a fixed count, a peer a little behind on state mustn't step differently
+        if not self.adaptive_steps or self.deterministic or self.last_steps == 0:
+            return math.ceil(self.steps * dt)
+
+        metrics = self.measure()
+        needed = max(metrics['max_motion'] * dt / SUBSTEP_MOTION,
+                     metrics['max_penetration'] / (SUBSTEP_PENETRATION * self.slop_p),
+                     metrics['max_joint_error'] / SUBSTEP_JOINT_ERROR,
+                     STACK_STEPS * dt if metrics['dynamic_pairs'] else 0)
+        return min(max(math.ceil(needed), math.ceil(self.min_steps * dt)), math.ceil(self.max_steps * dt))
+
     def update(self, dt=1):
-        steps = math.ceil(self.steps * dt)
-        for _ in range(steps):
-            super().update(dt/steps)
+        steps = self.last_steps = self.choose_steps(dt)
+        super().update(dt/max(steps, 1), steps)
+        self.finish_update(dt)
+
+    def finish_update(self, dt):
+        # Everything after the physics in update, see update_worlds
         self.tick += dt
 
         self.script['time'] = self.tick
+        self.dispatch_collisions()
         if 'tick' in self.script:
             try:
                 self.script['tick']()
             except:
                 print_exc()
 
-        for obj in self:
+        for player in self.pop_deaths():
+            player.die()
+
+        for obj in self.objects.values():
             obj.update(dt)
 
+    def dispatch_collisions(self):
+        # Objects with report_collisions set get on_collision(other, normal, local_a, local_b, impulse),
+        # with the normal pointing away from them
+        for obj_a, obj_b, normal, local_a, local_b, impulse in zip(*self.pop_collision_events()):
+            try:
+                if obj_a.report_collisions:
+                    obj_a.on_collision(obj_b, -normal, local_a, local_b, impulse)
+                if obj_b.report_collisions:
+                    obj_b.on_collision(obj_a, normal, local_b, local_a, impulse)
+            except:
+                print_exc()
+
     def copy_objects(self, objects, ID):
         memo = {id(self) : self}
         new_objects = copy.deepcopy(objects, memo=memo)
@@ -103,6 +164,7 @@ class World(physics.World):
     def add_object(self, obj):
         if isinstance(obj, objects.Object):
             self.objects[self.current_object_id] = obj
+            obj.sync_id = self.current_object_id
             self.current_object_id += 1
         if isinstance(obj, objects.BasePlayer):
             self.players.append(obj)
@@ -139,6 +201,8 @@ class World(physics.World):
 
     def load_script(self, script):
         self.script = {'players': self.players, 'time': self.tick, 'get_group': self.get_group, 'math': math, 'random':random, 'objects': self.objects, 'BasePlayer': objects.BasePlayer, 'Object': objects.Object}
+        self.script.update({'raycast': self.raycast, 'raycast_many': self.raycast_many, 'query_point': self.query_point, 'query_points': self.query_points,
+                            'query_aabb': self.query_aabb, 'query_shape': self.query_shape, 'CircleCollider': physics.CircleCollider, 'PolyCollider': physics.PolyCollider})
         if self.isHost:
             self.script.update({'add_object': self.add_object, 'remove_object': self.remove_object, 'create_object' : self.create_object, 'make_prototype': self.make_prototype})
         else: